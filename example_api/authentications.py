@@ -1,27 +1,119 @@
+import ipaddress
+
+from django.conf import settings
 from rest_framework.authentication import BaseAuthentication
-from django.contrib.auth import get_user_model
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.settings import api_settings
+
+
+class NetworkAllowlist(object):
+
+    """set of CIDR networks compiled once for fast membership checks
+
+    networks are grouped by prefix length as sets of their masked address
+    integers, so checking an address is one shift and set lookup per prefix
+    length in use (usually a handful).
+    """
+
+    def __init__(self, cidrs=()):
+        # version -> [(prefixlen, set of network ints)], longest prefix first
+        self._tables = {4: {}, 6: {}}
+
+        for cidr in cidrs:
+            network = ipaddress.ip_network(cidr, strict=False)
+            shift = network.max_prefixlen - network.prefixlen
+            self._tables[network.version].setdefault(shift, set()).add(
+                int(network.network_address) >> shift)
+
+        self._tables = {version: sorted(table.items())
+            for version, table in self._tables.items()}
+
+    def __bool__(self):
+        return any(self._tables.values())
+
+    def __contains__(self, address):
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+
+        value = int(address)
+        return any(value >> shift in networks
+            for shift, networks in self._tables[address.version])
+
+
+class GatewayPrincipal(object):
+
+    """the request.user of gateway callbacks, no database row behind it
+    """
+
+    username = 'gateway'
+    pk = id = None
+    is_active = True
+    is_staff = False
+    is_superuser = False
+    is_anonymous = False
+    is_authenticated = True
+
+    def __str__(self):
+        return self.username
+
+
+gateway_principal = GatewayPrincipal()
+
+# GATEWAY_CALLBACK_NETWORKS = ['175.99.72.0/24', ...], empty means any source,
+# the signature is checked by the views anyway
+callback_networks = NetworkAllowlist(
+    getattr(settings, 'GATEWAY_CALLBACK_NETWORKS', ()))
+
+
+def source_ip(request):
+    """the address the request came from, REMOTE_ADDR unless NUM_PROXIES of
+    rest framework is set, then the client address our NUM_PROXIES proxies
+    appended to X-Forwarded-For (the rest of the header is the caller's)
+    """
+    num_proxies = api_settings.NUM_PROXIES
+    forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+
+    if num_proxies and forwarded_for:
+        addrs = [addr.strip() for addr in forwarded_for.split(',')]
+        return addrs[-min(num_proxies, len(addrs))]
+
+    return request.META.get('REMOTE_ADDR')
 
 
 class EnableExternalRequest(BaseAuthentication):
 
     """this is a special authentication which removed the
     csrf check for SessionAuthentication.
-    """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    it's for the pages cash flow merchants redirect the buyer back to, no
+    query is made, request.user is gateway_principal. The views check the
+    signature of what they get.
+    """
 
     def authenticate(self, request):
         """no need to authenticate requester
         """
-
-        User = get_user_model()
-        user = User.objects.all()[0]
-
-        return (user, None)
-
+        return (gateway_principal, None)
 
     def enforce_csrf(self, request):
         """overwrite this one to disable csrf check
         """
-        print('enter')
+        return
+
+
+class GatewayCallback(EnableExternalRequest):
+
+    """server to server notifies of cash flow merchants, authenticated by
+    their source ip too (GATEWAY_CALLBACK_NETWORKS, see source_ip)
+
+    don't use it for buyer returns, they come from the buyer's ip.
+    """
+
+    def authenticate(self, request):
+        if callback_networks:
+            if source_ip(request) not in callback_networks:
+                raise AuthenticationFailed('source ip is not allowed')
+
+        return super().authenticate(request)
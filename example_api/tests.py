@@ -0,0 +1,242 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test import override_settings
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.settings import api_settings
+from rest_framework.test import APIRequestFactory
+
+from saleor.order.models import Order
+from saleor.order.models import Payment
+from saleor.userprofile.models import Address
+
+from cnpayments.models import CashFlowLog
+from cnpayments.paypal.nvp import NVPResponse
+
+from . import authentications
+from . import views
+from .authentications import GatewayCallback
+from .authentications import NetworkAllowlist
+
+
+GATEWAY_IP = '175.99.72.1'
+
+
+@mock.patch.object(authentications, 'callback_networks',
+    NetworkAllowlist(['175.99.72.0/24']))
+class GatewayCallbackTest(SimpleTestCase):
+
+    """a callback is let in by its REMOTE_ADDR, X-Forwarded-For only counts
+    as far as NUM_PROXIES says
+    """
+
+    def authenticate(self, remote_addr, forwarded_for=None):
+        extra = {'REMOTE_ADDR': remote_addr}
+        if forwarded_for is not None:
+            extra['HTTP_X_FORWARDED_FOR'] = forwarded_for
+
+        return GatewayCallback().authenticate(
+            RequestFactory().post('/', **extra))
+
+    def test_gateway(self):
+        user, _auth = self.authenticate(GATEWAY_IP)
+        self.assertTrue(user.is_authenticated)
+
+    def test_other_source(self):
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate('203.0.113.9')
+
+    @mock.patch.object(api_settings, 'NUM_PROXIES', None)
+    def test_spoofed_forwarded_for(self):
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate('203.0.113.9', GATEWAY_IP)
+
+    @mock.patch.object(api_settings, 'NUM_PROXIES', 1)
+    def test_behind_proxy(self):
+        user, _auth = self.authenticate('10.0.0.2', GATEWAY_IP)
+        self.assertTrue(user.is_authenticated)
+
+    @mock.patch.object(api_settings, 'NUM_PROXIES', 1)
+    def test_spoofed_forwarded_for_behind_proxy(self):
+        # the caller's own header is left of what our proxy appended
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate('10.0.0.2', GATEWAY_IP + ', 203.0.113.9')
+
+
+def make_order():
+    address = Address.objects.create(first_name='Xiaoming', last_name='Wang',
+        street_address_1='No. 1, Section 1', city='Taipei', postal_code='100',
+        country='TW')
+    return Order.objects.create(billing_address=address,
+        user_email='buyer@example.com')
+
+
+def make_payment(variant, **kwargs):
+    return Payment.objects.create(order=make_order(), variant=variant,
+        status='waiting', total=100, currency='TWD', **kwargs)
+
+
+def call(view, method, path='/', data=None, **kwargs):
+    factory = APIRequestFactory()
+    request = getattr(factory, method)(path, data or {},
+        HTTP_USER_AGENT='gateway', REMOTE_ADDR=GATEWAY_IP)
+    return view.as_view()(request, **kwargs)
+
+
+# the status change of the host models (and what it does to the order) is
+# not the views' work, it's mocked. Every transaction.atomic of a view is a
+# savepoint in a test, two queries more.
+change_status = mock.patch.object(Payment, 'change_status', autospec=True)
+
+
+@change_status
+@mock.patch.object(views, 'get_provider')
+class NotifyQueriesTest(TestCase):
+
+    """the notify views read the payment once, with its order, and lock it
+    while its status changes
+    """
+
+    def test_allpay_asynchro_notify(self, get_provider, change_status):
+        payment = make_payment('allpay', tradeNo='T20160101000001')
+        get_provider.return_value.verify_macValue.return_value = True
+
+        # the log, then the locked payment
+        with self.assertNumQueries(2 + 2 * 2):
+            response = call(views.AllPayAsynchroNotify, 'post', data={
+                'MerchantTradeNo': 'T20160101000001', 'RtnCode': '1',
+                'PaymentDate': '2016/01/01 00:00:00'})
+
+        self.assertEqual(response.content, b'1|OK')
+        change_status.assert_called_once_with(mock.ANY, 'confirmed')
+        self.assertEqual(change_status.call_args[0][0].pk, payment.pk)
+
+        # allpay retries, answered from the cache
+        with self.assertNumQueries(0):
+            response = call(views.AllPayAsynchroNotify, 'post', data={
+                'MerchantTradeNo': 'T20160101000001', 'RtnCode': '1',
+                'PaymentDate': '2016/01/01 00:00:00'})
+
+        self.assertEqual(response.content, b'1|OK')
+
+    def test_allpay_asynchro_notify_dropped_log(self, get_provider,
+        change_status):
+        make_payment('allpay', tradeNo='T20160101000003', logs=7)
+        get_provider.return_value.verify_macValue.return_value = True
+
+        with mock.patch.object(CashFlowLog, 'fill_fields',
+            side_effect=ValueError):
+            response = call(views.AllPayAsynchroNotify, 'post', data={
+                'MerchantTradeNo': 'T20160101000003', 'RtnCode': '1',
+                'PaymentDate': '2016/01/01 00:00:00'})
+
+        self.assertEqual(response.content, b'1|OK')
+        # the payment keeps the log it had
+        self.assertEqual(change_status.call_args[0][0].logs, 7)
+
+    def test_allpay_synchro_notify(self, get_provider, change_status):
+        make_payment('allpay', tradeNo='T20160101000002')
+        get_provider.return_value.verify_macValue.return_value = True
+
+        # the log is written later by the buffer
+        with self.assertNumQueries(1):
+            response = call(views.AllPaySynchroNotify, 'post', data={
+                'MerchantTradeNo': 'T20160101000002', 'RtnCode': '1'})
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_alipay_asynchro_notify(self, get_provider, change_status):
+        get_provider.return_value.verify_notify.return_value = True
+
+        with self.assertNumQueries(0):
+            response = call(views.AsynchroNotify, 'post', data={
+                'notify_id': 'N20160101000001', 'out_trade_no': 'T1'})
+
+        self.assertEqual(response.content, b'success')
+
+
+@change_status
+@mock.patch.object(views, 'get_provider')
+class PayPalSynchroNotifyQueriesTest(TestCase):
+
+    """the paypal return reads the payment once and locks it to confirm it
+    """
+
+    def setUp(self):
+        self.payment = make_payment('paypal')
+
+    def call(self):
+        return call(views.PayPalSynchroNotify, 'get',
+            data={'token': 'EC-1', 'PayerID': 'PAYER1'},
+            payment_token=self.payment.token)
+
+    def test_capture(self, get_provider, change_status):
+        get_provider.return_value.get_nvp_response.side_effect = [
+            NVPResponse('ACK=Success&TOKEN=EC-1&PAYERID=PAYER1'),
+            NVPResponse('ACK=Success&PAYMENTINFO_0_TRANSACTIONID=TX1'),
+        ]
+
+        # the payment, the logs and their link to it, the locked payment
+        with self.assertNumQueries(4 + 2 * 3):
+            response = self.call()
+
+        self.assertEqual(response.status_code, 302)
+        change_status.assert_called_once_with(mock.ANY, 'confirmed')
+
+    @override_settings(PAYPAL_CAPTURE_IN_BACKGROUND=True)
+    def test_capture_in_background(self, get_provider, change_status):
+        # the payment, its UPDATE to preauth
+        with self.assertNumQueries(2):
+            self.call()
+
+        get_provider.return_value.get_nvp_response.assert_not_called()
+
+    def test_gateway_unavailable(self, get_provider, change_status):
+        get_provider.return_value.get_nvp_response.side_effect = \
+            views.GatewayUnavailable('paypal gateway is unavailable')
+
+        with mock.patch.object(views, 'gateway_unavailable',
+            return_value=HttpResponse(status=503)) as gateway_unavailable:
+            with self.assertNumQueries(1):
+                response = self.call()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('EC-1', gateway_unavailable.call_args[1]['retry_url'])
+
+
+@mock.patch.object(views.PaymentProcess, 'authentication_classes', ())
+@mock.patch.object(views, 'redirect', return_value=HttpResponse())
+@mock.patch.object(Order, 'change_status')
+class PaymentProcessQueriesTest(TestCase):
+
+    """the order is read once with its billing address and user
+    """
+
+    def setUp(self):
+        self.order = make_order()
+        total = SimpleNamespace(gross=100, tax=0, currency='TWD')
+
+        for name in ('get_total', 'get_delivery_total'):
+            patcher = mock.patch.object(Order, name, return_value=total)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call(self):
+        return call(views.PaymentProcess, 'get',
+            data={'token': self.order.token, 'method': 'allpay'})
+
+    def test_queries(self, order_change_status, redirect):
+        # the order, then get_or_create of the payment (the host model
+        # checks its token is unique before the INSERT)
+        with self.assertNumQueries(4 + 2 * 2):
+            self.call()
+
+        # the payment is there now
+        with self.assertNumQueries(2 + 2):
+            self.call()
+
+        self.assertEqual(Payment.objects.filter(order=self.order).count(), 1)
@@ -5,6 +5,7 @@ from web_api.cnpayments.views import PaymentProcess
 from web_api.cnpayments.views import AllPayAsynchroNotify
 from web_api.cnpayments.views import AllPaySynchroNotify
 from web_api.cnpayments.views import PayPalSynchroNotify
+from web_api.cnpayments.views import PaymentStatus
 
 urlpatterns = [
     url(r'payment_process', PaymentProcess.as_view(), name='payment_process'),
@@ -13,4 +14,5 @@ urlpatterns = [
     url(r'allpay_asynchro_notify', AllPayAsynchroNotify.as_view(), name='allpay_asynchro_notify'),
     url(r'allpay_synchro_notify', AllPaySynchroNotify.as_view(), name='allpay_synchro_notify'),
     url(r'paypal_synchro_notify/(?P<payment_token>.+)/', PayPalSynchroNotify.as_view(), name='paypal_synchro_notify'),
+    url(r'payment_status/(?P<payment_token>.+)/', PaymentStatus.as_view(), name='payment_status'),
 ]
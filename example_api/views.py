@@ -6,6 +6,7 @@ from django.http import Http404
 from django.shortcuts import redirect
 from django.conf import settings
 from django.db import transaction
+import requests
 
 from rest_framework import permissions
 from rest_framework.views import APIView
@@ -15,13 +16,21 @@ from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 from saleor.order.models import Order
 from saleor.order.models import Payment
 from saleor.order.models import get_ip
-from payments import provider_factory
 
-from cnpayments.alipay import AliPayProvider
-from cnpayments.allpay import AllPayProvider
-from cnpayments.models import CashFlowLog
+from cnpayments.cashflow import cash_flow_log_buffer
+from cnpayments.circuitbreaker import GatewayUnavailable
+from cnpayments.idempotency import alipay_notify_deduplicator
+from cnpayments.idempotency import allpay_notify_deduplicator
+from cnpayments.instrumentation import STATUS_CHANGE
+from cnpayments.instrumentation import timed
+from cnpayments.lookups import get_payment
+from cnpayments.lookups import lock_payment
+from cnpayments.paypal.tasks import start_capture
+from cnpayments.registry import get_provider
+from cnpayments.views import gateway_unavailable
 
 from .authentications import EnableExternalRequest
+from .authentications import GatewayCallback
 
 
 class PaymentProcess(APIView):
@@ -46,7 +55,8 @@ class PaymentProcess(APIView):
         data = request.query_params
 
         if data['token'] is not None:
-            order = Order.objects.filter(token=data['token']).first()
+            order = Order.objects.select_related('billing_address', 'user') \
+                .filter(token=data['token']).first()
             # start to check order total number is consistent with sum of all items
             price_consistent = True
 
@@ -101,17 +111,30 @@ class AsynchroNotify(APIView):
     """
 
     permissions = (permissions.AllowAny, )
-    authentication_classes = (EnableExternalRequest, )
+    authentication_classes = (GatewayCallback, )
 
     def post(self, request):
         """log the request first, and then process the cash flow response
         """
-        alipay = AliPayProvider()  # special use, no param given, just call some method
+        alipay = get_provider('alipay')
         data = request.data
 
-        if alipay.verify_notify(**data):
+        # alipay retries until it gets success
+        notify_id = data.get('notify_id')
+        response = alipay_notify_deduplicator.get(notify_id, data)
+        if response is not None:
+            return HttpResponse(response)
+
+        try:
+            verified = alipay.verify_notify(**data)
+        except requests.RequestException:
+            # notify_verify failed, alipay sends the notify again
+            return HttpResponse('fail')
+
+        if verified:
             # verify pass, TODO: do some process here ex. payment processing and logging
 
+            alipay_notify_deduplicator.set(notify_id, data, 'success')
             return HttpResponse('success')
         else:
             # this request may be faked which made by cracker..
@@ -134,10 +157,15 @@ class SynchroNotify(APIView):
         the order view page if it's verified. Otherwise, redirect to
         """
 
-        alipay = AliPayProvider()
+        alipay = get_provider('alipay')
         data = request.query_params
 
-        if alipay.verify_notify(**data):
+        try:
+            verified = alipay.verify_notify(**data)
+        except requests.RequestException:
+            verified = False
+
+        if verified:
             # TODO: same as above
 
             return HttpResponseRedirect('')
@@ -158,19 +186,26 @@ class AllPayAsynchroNotify(APIView):
     """
 
     permissions = (permissions.AllowAny, )
-    authentication_classes = (EnableExternalRequest, )
+    authentication_classes = (GatewayCallback, )
 
     def post(self, request):
         """
         """
 
-        allpay = provider_factory('allpay')
+        allpay = get_provider('allpay')
         data = request.data
 
-        cash_flow_log = CashFlowLog.objects.create(
-            json_res=json.dumps(data),
+        # allpay retries until it gets 1|OK
+        tradeNo = data.get('MerchantTradeNo')
+        response = allpay_notify_deduplicator.get(tradeNo, data)
+        if response is not None:
+            return HttpResponse(response)
+
+        cash_flow_log = cash_flow_log_buffer.add(
+            data,
             source_device=request.META['HTTP_USER_AGENT'],
             source_ip=get_ip(request),
+            provider='allpay',
         )
 
         data = json.loads(json.dumps(data))
@@ -180,15 +215,28 @@ class AllPayAsynchroNotify(APIView):
             RtnCode = int(data['RtnCode'])
 
             if RtnCode in [1, 800]:
-                tradeNo = data['MerchantTradeNo']
-                payment = Payment.objects.filter(tradeNo=tradeNo).first()
-                payment.logs = cash_flow_log.pk
-                payment.attrs.PaymentDate = data['PaymentDate']
-
-                payment.change_status('confirmed')
+                # the log must be written before the payment status changes,
+                # and before the payment is locked (flush updates payments)
+                cash_flow_log_buffer.flush()
+
+                with transaction.atomic():
+                    # a retried notify waits here until this one is done
+                    payment = lock_payment(Payment.objects, tradeNo=tradeNo)
+                    if payment is None:
+                        return HttpResponse('0|ErrorMessage')
+
+                    if payment.status != 'confirmed':
+                        # a dropped log (pk None) keeps the earlier link
+                        if cash_flow_log.pk is not None:
+                            payment.logs = cash_flow_log.pk
+                        payment.attrs.PaymentDate = data['PaymentDate']
+
+                        with timed('allpay', STATUS_CHANGE):
+                            payment.change_status('confirmed')
             else:
                 return HttpResponse('0|ErrorMessage')
 
+            allpay_notify_deduplicator.set(tradeNo, request.data, '1|OK')
             return HttpResponse('1|OK')
         else:
 
@@ -206,20 +254,21 @@ class AllPaySynchroNotify(APIView):
     def post(self, request):
         """
         """
-        allpay = provider_factory('allpay')
+        allpay = get_provider('allpay')
         data = request.data
 
-        cashFlowLog = CashFlowLog.objects.create(
-            json_res=json.dumps(data),
+        tradeNo = data['MerchantTradeNo']
+        payment = get_payment(Payment.objects, related=(), tradeNo=tradeNo)
+
+        # payment.logs is updated when the log is written
+        cash_flow_log_buffer.add(
+            data,
             source_device=request.META['HTTP_USER_AGENT'],
             source_ip=get_ip(request),
+            payment=payment,
+            provider='allpay',
         )
 
-        tradeNo = data['MerchantTradeNo']
-        payment = Payment.objects.filter(tradeNo=tradeNo).first()
-        payment.logs = cashFlowLog.pk
-        payment.save()
-
         data = json.loads(json.dumps(data))
 
         if allpay.verify_macValue(**data):
@@ -240,15 +289,16 @@ class PayPalSynchroNotify(APIView):
     authentication_classes = (EnableExternalRequest, )
 
     def _addLogForCashFlow(self, payment, data):
+        """buffer the log, payment.logs is updated when it's written
         """
-        """
-        cashFlowLog = CashFlowLog.objects.create(
-            json_res=json.dumps(data),
+        cashFlowLog = cash_flow_log_buffer.add(
+            data,
             source_device=self.request.META['HTTP_USER_AGENT'],
             source_ip=get_ip(self.request),
+            payment=payment,
+            provider='paypal',
         )
-        payment.logs = cashFlowLog.pk
-        payment.save()
+        return cashFlowLog
 
 
     def get(self, request, payment_token):
@@ -259,7 +309,7 @@ class PayPalSynchroNotify(APIView):
         PayerID is need for capture payment
         """
         data = request.query_params
-        paypal = provider_factory('paypal')
+        paypal = get_provider('paypal')
 
         # import pdb
         # pdb.set_trace()
@@ -268,39 +318,51 @@ class PayPalSynchroNotify(APIView):
             'TOKEN': data['token'],
         }
 
-        cashFlowLog = CashFlowLog.objects.create(
-            json_res=json.dumps(data),
-            source_device=request.META['HTTP_USER_AGENT'],
-            source_ip=get_ip(request),
-        )
+        payment = get_payment(Payment.objects, token=payment_token)
+        if payment is None:
+            return HttpResponseRedirect('/')
 
-        payment = Payment.objects.filter(token=payment_token).first()
-        payment.logs = cashFlowLog.pk
-        payment.save()
+        self._addLogForCashFlow(payment, data)
 
+        if getattr(settings, 'PAYPAL_CAPTURE_IN_BACKGROUND', False):
+            # one UPDATE to preauth, the order page polls PaymentStatus
+            start_capture(payment, data['token'],
+                source_device=request.META['HTTP_USER_AGENT'],
+                source_ip=get_ip(request))
+            return HttpResponseRedirect('/profile/orderList/')
 
         # call GetExpressCheckoutDetail api
-        url = paypal.getExpressCheckoutDetails(**_params)
-        res = paypal.get_nvp_response(url)
+        body = paypal.getExpressCheckoutDetails(**_params)
+        try:
+            res = paypal.get_nvp_response(body)
+        except GatewayUnavailable:
+            # paypal is down, the buyer can come back with the same token
+            return gateway_unavailable(request._request, payment,
+                retry_url=request.get_full_path())
         self._addLogForCashFlow(payment, res)
 
-        if res['ACK'][0] == 'Failure':
+        if not res.is_success:
             return HttpResponseRedirect('/')
         else:
             # go on DoExpressCheckoutPayment..
             # auto confirm?
             doExpress_data = {
-                'TOKEN': res['TOKEN'][0],
-                'PAYERID': res['PAYERID'][0],
+                'TOKEN': res['TOKEN'],
+                'PAYERID': res['PAYERID'],
                 'PAYMENTREQUEST_0_PAYMENTACTION': 'Sale',
                 'PAYMENTREQUEST_0_AMT': payment.get_total_price().gross,
             }
 
-            url = paypal.doExpressCheckoutPayment(**doExpress_data)
-            res = paypal.get_nvp_response(url)
-            self._addLogForCashFlow(payment, res)
+            body = paypal.doExpressCheckoutPayment(**doExpress_data)
+            try:
+                res = paypal.get_nvp_response(body)
+            except GatewayUnavailable:
+                # not captured, the return url can be loaded again
+                return gateway_unavailable(request._request, payment,
+                    retry_url=request.get_full_path())
+            cashFlowLog = self._addLogForCashFlow(payment, res)
 
-            if res['ACK'][0] == 'Failure':
+            if not res.is_success:
                 return HttpResponseRedirect('/')
             else:
                 # start to change payment status
@@ -308,7 +370,37 @@ class PayPalSynchroNotify(APIView):
                 # it will automatically check whether order is full paid or not
                 # and then change order status when I change the payment status
 
-                payment.change_status('confirmed')
+                # the logs must be written before the payment status changes,
+                # and before the payment is locked (flush updates payments)
+                cash_flow_log_buffer.flush()
+
+                with transaction.atomic():
+                    payment = lock_payment(Payment.objects, pk=payment.pk)
+
+                    if payment.status != 'confirmed':
+                        # a dropped log (pk None) keeps the earlier link
+                        if cashFlowLog.pk is not None:
+                            payment.logs = cashFlowLog.pk
+                        with timed('paypal', STATUS_CHANGE):
+                            payment.change_status('confirmed')
 
 
         return HttpResponseRedirect('/profile/orderList/')
+
+
+class PaymentStatus(APIView):
+
+    """status of a payment for the order page to poll, e.g. while a paypal
+    payment is captured in background (preauth)
+    """
+
+    permission_classes = (permissions.AllowAny, )
+    authentication_classes = (JSONWebTokenAuthentication, )
+
+    def get(self, request, payment_token):
+        payment = Payment.objects.filter(token=payment_token) \
+            .values('status').first()
+        if payment is None:
+            raise Http404
+
+        return Response({'status': payment['status']})
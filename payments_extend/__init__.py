@@ -0,0 +1 @@
+default_app_config = __name__ + '.apps.PaymentsExtendConfig'
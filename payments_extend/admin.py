@@ -5,7 +5,11 @@ from cnpayments.models import CashFlowLog
 
 class CashFlowLogAdmin(admin.ModelAdmin):
 
-    list_display = ('source_ip', 'created_at')
+    list_display = ('provider', 'trade_no', 'result_code', 'amount',
+        'source_ip', 'created_at')
+    list_filter = ('provider', )
+    search_fields = ('=trade_no', '=payment_token')
+    date_hierarchy = 'created_at'
 
 
 admin.site.register(CashFlowLog, CashFlowLogAdmin)
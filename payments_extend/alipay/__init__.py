@@ -1,10 +1,11 @@
 import binascii
 import collections
-import hashlib
 import json
-import copy
+import functools
+from types import MappingProxyType
 from urllib.parse import quote_plus, urlencode
 
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.shortcuts import redirect
 from django.utils.translation import pgettext_lazy
@@ -12,24 +13,87 @@ from django.utils.translation import pgettext_lazy
 from payments import BasicProvider
 import requests
 
+from .. import batch
+from ..cache import MemoCache
+from ..instrumentation import HTTP
+from ..instrumentation import SIGN
+from ..instrumentation import VERIFY
+from ..instrumentation import timed
+from ..sessions import get_session
+from ..sessions import pop_session_options
 from .exceptions import MissingParameter
 from .exceptions import ParameterValueError
 from .exceptions import TokenAuthorizationError
+from .exceptions import TradeQueryError
+from .response import parse_query_response
+from .signer import encode_param
+from .signer import get_md5_signer
+from .signer import get_rsa_signer
+from .signer import verify_sign
+
+
+# remote notify_verify verdicts by notify_id, shared by all providers of the
+# process and across workers if ALIPAY_NOTIFY_VERIFY_CACHE names a cache
+notify_verify_cache = MemoCache(
+    'payments_extend:alipay:notify_verify',
+    maxsize=getattr(settings, 'ALIPAY_NOTIFY_VERIFY_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'ALIPAY_NOTIFY_VERIFY_CACHE_TTL', 60 * 60),
+    cache_alias=getattr(settings, 'ALIPAY_NOTIFY_VERIFY_CACHE', None),
+)
 
 
 class AliPayProvider(BasicProvider):
 
     """the document rule the version must be 1.0
+
+    sign_type can be MD5 (secret_key), RSA (SHA1withRSA) or RSA2
+    (SHA256withRSA). For RSA, private_key signs our requests and
+    alipay_public_key verifies the notifies (it's needed as soon as a key is
+    given), both are PEM text or the base64 body alipay shows. Keys are parsed once per provider, RSA needs the
+    cryptography package.
+
+        'alipay': ('payments_extend.alipay.AliPayProvider', {
+            'vendor': '2088...',
+            'private_key': open('/path/to/rsa_private_key.pem').read(),
+            'alipay_public_key': open('/path/to/alipay_public_key.pem').read(),
+            'sign_type': 'RSA2',
+        }),
     """
 
     _version = '1.0'
     _action = 'https://mapi.alipay.com/gateway.do'
 
-    def __init__(self, vendor=None, app_id=None, secret_key=None, endpoint=_action, **kwargs):
+    def __init__(self, vendor=None, app_id=None, secret_key=None, endpoint=_action,
+        private_key=None, alipay_public_key=None, sign_type='MD5', **kwargs):
         self._vendor = vendor  # partner_id ?
         self._app_id = app_id  # seller_id ?
         self._secret_key = secret_key
         self._action = endpoint
+        self._sign_type = sign_type.upper()
+
+        # sign_type -> signer, used to sign requests and verify notifies
+        self._signers = {}
+        if secret_key is not None:
+            self._signers['MD5'] = get_md5_signer(secret_key)
+
+        if private_key is not None or alipay_public_key is not None:
+            # a notify signed with RSA couldn't be verified, every one would
+            # fail with a server error
+            if alipay_public_key is None:
+                raise ImproperlyConfigured(
+                    'alipay_public_key is required for alipay RSA sign')
+            if self._sign_type in ('RSA', 'RSA2') and private_key is None:
+                raise ImproperlyConfigured(
+                    'private_key is required for alipay {} sign'.format(
+                        self._sign_type))
+
+            try:
+                for rsa_type in ('RSA', 'RSA2'):
+                    self._signers[rsa_type] = get_rsa_signer(
+                        rsa_type, private_key, alipay_public_key)
+            except ImportError:
+                raise ImproperlyConfigured(
+                    'cryptography is required for alipay RSA sign')
 
         self._core_params = {
             '_input_charset': 'utf-8',
@@ -38,7 +102,12 @@ class AliPayProvider(BasicProvider):
         }
 
         if self._app_id is not None:
-            self._core_params['seller_id'] = seller_id
+            self._core_params['seller_id'] = self._app_id
+
+        # providers are shared by requests, don't change it after here
+        self._core_params = MappingProxyType(self._core_params)
+
+        self._session = get_session('alipay', **pop_session_options(kwargs))
 
         super().__init__(**kwargs)
         if not self._capture:
@@ -46,6 +115,11 @@ class AliPayProvider(BasicProvider):
                 pgettext_lazy('alipay does not support pre-authorization')
             )
 
+    def get_breaker(self):
+        """the circuit breaker of the gateway, None if it's turned off
+        """
+        return self._session.breaker
+
     def _check_params(self, params, requirements):
         """be used for checking params which is needed by
         action method.
@@ -56,15 +130,27 @@ class AliPayProvider(BasicProvider):
     def _generate_md5_sign(self, param, private_key):
         """implement encrypt by md5 algorithm
         """
-        data = self._encode_param(param)
-        result = hashlib.md5(data + private_key).hexdigest()
-        return result
+        return get_md5_signer(private_key).sign(param)
 
     def _generate_rsa_sign(self, param, private_key):
-        """I have no idea whether the sign_type must be
-        rsa or not...
+        """SHA1withRSA sign, private_key is ignored, the key parsed when the
+        provider is created is used
         """
-        pass
+        return self._get_signer('RSA').sign(param)
+
+    def _generate_rsa2_sign(self, param, private_key):
+        """SHA256withRSA sign, private_key is ignored like _generate_rsa_sign
+        """
+        return self._get_signer('RSA2').sign(param)
+
+    def _get_signer(self, sign_type):
+        signer = self._signers.get(sign_type.upper(), None)
+
+        if signer is None:
+            raise ImproperlyConfigured(
+                'no key is given for sign_type {}'.format(sign_type))
+
+        return signer
 
     def _encode_param(self, param):
         """encode the param before use md5 or RSA algorithm.
@@ -73,17 +159,7 @@ class AliPayProvider(BasicProvider):
 
         ref: https://b.alipay.com/order/techService.htm?src=nsf05/
         """
-        _param = copy.deepcopy(param)
-        keys_needed_pop = ['sign', 'sign_type']
-
-        for key in keys_needed_pop:
-            if key in _param:
-                _param.pop(key)
-
-        sorted_items = sorted(_param.items())
-        result = '&'.join(['{}={}'.format(key, value) for key, value in sorted_items if value != ''])
-
-        return result
+        return encode_param(param)
 
     def _generate_sign(self, sign_type, param):
         """according to the sign_type return the correspond encrypt algorithm
@@ -97,7 +173,8 @@ class AliPayProvider(BasicProvider):
                 "there is no method named {}".format(name)
             )
 
-        return signGenerator(param, self._secret_key)
+        with timed('alipay', SIGN):
+            return signGenerator(param, self._secret_key)
 
     def _get_notify_url(self, notify_id):
         """generate the notify url.
@@ -111,18 +188,33 @@ class AliPayProvider(BasicProvider):
     def _check_is_alipay_notify_or_not(self, notify_id):
         """Check whether it is valid or not.
         In page 9.
+
+        a valid notify_id is memoized, so a retried notify or the synchro
+        notify of the same trade doesn't request alipay again. Anything else
+        is asked again next time, the answer may have been an error page.
         """
-        result = requests.get(self._get_notify_url(notify_id), headers={'connection': 'close'}).text
-        return result == 'true'
+        key = '{}:{}'.format(self._vendor, notify_id)
+        return notify_verify_cache.get_or_call(
+            key, lambda: self._request_notify_verify(notify_id), store=bool)
+
+    def _request_notify_verify(self, notify_id):
+        with timed('alipay', HTTP):
+            r = self._session.get(self._get_notify_url(notify_id))
+        r.raise_for_status()
+        return r.text == 'true'
 
     def verify_notify(self, **kwargs):
         """check the sign from alipay whether is consistent or not.
+
+        md5 sign is compared with the one we generate, rsa sign is verified
+        with the alipay public key.
         """
-        sign_returned_by_alipay = kwargs.get('sign', None)
         sign_type = kwargs.get('sign_type', None)
         if sign_type is not None:
-            sign = self._generate_sign(sign_type, kwargs)
-            if sign == sign_returned_by_alipay:
+            with timed('alipay', VERIFY):
+                valid = verify_sign(self._signers, kwargs)
+
+            if valid:
                 notify_id = kwargs.get('notify_id')
                 return self._check_is_alipay_notify_or_not(notify_id)
             else:
@@ -130,6 +222,47 @@ class AliPayProvider(BasicProvider):
         else:
             raise MissingParameter('sign_type is missing')
 
+    def verify_many(self, payloads, workers=None, remote=False,
+        chunksize=batch.DEFAULT_CHUNKSIZE):
+        """verify the sign of many notify payloads, e.g. replay the notify
+        log after an outage
+
+        yield a batch.Verdict for every payload in order. The local sign
+        check shares the signers (and parsed keys) of the provider and a
+        process pool is used if workers is given.
+
+        notify_id is only valid for a short time on alipay side, so the remote
+        notify_verify check is off by default. Set remote to true to also
+        check the locally valid payloads (one request each).
+        """
+        verdicts = batch.verify_many(functools.partial(verify_sign, self._signers),
+            payloads, workers=workers, chunksize=chunksize)
+
+        for verdict in verdicts:
+            if remote and verdict.valid:
+                try:
+                    valid = self._check_is_alipay_notify_or_not(
+                        verdict.payload.get('notify_id'))
+                except requests.RequestException as e:
+                    verdict = verdict._replace(valid=False,
+                        error='{}: {}'.format(type(e).__name__, e))
+                else:
+                    verdict = verdict._replace(valid=valid)
+
+            yield verdict
+
+    def _sign_params(self, _params):
+        """add sign (and sign_type) to _params
+        """
+        # use the sign_type of provider if there is not a sign_type in _params
+        sign_type = _params.get('sign_type', None)
+        if sign_type is not None:
+            _params.update({'sign': self._generate_sign(sign_type, _params)})
+        else:
+            _params.update({'sign_type': self._sign_type,
+                'sign': self._generate_sign(self._sign_type, _params)})
+
+        return _params
 
     def _build_service_url(self, service, **kwargs):
         """In Alipay, service means api service. Every of them has its own gateway.
@@ -138,17 +271,57 @@ class AliPayProvider(BasicProvider):
         _params['service'] = service
         _params.update(kwargs)
 
-        # use md5 to generate sign if there is not a sign_typ in _params
-        sign_type = _params.get('sign_type', None)
-        if sign_type is not None:
-            _params.update({'sign': self._generate_sign(sign_type, _params)})
-        else:
-            _params.update({'sign_type': 'MD5', 'sign': self._generate_sign('MD5', _params)})
-
-        url = '{}?{}'.format(self._action, urlencode(_params))
+        url = '{}?{}'.format(self._action, urlencode(self._sign_params(_params)))
 
         return url
 
+    def single_trade_query(self, out_trade_no=None, trade_no=None):
+        """alipay method -- single_trade_query
+
+        return the fields of the trade as a dict (trade_status, total_fee,
+        ...). Raise TradeQueryError when alipay answers an error
+        (e.g. TRADE_NOT_EXIST) or the answer is not signed or its sign is
+        incorrect.
+        """
+        if out_trade_no is None and trade_no is None:
+            raise MissingParameter('out_trade_no or trade_no is needed')
+
+        _params = {
+            'service': 'single_trade_query',
+            'partner': self._vendor,
+            '_input_charset': 'utf-8',
+        }
+        if out_trade_no is not None:
+            _params['out_trade_no'] = out_trade_no
+        if trade_no is not None:
+            _params['trade_no'] = trade_no
+
+        _params = self._sign_params(_params)
+
+        with timed('alipay', HTTP):
+            r = self._session.get(self._action, params=_params, stream=True)
+            try:
+                r.raise_for_status()
+                answer = parse_query_response(r.iter_content(chunk_size=4096))
+            finally:
+                r.close()
+
+        if not answer.is_success:
+            raise TradeQueryError('single_trade_query of {}: {}'.format(
+                out_trade_no or trade_no, answer.error), code=answer.error)
+
+        if answer.sign is None:
+            raise TradeQueryError('single_trade_query of {} is not '
+                'signed'.format(out_trade_no or trade_no))
+
+        fields = dict(answer.fields, sign=answer.sign,
+            sign_type=answer.sign_type or self._sign_type)
+        if not verify_sign(self._signers, fields):
+            raise TradeQueryError('sign of single_trade_query of {} is '
+                'incorrect'.format(out_trade_no or trade_no))
+
+        return answer.fields
+
     def create_direct_pay_by_user_url(self, **kwargs):
         """alipay method -- direct_pay_by_user
 
@@ -14,3 +14,13 @@ class ParameterValueError(AlipayException):
 
 class TokenAuthorizationError(AlipayException):
     """The error occured when getting token"""
+
+
+class TradeQueryError(AlipayException):
+    """Raised when alipay answers a trade query with an error, e.g.
+    TRADE_NOT_EXIST, or the sign of the answer is incorrect
+    """
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
@@ -0,0 +1,70 @@
+"""parse the xml answers of alipay query services
+
+the body is fed to the parser chunk by chunk as it is read from the socket,
+the whole document is never kept. Elements are dropped once they are read.
+
+    <alipay>
+        <is_success>T</is_success>
+        <request>...</request>
+        <response>
+            <trade>
+                <out_trade_no>T20160101000002</out_trade_no>
+                <trade_status>TRADE_SUCCESS</trade_status>
+                ...
+            </trade>
+        </response>
+        <sign>...</sign>
+        <sign_type>MD5</sign_type>
+    </alipay>
+
+    <alipay><is_success>F</is_success><error>TRADE_NOT_EXIST</error></alipay>
+"""
+import collections
+from xml.etree.ElementTree import XMLPullParser
+
+
+QueryResponse = collections.namedtuple('QueryResponse',
+    ['is_success', 'error', 'fields', 'sign', 'sign_type'])
+
+
+def parse_query_response(chunks, item_tag='trade'):
+    """parse a query answer from an iterable of bytes chunks
+
+    fields is a dict of the children of item_tag (the signed part of the
+    answer), nested elements are skipped.
+    """
+    parser = XMLPullParser(events=('start', 'end'))
+    top = {}
+    fields = {}
+    path = []
+
+    def read_events():
+        for event, element in parser.read_events():
+            if event == 'start':
+                path.append(element.tag)
+                continue
+
+            path.pop()
+            parent = path[-1] if path else None
+
+            if parent == item_tag and len(element) == 0:
+                fields[element.tag] = element.text or ''
+            elif parent == 'alipay' and element.tag != 'response':
+                top[element.tag] = element.text or ''
+
+            element.clear()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        read_events()
+
+    parser.close()
+    read_events()
+
+    return QueryResponse(
+        top.get('is_success', '') == 'T',
+        top.get('error', None),
+        fields,
+        top.get('sign', None),
+        top.get('sign_type', None),
+    )
@@ -0,0 +1,166 @@
+import base64
+import binascii
+import functools
+import hashlib
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:  # pragma: no cover
+    serialization = None
+
+
+EXCLUDED_KEYS = ('sign', 'sign_type')
+
+
+def encode_param(param):
+    """encode the param before use md5 or RSA algorithm.
+
+    sort by key, skip sign, sign_type and empty values, then join them
+    with & (no url encoding)
+
+    ref: https://b.alipay.com/order/techService.htm?src=nsf05/
+    """
+    return '&'.join(['{}={}'.format(key, param[key]) for key in sorted(param)
+        if key not in EXCLUDED_KEYS and param[key] != ''])
+
+
+class MD5Signer(object):
+
+    """md5 sign of alipay, md5(encoded param + secret key)
+
+    the secret key is encoded once when the signer is created, use
+    get_md5_signer to share one signer per key.
+    """
+
+    __slots__ = ('_key', )
+
+    sign_type = 'MD5'
+
+    def __init__(self, secret_key):
+        self._key = secret_key.encode('utf-8')
+
+    def sign(self, param):
+        return hashlib.md5(encode_param(param).encode('utf-8') + self._key).hexdigest()
+
+    def verify(self, param, sign):
+        return sign == self.sign(param)
+
+
+@functools.lru_cache(maxsize=32)
+def get_md5_signer(secret_key):
+    """return the shared md5 signer of a secret key
+    """
+    return MD5Signer(secret_key)
+
+
+def _load_key(key, private):
+    """load a PEM key, or the base64 body of it without the BEGIN/END
+    lines (the way alipay shows keys)
+    """
+    if isinstance(key, str):
+        key = key.strip().encode('ascii')
+
+    if key.startswith(b'-----BEGIN'):
+        if private:
+            return serialization.load_pem_private_key(key, None, default_backend())
+        return serialization.load_pem_public_key(key, default_backend())
+
+    der = base64.b64decode(b''.join(key.split()))
+    if private:
+        return serialization.load_der_private_key(der, None, default_backend())
+    return serialization.load_der_public_key(der, default_backend())
+
+
+class RSASigner(object):
+
+    """rsa sign of alipay
+
+    sign_type RSA is SHA1withRSA and RSA2 is SHA256withRSA, both PKCS#1 v1.5
+    and base64 encoded. Requests are signed with our private key and
+    notifies are verified with the alipay public key, a signer can have
+    either or both of them.
+
+    keys are parsed once when the signer is created, use get_rsa_signer to
+    share one signer per key pair. A signer is pickled as its key text, so
+    it can be sent to batch worker processes.
+    """
+
+    __slots__ = ('sign_type', '_private_key_text', '_public_key_text',
+        '_private_key', '_public_key', '_hash')
+
+    def __init__(self, sign_type='RSA', private_key=None, public_key=None):
+        if serialization is None:
+            raise ImportError('cryptography is required for RSA sign')
+
+        self.sign_type = sign_type.upper()
+        if self.sign_type not in ('RSA', 'RSA2'):
+            raise ValueError('sign_type must be RSA or RSA2')
+
+        self._hash = hashes.SHA256 if self.sign_type == 'RSA2' else hashes.SHA1
+
+        self._private_key_text = private_key
+        self._public_key_text = public_key
+        self._private_key = _load_key(private_key, True) if private_key else None
+        self._public_key = _load_key(public_key, False) if public_key else None
+
+    def __reduce__(self):
+        return (get_rsa_signer, (self.sign_type, self._private_key_text,
+            self._public_key_text))
+
+    def sign(self, param):
+        if self._private_key is None:
+            raise ValueError('private key is needed to sign')
+
+        data = encode_param(param).encode('utf-8')
+        signature = self._private_key.sign(data, padding.PKCS1v15(), self._hash())
+        return base64.b64encode(signature).decode('ascii')
+
+    def verify(self, param, sign):
+        if self._public_key is None:
+            raise ValueError('alipay public key is needed to verify')
+
+        if not sign:
+            return False
+
+        try:
+            signature = base64.b64decode(sign)
+        except (binascii.Error, ValueError):
+            return False
+
+        data = encode_param(param).encode('utf-8')
+        try:
+            self._public_key.verify(signature, data, padding.PKCS1v15(), self._hash())
+        except InvalidSignature:
+            return False
+
+        return True
+
+
+@functools.lru_cache(maxsize=32)
+def get_rsa_signer(sign_type, private_key=None, public_key=None):
+    """return the shared rsa signer of a sign_type and key pair
+    """
+    return RSASigner(sign_type, private_key=private_key, public_key=public_key)
+
+
+def verify_sign(signers, param):
+    """local check of the sign of a notify
+
+    signers is a dict of sign_type to signer. Raise ValueError if sign_type
+    is missing or not supported.
+    """
+    sign_type = param.get('sign_type', None)
+
+    if sign_type is None:
+        raise ValueError('sign_type is missing')
+
+    signer = signers.get(sign_type.upper(), None)
+
+    if signer is None:
+        raise ValueError('sign_type {} is not supported'.format(sign_type))
+
+    return signer.verify(param, param.get('sign', None))
@@ -1,9 +1,11 @@
 import binascii
 import collections
 import json
-import hashlib
 import copy
+import time
+from types import MappingProxyType
 from urllib.parse import quote_plus, urlencode
+from urllib.parse import parse_qsl
 
 from django.core.exceptions import ImproperlyConfigured
 from django.shortcuts import redirect
@@ -11,10 +13,22 @@ from django.core.urlresolvers import reverse
 from django.utils.translation import pgettext_lazy
 
 from payments import BasicProvider
-import requests
-
-from cnpayments.allpay.forms import AllPayForm
 
+from .forms import AllPayForm
+from .. import batch
+from ..checkout import get_checkout_snapshot
+from ..formcache import payment_form_cache
+from ..instrumentation import HTTP
+from ..instrumentation import SIGN
+from ..instrumentation import VERIFY
+from ..instrumentation import timed
+from ..concurrency import RateLimiter
+from ..concurrency import map_concurrently
+from ..sessions import get_session
+from ..sessions import pop_session_options
+from .signer import get_signer
+
+from .exceptions import CheckMacValueError
 from .exceptions import MissingParameter
 from .exceptions import ParameterValueError
 
@@ -39,24 +53,40 @@ class AllPayProvider(BasicProvider):
     Instantiate BasicProvider with no params are special usage. Normally, this are
     for accessing some util method.
 
+    query_trade_info and query_many use QueryURL (query_endpoint), calls are
+    limited to query_rate per second for the whole process.
+
+    the signed form data of a payment is cached for form_cache_ttl seconds
+    (until the payment is saved), see formcache.
+
     """
 
     _action = "http://payment-stage.allpay.com.tw/Cashier/AioCheckOut"
+    _query_action = "http://payment-stage.allpay.com.tw/Cashier/QueryTradeInfo"
 
-    def __init__(self, MerchantID=None, HashKey=None, HashIV=None, endpoint=_action, **kwargs):
+    def __init__(self, MerchantID=None, HashKey=None, HashIV=None, endpoint=_action,
+        query_endpoint=_query_action, query_rate=10, form_cache_ttl=30 * 60,
+        **kwargs):
         self._MerchantID = MerchantID
         self._HashKey = HashKey
         self._HashIV = HashIV
         self._action = endpoint
+        self._query_action = query_endpoint
+        self._query_limiter = RateLimiter(query_rate, burst=query_rate)
+        self._form_cache_ttl = form_cache_ttl
 
-        self._core_params = {
+        # providers are shared by requests, it's read only
+        self._core_params = MappingProxyType({
             'MerchantID': self._MerchantID,
             'PaymentType': 'aio',
             'ReturnURL': '',  # payment result notify
             'OrderResultURL': ''  # redirect to this url after pay complete..
-        }
+        })
 
-        # ReturnURL and OrderResultURL should be update in process_data
+        # ReturnURL and OrderResultURL are given by process_data per request
+
+        self._signer = get_signer(self._HashKey, self._HashIV)
+        self._session = get_session('allpay', **pop_session_options(kwargs))
 
         super().__init__(kwargs.get('capture', True))  # Basic only accept a capture keyword arguement
 
@@ -65,6 +95,11 @@ class AllPayProvider(BasicProvider):
                 pgettext_lazy('allpay does not support pre-authorization')
             )
 
+    def get_breaker(self):
+        """the circuit breaker of the gateway, None if it's turned off
+        """
+        return self._session.breaker
+
     def _check_params(self, params, requirements):
         """check params which are needed by allpay
         """
@@ -73,15 +108,18 @@ class AllPayProvider(BasicProvider):
 
     def _generate_md5_check_value(self, params):
         """generate mac check value with md5
+
+        the signer gives the same result as md5 of _encode_param without
+        copying params and building the whole string
         """
-        hash_code = self._encode_param(params)
-        # ok.. in python3 string must be encode before hash
-        result = hashlib.md5(hash_code.encode('utf-8')).hexdigest().upper()
-        return result
+        with timed('allpay', SIGN):
+            return self._signer.sign(params)
 
     def _encode_param(self, params):
         """encoding param to a string
 
+        it's kept as the reference implementation of signer.CheckMacValueSigner
+
         sort the param -- dict
         split then with = and connect them with &
         prefix HashKey
@@ -117,12 +155,60 @@ class AllPayProvider(BasicProvider):
         checkMacValue = kwargs.get('CheckMacValue', None)
 
         if checkMacValue is not None:
-            value = self._generate_md5_check_value(kwargs)
+            with timed('allpay', VERIFY):
+                value = self._signer.sign(kwargs)
             return checkMacValue == value
 
         else:
             raise MissingParameter('CheckMacValue')
 
+    def verify_many(self, payloads, workers=None, chunksize=batch.DEFAULT_CHUNKSIZE):
+        """verify the CheckMacValue of many notify payloads, e.g. replay
+        the notify log after an outage
+
+        yield a batch.Verdict for every payload in order, a payload without
+        CheckMacValue is just not valid. All payloads share the signer of
+        this merchant and a process pool is used if workers is given.
+        """
+        return batch.verify_many(self._signer.verify, payloads,
+            workers=workers, chunksize=chunksize)
+
+    def query_trade_info(self, MerchantTradeNo):
+        """allpay QueryTradeInfo, return the trade info as a dict
+
+        TradeStatus 1 means paid, 0 means not paid yet. The response must be
+        signed, CheckMacValueError is raised if its CheckMacValue is missing
+        or wrong.
+        """
+        params = {
+            'MerchantID': self._MerchantID,
+            'MerchantTradeNo': MerchantTradeNo,
+            'TimeStamp': int(time.time()),
+        }
+        params['CheckMacValue'] = self._signer.sign(params)
+
+        self._query_limiter.acquire()
+        with timed('allpay', HTTP):
+            r = self._session.post(self._query_action, data=params)
+        r.raise_for_status()
+
+        result = dict(parse_qsl(r.text, keep_blank_values=True))
+
+        if not self._signer.verify(result):
+            raise CheckMacValueError('QueryTradeInfo of {}'.format(MerchantTradeNo))
+
+        return result
+
+    def query_many(self, MerchantTradeNos, workers=4):
+        """query many trades concurrently with a pool of workers threads
+
+        yield a concurrency.Outcome(MerchantTradeNo, trade info, error) per
+        trade in completion order. Calls share the pooled session and the
+        rate limit of the provider.
+        """
+        return map_concurrently(self.query_trade_info, MerchantTradeNos,
+            workers=workers)
+
     def create_cvs(self, **kwargs):
         """you can set StoreExpireDate if you want to set an expire time
         """
@@ -203,11 +289,12 @@ class AllPayProvider(BasicProvider):
         receive request data to generate form to post to allpay
 
         param: payment is Payment model
-        waiting to input - means already choose pay method
+        waiting to input - means already choose pay method, an input payment
+        gets its form again (reload of direct_to_pay)
         """
         if payment.status == 'waiting':
             payment.change_status('input')
-        else:
+        elif payment.status != 'input':
             return None
 
         form = AllPayForm(data=data, provider=self, payment=payment)
@@ -231,33 +318,28 @@ class AllPayProvider(BasicProvider):
     def process_data(self, payment, request, **kwargs):
         """confirm the payment, set the status and return the form
         """
-        # get datas needed from the payment
-        self._core_params.update({
-            'ReturnURL': self.get_asynchro_notify_url(request),
-            'OrderResultURL': self.get_synchro_notify_url(request)
-        })
+        data = payment_form_cache.get(payment)
+        if data is not None:
+            return self.get_form(data=data, payment=payment)
 
-        # use payment's get_purchased_items type python named tuple..
-        # name, quantity, price, currency, sku
+        # items, totals and buyer are read once per payment, see checkout.py
         # note...... allpay's price need to be integer
-        items = payment.get_purchased_items()
-
-        AlipayItemName = '#'.join([item.name for item in items])
-        AlipayItemCounts = '#'.join([str(item.quantity) for item in items])
-        AlipayItemPrice = '#'.join([str(int(item.price)) for item in items])
+        snapshot = get_checkout_snapshot(payment)
 
         params = {
+            'ReturnURL': self.get_asynchro_notify_url(request),
+            'OrderResultURL': self.get_synchro_notify_url(request),
             'MerchantTradeNo': payment.tradeNo,
             'MerchantTradeDate': payment.generateTradeDate().strftime('%Y/%m/%d %H:%M:%S'),
-            'TotalAmount': int(payment.get_total_price().gross),
+            'TotalAmount': snapshot.total,
             'TradeDesc': 'lbstek',
-            'ItemName': AlipayItemName,
-            'AlipayItemName': AlipayItemName,
-            'AlipayItemCounts': AlipayItemCounts,
-            'AlipayItemPrice': AlipayItemPrice,
-            'Email': payment.order.get_user_email(),
-            'PhoneNo': payment.order.user.phone_number,
-            'UserName': payment.billing_full_name(),
+            'ItemName': snapshot.item_names,
+            'AlipayItemName': snapshot.item_names,
+            'AlipayItemCounts': snapshot.item_counts,
+            'AlipayItemPrice': snapshot.item_prices,
+            'Email': snapshot.email,
+            'PhoneNo': snapshot.phone_number,
+            'UserName': snapshot.full_name,
         }
 
         if request.user_agent.is_mobile:
@@ -266,5 +348,8 @@ class AllPayProvider(BasicProvider):
             data = self.create_alipay(**params)
 
         form = self.get_form(data=data, payment=payment)
+        # after get_form, saving the payment there drops the cached data
+        if form is not None:
+            payment_form_cache.set(payment, data, self._form_cache_ttl)
 
         return form
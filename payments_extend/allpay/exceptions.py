@@ -10,3 +10,7 @@ class MissingParameter(AllPayException):
 
 class ParameterValueError(AllPayException):
     """Raised when paramter value is incorrect"""
+
+
+class CheckMacValueError(AllPayException):
+    """Raised when CheckMacValue of allpay response is incorrect"""
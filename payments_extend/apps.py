@@ -0,0 +1,28 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_save
+
+
+class PaymentsExtendConfig(AppConfig):
+
+    # installed as payments_extend or under another name (e.g. cnpayments)
+    name = __name__.rpartition('.')[0]
+    verbose_name = 'payments extend'
+
+    def ready(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from payments import get_payment_model
+
+        from .formcache import invalidate_payment_form
+        from .instrumentation import configure_from_settings
+
+        try:
+            payment_model = get_payment_model()
+        except ImproperlyConfigured:
+            # no PAYMENT_MODEL, e.g. the standalone benchmarks
+            payment_model = None
+
+        if payment_model is not None:
+            post_save.connect(invalidate_payment_form, sender=payment_model,
+                dispatch_uid='payments_extend.invalidate_payment_form')
+
+        configure_from_settings()
@@ -0,0 +1,211 @@
+"""archive old CashFlowLog rows into gzip json lines files
+
+rows are partitioned by the (UTC) day of created_at, every batch writes
+one part file per day named by its first id
+
+    <CASHFLOW_LOG_ARCHIVE_DIR>/cashflowlog-2016-01-01.1234.jsonl.gz
+
+a part is written to a temporary file, synced and renamed into place, and
+the batch is only deleted from the table after that, so a crash leaves a
+row in the table or in a complete part (or both), never in neither. A
+crash never touches the parts written before. iter_archived_logs drops the
+duplicates that may give, and skips what it can't read of a damaged file
+(e.g. the appended day files of older versions) instead of failing.
+
+    python manage.py archive_cashflowlogs --days 90
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import CashFlowLog
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+FILE_PREFIX = 'cashflowlog-'
+FILE_SUFFIX = '.jsonl.gz'
+
+ARCHIVE_FIELDS = ('id', 'created_at', 'source_device', 'source_ip',
+    'provider', 'trade_no', 'payment_token', 'result_code', 'amount',
+    'json_res')
+
+
+def get_archive_dir():
+    return getattr(settings, 'CASHFLOW_LOG_ARCHIVE_DIR',
+        os.path.join(getattr(settings, 'BASE_DIR', os.getcwd()),
+            'cashflowlog_archive'))
+
+
+def _utc_day(value):
+    if timezone.is_aware(value):
+        value = value.astimezone(datetime.timezone.utc)
+    return value.date()
+
+
+def _archive_path(archive_dir, day, first_id):
+    return os.path.join(archive_dir, '{}{}.{}{}'.format(
+        FILE_PREFIX, day.isoformat(), first_id, FILE_SUFFIX))
+
+
+def _write_part(path, lines):
+    """write a complete part file or none, a part of the same name (the
+    same rows, archived again after a crash) is replaced
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.{}.tmp'.format(name))
+
+    try:
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(lines.encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # the rename must be on disk before the rows are deleted
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _serialize(row):
+    row = dict(row)
+    row['created_at'] = row['created_at'].isoformat()
+    if row['amount'] is not None:
+        row['amount'] = str(row['amount'])
+    return json.dumps(row, ensure_ascii=False)
+
+
+def archive_logs(before, archive_dir=None, batch_size=DEFAULT_BATCH_SIZE):
+    """move the logs created before the given datetime to the archive
+
+    return the number of archived rows
+    """
+    archive_dir = archive_dir or get_archive_dir()
+    os.makedirs(archive_dir, exist_ok=True)
+
+    queryset = CashFlowLog.objects.filter(created_at__lt=before)
+    archived = 0
+
+    while True:
+        rows = list(queryset.order_by('created_at', 'pk')
+            .values(*ARCHIVE_FIELDS)[:batch_size])
+        if not rows:
+            break
+
+        days = {}
+        for row in rows:
+            days.setdefault(_utc_day(row['created_at']), []).append(row)
+
+        for day, day_rows in days.items():
+            lines = ''.join(_serialize(row) + '\n' for row in day_rows)
+            _write_part(_archive_path(archive_dir, day, day_rows[0]['id']),
+                lines)
+
+        with transaction.atomic():
+            CashFlowLog.objects.filter(
+                pk__in=[row['id'] for row in rows]).delete()
+
+        archived += len(rows)
+
+    return archived
+
+
+def archive_logs_older_than(days, archive_dir=None,
+    batch_size=DEFAULT_BATCH_SIZE):
+    """move the logs older than days to the archive
+    """
+    before = timezone.now() - datetime.timedelta(days=days)
+    return archive_logs(before, archive_dir=archive_dir, batch_size=batch_size)
+
+
+def iter_archive_days(archive_dir=None):
+    """yield (day, path) of the archive files sorted by day, the parts of a
+    day by their first id
+    """
+    archive_dir = archive_dir or get_archive_dir()
+    if not os.path.isdir(archive_dir):
+        return
+
+    files = []
+    for name in os.listdir(archive_dir):
+        if not (name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX)):
+            continue
+
+        # cashflowlog-<day>.<first id>.jsonl.gz, or cashflowlog-<day>.jsonl.gz
+        # of older versions
+        day, _, first_id = name[len(FILE_PREFIX):-len(FILE_SUFFIX)].partition(
+            '.')
+        try:
+            day = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+            first_id = int(first_id) if first_id else 0
+        except ValueError:
+            continue
+
+        files.append((day, first_id, name))
+
+    for day, _first_id, name in sorted(files):
+        yield day, os.path.join(archive_dir, name)
+
+
+def _iter_lines(path):
+    """the lines of a gzip file up to where it's damaged
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield line
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError):
+        logger.warning('cash flow log archive %s is damaged, skipping the rest '
+            'of it', path, exc_info=True)
+
+
+def iter_archived_logs(start=None, end=None, archive_dir=None, trade_no=None):
+    """stream archived logs back as dicts, for audits
+
+    start and end are dates (inclusive) of the files to read. Only one line
+    is in memory at a time (plus the ids seen of the current day).
+    """
+    seen_day = seen = None
+
+    for day, path in iter_archive_days(archive_dir):
+        if start is not None and day < start:
+            continue
+        if end is not None and day > end:
+            break
+
+        if day != seen_day:
+            seen_day, seen = day, set()
+
+        for line in _iter_lines(path):
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash
+                logger.warning('skipping a damaged line of %s', path)
+                continue
+
+            if row['id'] in seen:
+                continue
+            seen.add(row['id'])
+
+            if trade_no is not None and row['trade_no'] != trade_no:
+                continue
+
+            yield row
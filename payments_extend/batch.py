@@ -0,0 +1,65 @@
+"""verify notify payloads in batch, e.g. replay a notify backlog
+
+    for verdict in provider.verify_many(payloads, workers=4):
+        if not verdict.valid:
+            print(verdict.payload, verdict.error)
+
+results are streamed in the order of payloads. A bad payload never stops
+the batch, it just gets a verdict with valid False (and the error if the
+check raised).
+"""
+import collections
+import functools
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+
+DEFAULT_CHUNKSIZE = 256
+
+Verdict = collections.namedtuple('Verdict', ['payload', 'valid', 'error'])
+
+
+def _verdict(verify, payload):
+    try:
+        return Verdict(payload, bool(verify(payload)), None)
+    except Exception as e:
+        return Verdict(payload, False, '{}: {}'.format(type(e).__name__, e))
+
+
+def _init_worker():
+    """providers import django models, so set django up in spawned workers
+    """
+    import django
+    from django.core.exceptions import ImproperlyConfigured
+
+    try:
+        django.setup()
+    except ImproperlyConfigured:
+        pass
+
+
+def verify_many(verify, payloads, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    """yield a Verdict for every payload
+
+    verify is a callable which takes a payload and return true or false. It
+    must be picklable when workers is given, then payloads are checked by a
+    process pool of that size. Only workers * chunksize * 2 payloads are
+    taken from the iterable at a time, so a huge backlog can be streamed.
+    """
+    check = functools.partial(_verdict, verify)
+
+    if not workers or workers <= 1:
+        for payload in payloads:
+            yield check(payload)
+        return
+
+    window = workers * chunksize * 2
+    payloads = iter(payloads)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        while True:
+            chunk = list(itertools.islice(payloads, window))
+            if not chunk:
+                break
+
+            yield from executor.map(check, chunk, chunksize=chunksize)
@@ -0,0 +1,500 @@
+"""benchmark suite of the hot paths of the providers
+
+form building per provider and cart size, notify verification with real
+payloads, and verify_and_log: the verification and the cash flow log write
+a notify view starts with (remote verify against a local stub gateway, log
+written to SQLite). The rest of a notify view (dedup check, payment lookup
+and lock, status change) works on the payment model of the host project,
+it's not benchmarked here. Run it inside a configured django project, or
+alone (an in-memory SQLite project is configured)
+
+    python -m payments_extend.benchmarks --json results.json
+    python -m payments_extend.benchmarks --baseline results.json --threshold 0.1
+    python -m payments_extend.benchmarks -k 'allpay.*'
+
+results are json, per benchmark the median and min seconds per call. With
+--baseline, a benchmark whose min is more than threshold slower than the
+baseline one is a regression and the exit status is 1.
+"""
+import argparse
+import collections
+import datetime
+import fnmatch
+import functools
+import hashlib
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import timeit
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+from .testdata import ALLPAY_TEST_MERCHANT
+from .testdata import CHECK_MAC_VALUE_VECTORS
+
+
+# a typical trade_status_sync notify of alipay
+ALIPAY_NOTIFY = {
+    'notify_time': '2016-01-01 12:05:00',
+    'notify_type': 'trade_status_sync',
+    'notify_id': 'RqPnCoPT3K9%2Fvwbh3InWfjSqVn2GkbK%2BfR%2Btn1ZJ4G',
+    'out_trade_no': 'T20160101000002',
+    'subject': 'lbstek order',
+    'payment_type': '1',
+    'trade_no': '2016010121001004390200012345',
+    'trade_status': 'TRADE_SUCCESS',
+    'seller_id': '2088101122136241',
+    'seller_email': 'seller@example.com',
+    'buyer_id': '2088102122524333',
+    'buyer_email': 'buyer@example.com',
+    'total_fee': '10.50',
+    'quantity': '1',
+    'price': '10.50',
+    'gmt_create': '2016-01-01 12:00:00',
+    'gmt_payment': '2016-01-01 12:05:00',
+    'is_total_fee_adjust': 'N',
+    'use_coupon': 'N',
+}
+
+ALIPAY_MD5_KEY = '0123456789abcdef0123456789abcdef'
+
+
+# GetExpressCheckoutDetails response with 20 line items
+PAYPAL_DETAILS_RESPONSE = '&'.join(
+    ['TOKEN=EC%2d4P809628KK1823013', 'ACK=Success', 'VERSION=124',
+     'CORRELATIONID=3b2d1f5c8e4a', 'PAYERID=MBKAY3Q6GMASN',
+     'PAYMENTREQUEST_0_AMT=200.00', 'PAYMENTREQUEST_0_CURRENCYCODE=TWD'] +
+    ['L_PAYMENTREQUEST_0_{}{}={}'.format(name, index, value)
+        for index in range(20)
+        for name, value in (('NAME', 'Item+%23{}'.format(index)),
+            ('QTY', '1'), ('AMT', '10.00'))])
+
+
+CART_SIZES = (1, 10, 50)
+
+
+class BenchmarkError(Exception):
+    """a benchmark setup doesn't give the expected result"""
+
+
+def check(condition, message=None):
+    """like assert, but still checked under python -O
+    """
+    if not condition:
+        raise BenchmarkError(message)
+
+# name -> setup, a setup checks what it benchmarks and returns the callable
+# to time
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, *args):
+    """register setup (called with args) as benchmark name
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = functools.partial(setup, *args) if args else setup
+        return setup
+    return decorator
+
+
+def make_cart(size):
+    """(name, quantity, price) of size purchased items
+    """
+    return [('商品{} (限量)#{}'.format(index, index), index % 3 + 1,
+        100 + index) for index in range(size)]
+
+
+def _allpay_provider():
+    from .allpay import AllPayProvider
+    return AllPayProvider(**ALLPAY_TEST_MERCHANT)
+
+
+def setup_allpay_check_mac_value_encode_param(index):
+    """the old path, md5 of _encode_param, kept as the reference
+    """
+    provider = _allpay_provider()
+    params, expected = CHECK_MAC_VALUE_VECTORS[index]
+
+    def check_value():
+        hash_code = provider._encode_param(params)
+        return hashlib.md5(hash_code.encode('utf-8')).hexdigest().upper()
+
+    check(check_value() == expected, index)
+    return check_value
+
+
+def setup_allpay_check_mac_value_signer(index):
+    provider = _allpay_provider()
+    params, expected = CHECK_MAC_VALUE_VECTORS[index]
+
+    check(provider._signer.sign(params) == expected, index)
+    return functools.partial(provider._signer.sign, params)
+
+
+def setup_allpay_form(size):
+    """the fields process_data builds for a cart of size items
+    """
+    provider = _allpay_provider()
+    cart = make_cart(size)
+
+    params = dict(CHECK_MAC_VALUE_VECTORS[1][0])
+    del params['ChoosePayment']
+    params.update({
+        'TotalAmount': sum(quantity * price for _, quantity, price in cart),
+        'ItemName': '#'.join(name for name, _, _ in cart),
+        'AlipayItemName': '#'.join(name for name, _, _ in cart),
+        'AlipayItemCounts': '#'.join(str(quantity) for _, quantity, _ in cart),
+        'AlipayItemPrice': '#'.join(str(price) for _, _, price in cart),
+    })
+
+    fields = provider.create_alipay(**params)
+    check(provider._signer.verify(fields))
+    return functools.partial(provider.create_alipay, **params)
+
+
+def _alipay_provider(sign_type='MD5', **kwargs):
+    from .alipay import AliPayProvider
+    return AliPayProvider(vendor='2088101122136241', app_id='2088101122136241',
+        secret_key=ALIPAY_MD5_KEY, sign_type=sign_type, **kwargs)
+
+
+def setup_alipay_service_url(size):
+    """create_direct_pay_by_user url, the body lists size items
+    """
+    provider = _alipay_provider()
+    cart = make_cart(size)
+
+    params = {
+        'out_trade_no': 'T20160101000002',
+        'subject': 'lbstek order',
+        'body': ', '.join('{} x{}'.format(name, quantity)
+            for name, quantity, _ in cart),
+        'total_fee': '{:.2f}'.format(
+            sum(quantity * price for _, quantity, price in cart)),
+        'notify_url': 'http://example.com/alipay_asynchro_notify',
+        'return_url': 'http://example.com/alipay_synchro_notify',
+    }
+
+    check(provider.create_direct_pay_by_user_url(**params).startswith(
+        provider._action))
+    return functools.partial(provider.create_direct_pay_by_user_url, **params)
+
+
+def setup_paypal_express_body(size):
+    """SetExpressCheckout body with size line items
+    """
+    from .paypal import PayPalExpressCheckoutProvider
+
+    provider = PayPalExpressCheckoutProvider('user', 'pwd', 'signature')
+    cart = make_cart(size)
+
+    params = {
+        'PAYMENTREQUEST_0_AMT': sum(quantity * price
+            for _, quantity, price in cart),
+        'PAYMENTREQUEST_0_PAYMENTACTION': 'Sale',
+        'RETURNURL': 'http://example.com/paypal_synchro_notify/token/',
+        'CANCELURL': 'http://example.com/',
+        'REQCONFIRMSHIPPING': '0',
+        'NOSHIPPING': '1',
+        'ADDROVERRIDE': '0',
+    }
+    for index, (name, quantity, price) in enumerate(cart):
+        params['L_PAYMENTREQUEST_0_NAME{}'.format(index)] = name
+        params['L_PAYMENTREQUEST_0_QTY{}'.format(index)] = quantity
+        params['L_PAYMENTREQUEST_0_AMT{}'.format(index)] = price
+
+    check(b'METHOD=SetExpressCheckout' in provider.setExpressCheckout(**params))
+    return functools.partial(provider.setExpressCheckout, **params)
+
+
+def setup_paypal_nvp_response():
+    """parse a GetExpressCheckoutDetails answer and read ACK and TOKEN like
+    the checkout flow does
+    """
+    from .paypal.nvp import NVPResponse
+
+    def read():
+        res = NVPResponse(PAYPAL_DETAILS_RESPONSE)
+        return res['ACK'], res['TOKEN']
+
+    check(read() == ('Success', 'EC-4P809628KK1823013'))
+    return read
+
+
+def setup_allpay_verify_notify():
+    provider = _allpay_provider()
+    notify = dict(CHECK_MAC_VALUE_VECTORS[2][0],
+        CheckMacValue=CHECK_MAC_VALUE_VECTORS[2][1])
+
+    check(provider.verify_macValue(**notify))
+    return functools.partial(provider.verify_macValue, **notify)
+
+
+def _rsa_key_pair():
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    private_pem = key.private_bytes(serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    public_pem = key.public_key().public_bytes(serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    return private_pem, public_pem
+
+
+def setup_alipay_verify_sign(sign_type):
+    """local sign check of a notify, a throwaway key pair for RSA and RSA2
+    """
+    from .alipay.signer import verify_sign
+
+    kwargs = {}
+    if sign_type != 'MD5':
+        private_pem, public_pem = _rsa_key_pair()
+        kwargs = {'private_key': private_pem, 'alipay_public_key': public_pem}
+
+    provider = _alipay_provider(sign_type, **kwargs)
+
+    notify = dict(ALIPAY_NOTIFY, sign_type=sign_type)
+    notify['sign'] = provider._generate_sign(sign_type, notify)
+
+    check(verify_sign(provider._signers, notify))
+    return functools.partial(verify_sign, provider._signers, notify)
+
+
+class _StubGatewayHandler(BaseHTTPRequestHandler):
+
+    """answers notify_verify of alipay with true
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'true'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_gateway():
+    """start the stub gateway in a daemon thread, return its url
+    """
+    server = HTTPServer(('127.0.0.1', 0), _StubGatewayHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return 'http://127.0.0.1:{}/gateway.do'.format(server.server_port)
+
+
+def setup_alipay_verify_and_log():
+    """the verification of a new notify, local and remote (notify_verify
+    against the stub gateway), and its cash flow log written
+    """
+    from .cashflow import CashFlowLogBuffer
+
+    provider = _alipay_provider(endpoint=start_stub_gateway())
+    buffer = CashFlowLogBuffer(write_behind=False)
+    notify_ids = itertools.count()
+
+    def notify():
+        # a new notify_id, the verdict cache must not answer
+        data = dict(ALIPAY_NOTIFY, sign_type='MD5',
+            notify_id='bench{}'.format(next(notify_ids)))
+        data['sign'] = provider._generate_sign('MD5', data)
+
+        check(provider.verify_notify(**data))
+        return buffer.add(data, source_device='bench', source_ip='127.0.0.1',
+            provider='alipay')
+
+    check(notify().pk is not None)
+    return notify
+
+
+def setup_allpay_verify_and_log():
+    """the verification of a notify and its cash flow log written
+    """
+    from .cashflow import CashFlowLogBuffer
+
+    provider = _allpay_provider()
+    buffer = CashFlowLogBuffer(write_behind=False)
+    data = dict(CHECK_MAC_VALUE_VECTORS[2][0],
+        CheckMacValue=CHECK_MAC_VALUE_VECTORS[2][1])
+
+    def notify():
+        check(provider.verify_macValue(**data))
+        return buffer.add(data, source_device='bench', source_ip='127.0.0.1',
+            provider='allpay')
+
+    check(notify().pk is not None)
+    return notify
+
+
+for _index in range(len(CHECK_MAC_VALUE_VECTORS)):
+    benchmark('allpay.check_mac_value.encode_param.{}'.format(_index),
+        _index)(setup_allpay_check_mac_value_encode_param)
+    benchmark('allpay.check_mac_value.signer.{}'.format(_index),
+        _index)(setup_allpay_check_mac_value_signer)
+
+for _size in CART_SIZES:
+    benchmark('allpay.form.{}'.format(_size), _size)(setup_allpay_form)
+    benchmark('alipay.service_url.{}'.format(_size), _size)(
+        setup_alipay_service_url)
+    benchmark('paypal.express_body.{}'.format(_size), _size)(
+        setup_paypal_express_body)
+
+benchmark('paypal.nvp_response')(setup_paypal_nvp_response)
+benchmark('allpay.verify_notify')(setup_allpay_verify_notify)
+
+for _sign_type in ('MD5', 'RSA', 'RSA2'):
+    benchmark('alipay.verify_notify.{}'.format(_sign_type.lower()),
+        _sign_type)(setup_alipay_verify_sign)
+
+benchmark('alipay.verify_and_log')(setup_alipay_verify_and_log)
+benchmark('allpay.verify_and_log')(setup_allpay_verify_and_log)
+
+
+def run(patterns=None, repeat=5):
+    """run the benchmarks whose name matches one of patterns (all if None)
+
+    every benchmark is called in loops of at least 0.2s, repeat times.
+    return {name: {'median': s, 'min': s, 'number': n, 'repeat': r}}
+    """
+    results = collections.OrderedDict()
+
+    for name, setup in BENCHMARKS.items():
+        if patterns and not any(fnmatch.fnmatchcase(name, pattern)
+            for pattern in patterns):
+            continue
+
+        timer = timeit.Timer(setup())
+        number, _ = timer.autorange()
+        timings = [total / number
+            for total in timer.repeat(repeat=repeat, number=number)]
+
+        results[name] = {
+            'median': statistics.median(timings),
+            'min': min(timings),
+            'number': number,
+            'repeat': repeat,
+        }
+
+    return results
+
+
+def make_report(results):
+    import django
+
+    return {
+        'version': 1,
+        'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'django': django.get_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """yield (name, baseline min, min, ratio) of the benchmarks more than
+    threshold slower than in baseline, benchmarks missing on either side
+    are skipped
+    """
+    for name, result in results.items():
+        base = baseline.get(name, None)
+        if base is None or not base['min']:
+            continue
+
+        ratio = result['min'] / base['min']
+        if ratio > 1 + threshold:
+            yield name, base['min'], result['min'], ratio
+
+
+def configure_standalone():
+    """configure a throwaway project with an in-memory SQLite database
+    """
+    from django.conf import settings
+
+    settings.configure(
+        INSTALLED_APPS=['payments_extend'],
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }},
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }},
+        CASHFLOW_LOG_WRITE_BEHIND=False,
+        USE_TZ=True,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m payments_extend.benchmarks')
+    parser.add_argument('-k', dest='patterns', action='append', default=None,
+        help='only benchmarks matching this glob, can be repeated')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', default=None,
+        help='write the results to this file, - for stdout')
+    parser.add_argument('--baseline', default=None,
+        help='results json of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='slowdown ratio over the baseline counted as a regression')
+    parser.add_argument('--list', action='store_true', default=False)
+    options = parser.parse_args(argv)
+
+    if options.list:
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+
+    import django
+    from django.core.management import call_command
+
+    standalone = 'DJANGO_SETTINGS_MODULE' not in os.environ
+    if standalone:
+        configure_standalone()
+    django.setup()
+    if standalone:
+        call_command('migrate', verbosity=0)
+
+    results = run(options.patterns, options.repeat)
+
+    report = sys.stderr if options.json == '-' else sys.stdout
+    for name, result in results.items():
+        print('{:<45} {:>12.2f}us {:>12.2f}us'.format(name,
+            result['median'] * 1e6, result['min'] * 1e6), file=report)
+
+    if options.json == '-':
+        json.dump(make_report(results), sys.stdout, indent=2)
+    elif options.json:
+        with open(options.json, 'w') as f:
+            json.dump(make_report(results), f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = list(compare(results, baseline, options.threshold))
+        for name, base, current, ratio in regressions:
+            print('REGRESSION {}: {:.2f}us -> {:.2f}us ({:+.0%})'.format(
+                name, base * 1e6, current * 1e6, ratio - 1), file=report)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
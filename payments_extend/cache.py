@@ -0,0 +1,151 @@
+"""small in-process caches used by the providers
+"""
+import collections
+import threading
+import time
+
+from django.core.cache import caches
+
+
+_missing = object()
+
+
+class TTLCache(object):
+
+    """bounded LRU cache whose entries expire after ttl seconds
+
+    it's thread-safe.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is None:
+                return default
+
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Call(object):
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    """collapse concurrent calls for the same key into one
+
+    the first caller of a key runs func, the others wait for its result (or
+    its exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class MemoCache(object):
+
+    """memoize results by key in a TTLCache, optionally backed by a django
+    cache to share them across workers. Concurrent misses of the same key
+    run func only once. Exceptions are not cached, nor the results for which
+    store (if given) returns false.
+    """
+
+    def __init__(self, key_prefix, maxsize=1024, ttl=60, cache_alias=None):
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flight = SingleFlight()
+
+    def _shared_key(self, key):
+        return '{}:{}'.format(self.key_prefix, key)
+
+    def get_or_call(self, key, func, store=None):
+        value = self._local.get(key, _missing)
+        if value is not _missing:
+            return value
+
+        return self._flight.do(key, lambda: self._load(key, func, store))
+
+    def _load(self, key, func, store=None):
+        shared = caches[self.cache_alias] if self.cache_alias else None
+
+        if shared is not None:
+            value = shared.get(self._shared_key(key), _missing)
+            if value is not _missing:
+                self._local.set(key, value)
+                return value
+
+        value = func()
+        if store is not None and not store(value):
+            return value
+
+        self._local.set(key, value)
+        if shared is not None:
+            shared.set(self._shared_key(key), value, self.ttl)
+
+        return value
@@ -0,0 +1,214 @@
+"""write-behind buffer for CashFlowLog
+
+notify views used to insert a CashFlowLog row before doing anything else.
+Now they add the log to cash_flow_log_buffer and a background thread writes
+the buffered rows with bulk_create when CASHFLOW_LOG_BUFFER_SIZE rows are
+waiting or every CASHFLOW_LOG_FLUSH_INTERVAL seconds.
+
+    log = cash_flow_log_buffer.add(data, source_device, source_ip, payment,
+        provider='allpay')
+
+if payment is given, payment.logs is set to the log after it's written.
+Before a payment status change, flush the buffer so the log is in the
+database (and has its pk) first. Flush before the payment is locked, never
+in the transaction holding the lock
+
+    cash_flow_log_buffer.flush()
+    with transaction.atomic():
+        payment = lock_payment(Payment.objects, pk=payment.pk)
+        if log.pk is not None:
+            payment.logs = log.pk
+        payment.change_status('confirmed')
+
+a log which fails to be written is logged and dropped (its pk stays None),
+it doesn't hold the other ones back.
+
+flush writes in the transaction of the caller if there's one, e.g. in a
+view with ATOMIC_REQUESTS. The logs are only in the database once that
+transaction commits, and a rollback loses them, the ones other requests
+buffered too. Call flush out of transaction.atomic (the background thread
+always does), or turn ATOMIC_REQUESTS off for the notify views with
+transaction.non_atomic_requests.
+
+set CASHFLOW_LOG_WRITE_BEHIND = False to write every log right away.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import connections
+from django.db import router
+from django.db import transaction
+
+from .instrumentation import LOG_WRITE
+from .instrumentation import timed
+from .models import CashFlowLog
+
+
+logger = logging.getLogger(__name__)
+
+SOURCE_MAX_LENGTH = CashFlowLog._meta.get_field('source_device').max_length
+
+
+class CashFlowLogBuffer(object):
+
+    """buffer CashFlowLog rows and write them in batch
+
+    payloads are serialized by json when they are written, so they should
+    not be changed after add.
+    """
+
+    def __init__(self, max_size=100, flush_interval=1.0, write_behind=True):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.write_behind = write_behind
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, data, source_device='', source_ip='', payment=None,
+        provider=''):
+        """add a log of data, return the CashFlowLog which may be unsaved
+        """
+        # a long user agent must not fail the whole batch
+        log = CashFlowLog(source_device=(source_device or '')[:SOURCE_MAX_LENGTH],
+            source_ip=(source_ip or '')[:SOURCE_MAX_LENGTH])
+        entry = (log, data, payment, provider)
+
+        if not self.write_behind:
+            self._write([entry])
+            return log
+
+        with self._lock:
+            self._pending.append(entry)
+            size = len(self._pending)
+
+        self._ensure_thread()
+
+        if size >= self.max_size:
+            self._wakeup.set()
+
+        return log
+
+    def flush(self):
+        """write all buffered logs now
+
+        a log which can't be written (even alone) is logged and dropped, its
+        pk stays None. Don't call it while payment rows are locked, the logs
+        are linked to their payments by an UPDATE of those rows. In a
+        transaction the logs are written for good when it commits, see the
+        module docstring.
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries, self._pending = self._pending, []
+
+            if entries:
+                self._write(entries)
+
+    def _write(self, entries):
+        # a batch mixes providers
+        with timed('', LOG_WRITE):
+            self._write_logs(entries)
+
+    def _write_logs(self, entries):
+        written = []
+        for entry in entries:
+            log, data, payment, provider = entry
+            try:
+                log.fill_fields(data, provider)
+            except Exception:
+                logger.exception('dropped cash flow log of %r', data)
+                continue
+
+            if not log.trade_no and payment is not None:
+                log.trade_no = getattr(payment, 'tradeNo', None) or ''
+            written.append(entry)
+
+        logs = [entry[0] for entry in written]
+        using = router.db_for_write(CashFlowLog)
+
+        try:
+            self._insert(logs, using)
+        except Exception:
+            logger.warning('failed to write %s cash flow logs in batch, '
+                'writing them one by one', len(logs), exc_info=True)
+            written = [entry for entry in written
+                if self._insert_one(entry[0], using)]
+
+        # the latest log of a payment wins, the same as setting it in view
+        links = {}
+        for log, _data, payment, _provider in written:
+            if payment is not None:
+                links[(type(payment), payment.pk)] = log.pk
+
+        # the logs are in, a failed link must not write them again
+        for (model, pk), log_pk in links.items():
+            try:
+                with transaction.atomic(using=using):
+                    model._default_manager.filter(pk=pk).update(logs=log_pk)
+            except Exception:
+                logger.exception('failed to link cash flow log %s to payment %s',
+                    log_pk, pk)
+
+    def _insert(self, logs, using):
+        features = connections[using].features
+        try:
+            with transaction.atomic(using=using):
+                if getattr(features, 'can_return_rows_from_bulk_insert', False) or \
+                    getattr(features, 'can_return_ids_from_bulk_insert', False):
+                    CashFlowLog.objects.bulk_create(logs)
+                else:
+                    # pk is needed for payment.logs
+                    for log in logs:
+                        log.save()
+        except Exception:
+            # rolled back, the logs which got a pk are not saved
+            for log in logs:
+                log.pk = None
+                log._state.adding = True
+            raise
+
+    def _insert_one(self, log, using):
+        try:
+            self._insert([log], using)
+        except Exception:
+            logger.exception('dropped cash flow log %r', log.json_res)
+            return False
+        return True
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                    name='cash-flow-log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('failed to write cash flow logs')
+            finally:
+                close_old_connections()
+
+
+cash_flow_log_buffer = CashFlowLogBuffer(
+    max_size=getattr(settings, 'CASHFLOW_LOG_BUFFER_SIZE', 100),
+    flush_interval=getattr(settings, 'CASHFLOW_LOG_FLUSH_INTERVAL', 1.0),
+    write_behind=getattr(settings, 'CASHFLOW_LOG_WRITE_BEHIND', True),
+)
+
+atexit.register(cash_flow_log_buffer.flush)
@@ -0,0 +1,82 @@
+"""what the providers need to know about a payment to start a checkout
+
+purchased items are read once and the item strings of every provider are
+built in one pass over them. They are cached by payment token, so another
+provider or a retried checkout of the same payment costs no query. Saving
+the payment (a new modified) or changing its total builds them again.
+The buyer info is taken from the payment, its order and user each time,
+load_payment joins them.
+
+    payment = lookups.load_payment(Payment.objects, token=token)
+    snapshot = get_checkout_snapshot(payment)
+    snapshot.item_names     # 'Apple#Banana'
+"""
+import collections
+
+from django.conf import settings
+
+from .cache import MemoCache
+
+
+CheckoutSnapshot = collections.namedtuple('CheckoutSnapshot',
+    ['total', 'item_names', 'item_counts', 'item_prices', 'email',
+     'phone_number', 'full_name'])
+
+checkout_snapshot_cache = MemoCache(
+    'payments_extend:checkout_snapshot',
+    maxsize=getattr(settings, 'CHECKOUT_SNAPSHOT_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'CHECKOUT_SNAPSHOT_TTL', 10 * 60),
+    cache_alias=getattr(settings, 'CHECKOUT_SNAPSHOT_CACHE', None),
+)
+
+
+CheckoutItems = collections.namedtuple('CheckoutItems',
+    ['item_names', 'item_counts', 'item_prices'])
+
+
+def build_checkout_items(payment):
+    """read the purchased items of payment and build their strings
+
+    prices are integers, allpay doesn't accept decimals
+    """
+    names = []
+    counts = []
+    prices = []
+
+    # name, quantity, price, currency, sku
+    for item in payment.get_purchased_items():
+        names.append(item.name)
+        counts.append(str(item.quantity))
+        prices.append(str(int(item.price)))
+
+    return CheckoutItems('#'.join(names), '#'.join(counts), '#'.join(prices))
+
+
+def build_checkout_snapshot(payment, items=None):
+    """the snapshot of payment, items are built if not given
+    """
+    if items is None:
+        items = build_checkout_items(payment)
+
+    order = payment.order
+
+    return CheckoutSnapshot(
+        total=int(payment.get_total_price().gross),
+        item_names=items.item_names,
+        item_counts=items.item_counts,
+        item_prices=items.item_prices,
+        email=order.get_user_email(),
+        phone_number=getattr(order.user, 'phone_number', ''),
+        full_name=payment.billing_full_name(),
+    )
+
+
+def get_checkout_snapshot(payment):
+    """the snapshot of payment with its cached items
+    """
+    # modified is set by django-payments on every save, no space for memcached
+    modified = payment.modified.timestamp() if payment.modified else ''
+    key = '{}:{}:{}'.format(payment.token, modified, payment.total)
+    items = checkout_snapshot_cache.get_or_call(
+        key, lambda: build_checkout_items(payment))
+    return build_checkout_snapshot(payment, items)
@@ -0,0 +1,209 @@
+"""circuit breakers of the gateways
+
+a breaker watches the calls to one gateway over a rolling window. When too
+many of them fail or are too slow, it opens and calls fail at once with
+GatewayUnavailable instead of tying a worker up until the timeout. After
+open_for seconds a few probe calls are let through (half open), the breaker
+closes if they succeed and opens again if they don't. A probe which ends
+without an outcome (cancelled, or an error which isn't the gateway's) is
+given back with cancel, and probes not heard of within open_for seconds
+are given up, so the breaker can't stay half open.
+
+sessions.get_session puts the breaker of the provider in front of every
+request, the options come from PAYMENT_VARIANTS like the session ones
+
+    'paypal': ('payments_extend.paypal.PayPalExpressCheckoutProvider', {
+        ...
+        'timeout': (3.05, 10),
+        'breaker_failure_rate': 0.5,
+        'breaker_slow_call': 5,
+    }),
+"""
+import collections
+import logging
+import threading
+import time
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# provider option -> CircuitBreaker argument
+BREAKER_OPTIONS = {
+    'breaker_failure_rate': 'failure_rate',
+    'breaker_min_calls': 'min_calls',
+    'breaker_window': 'window',
+    'breaker_slow_call': 'slow_call',
+    'breaker_open_for': 'open_for',
+    'breaker_half_open_calls': 'half_open_calls',
+}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class GatewayUnavailable(requests.RequestException):
+    """Raised without calling the gateway when its breaker is open"""
+
+
+class CircuitBreaker(object):
+
+    """failure_rate of the calls of the last window seconds (at least
+    min_calls of them) failed or took more than slow_call seconds, open for
+    open_for seconds then let half_open_calls probes through.
+
+    it's thread-safe.
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=30,
+        slow_call=10, open_for=30, half_open_calls=1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_for = open_for
+        self.half_open_calls = half_open_calls
+
+        self.state = CLOSED
+        self._calls = collections.deque()  # (time, failed)
+        self._failures = 0
+        self._opened_at = 0
+        self._probes = 0
+        self._probed_at = 0
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        calls = self._calls
+        while calls and calls[0][0] <= now - self.window:
+            _, failed = calls.popleft()
+            self._failures -= failed
+
+    def _open(self, now):
+        if self.state != OPEN:
+            logger.warning('circuit of %s gateway is open', self.name)
+
+        self.state = OPEN
+        self._opened_at = now
+        self._probes = 0
+
+    def _close(self):
+        logger.info('circuit of %s gateway is closed', self.name)
+
+        self.state = CLOSED
+        self._calls.clear()
+        self._failures = 0
+        self._probes = 0
+
+    def allows_calls(self):
+        """false while calls would fail fast
+        """
+        if self.state == OPEN:
+            return time.monotonic() - self._opened_at >= self.open_for
+        if self.state == HALF_OPEN:
+            return self._probes < self.half_open_calls
+        return True
+
+    def before(self):
+        """raise GatewayUnavailable if the call must not be made
+        """
+        if self.state == CLOSED:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+
+            if self.state == OPEN:
+                if now - self._opened_at < self.open_for:
+                    raise GatewayUnavailable(
+                        '{} gateway is unavailable'.format(self.name))
+                self.state = HALF_OPEN
+                self._probes = 0
+
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    if now - self._probed_at < self.open_for:
+                        raise GatewayUnavailable(
+                            '{} gateway is being probed'.format(self.name))
+                    # the probes were lost, probe again
+                    logger.warning('probes of %s gateway got no outcome',
+                        self.name)
+                    self._probes = 0
+                self._probes += 1
+                self._probed_at = now
+
+    def record(self, ok, duration):
+        """record the end of a call, slow calls count as failures
+        """
+        failed = not ok or (self.slow_call is not None and
+            duration > self.slow_call)
+
+        with self._lock:
+            now = time.monotonic()
+
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open(now)
+                else:
+                    self._close()
+                return
+
+            if self.state == OPEN:
+                # a call started before the breaker opened
+                return
+
+            self._calls.append((now, failed))
+            self._failures += failed
+            self._prune(now)
+
+            if len(self._calls) >= self.min_calls and \
+                self._failures >= self.failure_rate * len(self._calls):
+                self._open(now)
+
+    def cancel(self):
+        """a call let through by before ended without an outcome, e.g. it
+        was cancelled
+        """
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def reset(self):
+        with self._lock:
+            self._close()
+
+
+def pop_breaker_options(kwargs):
+    """take the breaker options out of session options, with the argument
+    names of CircuitBreaker
+    """
+    return {BREAKER_OPTIONS[key]: kwargs.pop(key) for key in list(kwargs)
+        if key in BREAKER_OPTIONS}
+
+
+def get_breaker(name, **options):
+    """return the shared breaker of the gateway named name
+
+    the first options given for a name are kept, the sync and async
+    sessions of a provider share its breaker.
+    """
+    breaker = _breakers.get(name, None)
+
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name, None)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name, **options)
+
+    return breaker
+
+
+def reset_breakers():
+    with _breakers_lock:
+        for breaker in _breakers.values():
+            breaker.reset()
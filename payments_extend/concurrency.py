@@ -0,0 +1,127 @@
+"""helpers to call gateways concurrently within their limits
+"""
+import collections
+import itertools
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+
+Outcome = collections.namedtuple('Outcome', ['item', 'result', 'error'])
+
+
+class RateLimiter(object):
+
+    """token bucket, at most rate calls per second with bursts of burst
+
+    acquire blocks until a token is available. It's thread-safe.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                    self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait_time = (1 - self._tokens) / self.rate
+
+            time.sleep(wait_time)
+
+
+class AdaptiveBackoff(object):
+
+    """delay between calls which grows when the gateway fails and shrinks
+    back when it recovers
+
+    failure multiplies the delay by factor (starting at min_delay or 0.1s),
+    success halves it, below 0.1s (or min_delay * 2) it goes back to
+    min_delay.
+    Only exceptions of errors count as failures. It's thread-safe.
+    """
+
+    def __init__(self, min_delay=0, max_delay=30, factor=2, errors=(Exception, )):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.errors = errors
+        self.delay = min_delay
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay:
+            time.sleep(delay)
+
+    def success(self):
+        with self._lock:
+            delay = self.delay / 2
+            if delay < max(self.min_delay * 2, 0.1):
+                delay = self.min_delay
+            self.delay = delay
+
+    def failure(self):
+        with self._lock:
+            self.delay = min(self.max_delay,
+                max(self.delay, self.min_delay, 0.1) * self.factor)
+
+    def call(self, func, *args, **kwargs):
+        """wait, call func and adapt the delay to how it went
+        """
+        self.wait()
+        try:
+            result = func(*args, **kwargs)
+        except self.errors:
+            self.failure()
+            raise
+
+        self.success()
+        return result
+
+
+def map_concurrently(func, items, workers=4, limiter=None):
+    """call func for every item with a pool of workers threads
+
+    yield an Outcome per item in completion order, an exception raised by
+    func is in the error of its Outcome. Only workers * 2 items are taken
+    from items at a time. If limiter is given, every call acquires it first.
+    """
+    def call(item):
+        if limiter is not None:
+            limiter.acquire()
+        return func(item)
+
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit(count):
+            for item in itertools.islice(items, count):
+                pending[executor.submit(call, item)] = item
+
+        submit(workers * 2)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield Outcome(item, None if error else future.result(), error)
+
+            submit(len(done))
@@ -0,0 +1,47 @@
+"""cache of the signed form data of payments
+
+reloading direct_to_pay (or coming back to it) renders the form data
+generated the first time, no signing and no SetExpressCheckout call again.
+The data lives as long as the provider says (form_cache_ttl, e.g. the life
+of a paypal token) and is dropped whenever the payment is saved, see
+apps.PaymentsExtendConfig.
+
+PAYMENT_FORM_CACHE names the django cache, it must be shared by all the
+workers so a save in one of them invalidates the others.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+
+class PaymentFormCache(object):
+
+    def __init__(self, key_prefix, cache_alias='default'):
+        self.key_prefix = key_prefix
+        self.cache_alias = cache_alias
+
+    def _key(self, payment):
+        return '{}:{}'.format(self.key_prefix, payment.pk)
+
+    def get(self, payment):
+        if payment.pk is None:
+            return None
+        return caches[self.cache_alias].get(self._key(payment), None)
+
+    def set(self, payment, data, ttl):
+        if payment.pk is not None and ttl:
+            caches[self.cache_alias].set(self._key(payment), data, ttl)
+
+    def invalidate(self, payment):
+        caches[self.cache_alias].delete(self._key(payment))
+
+
+payment_form_cache = PaymentFormCache(
+    'payments_extend:payment_form',
+    cache_alias=getattr(settings, 'PAYMENT_FORM_CACHE', 'default'),
+)
+
+
+def invalidate_payment_form(sender, instance, **kwargs):
+    """post_save receiver of the payment model
+    """
+    payment_form_cache.invalidate(instance)
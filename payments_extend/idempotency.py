@@ -0,0 +1,102 @@
+"""absorb retried notifies of cash flow merchants
+
+allpay and alipay send the same asynchronous notify again until they get
+1|OK / success. After a notify is processed, its response is kept in the
+django cache keyed on (provider, MerchantTradeNo / notify_id, payload hash),
+so a retry is answered from the cache without any database work
+
+    response = allpay_notify_deduplicator.get(trade_no, data)
+    if response is not None:
+        return HttpResponse(response)
+    ...
+    allpay_notify_deduplicator.set(trade_no, data, '1|OK')
+
+NOTIFY_DEDUP_TTL (seconds, default one day) and NOTIFY_DEDUP_CACHE (cache
+alias, default 'default') can be set in settings.
+"""
+import hashlib
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'payments_extend:notify'
+
+
+def payload_hash(payload):
+    """hash of a payload which doesn't depend on the key order
+    """
+    items = sorted((str(key), str(value)) for key, value in payload.items())
+    data = json.dumps(items, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class NotifyDeduplicator(object):
+
+    """cache of responses of processed notifies of a provider
+
+    duplicates counts the duplicates absorbed by this process,
+    get_duplicates_total counts them across processes sharing the cache.
+    """
+
+    def __init__(self, provider, ttl=None, cache_alias=None):
+        self.provider = provider
+        self.ttl = ttl if ttl is not None else \
+            getattr(settings, 'NOTIFY_DEDUP_TTL', 24 * 60 * 60)
+        self.cache_alias = cache_alias or \
+            getattr(settings, 'NOTIFY_DEDUP_CACHE', 'default')
+
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    @property
+    def _cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, notify_id, payload):
+        return '{}:{}:{}:{}'.format(KEY_PREFIX, self.provider, notify_id,
+            payload_hash(payload))
+
+    def _duplicates_key(self):
+        return '{}:{}:duplicates'.format(KEY_PREFIX, self.provider)
+
+    def get(self, notify_id, payload):
+        """return the cached response of the notify, None if it's new
+        """
+        response = self._cache.get(self._key(notify_id, payload))
+
+        if response is not None:
+            self._count_duplicate(notify_id)
+
+        return response
+
+    def set(self, notify_id, payload, response):
+        """remember the response of a processed notify
+        """
+        self._cache.set(self._key(notify_id, payload), response, self.ttl)
+
+    def _count_duplicate(self, notify_id):
+        with self._lock:
+            self.duplicates += 1
+
+        key = self._duplicates_key()
+        try:
+            self._cache.incr(key)
+        except ValueError:
+            # incr fails if the key is missing
+            self._cache.add(key, 0, None)
+            self._cache.incr(key)
+
+        logger.debug('absorbed duplicated %s notify %s', self.provider, notify_id)
+
+    def get_duplicates_total(self):
+        return self._cache.get(self._duplicates_key(), 0)
+
+
+allpay_notify_deduplicator = NotifyDeduplicator('allpay')
+alipay_notify_deduplicator = NotifyDeduplicator('alipay')
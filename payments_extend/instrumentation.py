@@ -0,0 +1,225 @@
+"""timing of the hot paths per provider and phase
+
+    with timed('paypal', HTTP):
+        r = self._session.post(...)
+
+phases are sign, verify, http, log_write and status_change. Every timing
+goes to the exporters, an InProcessCollector keeps histograms in memory,
+a StatsdExporter sends them as statsd timers over udp. Exporters are set
+up from settings when the app is ready
+
+    PAYMENTS_EXTEND_EXPORTERS = [
+        ('payments_extend.instrumentation.StatsdExporter', {
+            'host': '127.0.0.1', 'port': 8125, 'prefix': 'payments'}),
+    ]
+
+or added with add_exporter. Without exporters timed returns a shared no-op
+context manager, so it costs a function call and a truth test.
+"""
+import bisect
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+SIGN = 'sign'
+VERIFY = 'verify'
+HTTP = 'http'
+LOG_WRITE = 'log_write'
+STATUS_CHANGE = 'status_change'
+
+# upper bounds (seconds) of histogram buckets, the last one is +Inf
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10)
+
+_exporters = ()
+_lock = threading.Lock()
+
+
+class _NoopTimer(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_noop_timer = _NoopTimer()
+
+
+class _Timer(object):
+
+    __slots__ = ('provider', 'phase', '_started_at')
+
+    def __init__(self, provider, phase):
+        self.provider = provider
+        self.phase = phase
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.provider, self.phase, time.perf_counter() - self._started_at,
+            error=exc_type is not None)
+        return False
+
+
+def timed(provider, phase):
+    """context manager timing its block as phase of provider
+    """
+    if not _exporters:
+        return _noop_timer
+    return _Timer(provider, phase)
+
+
+def record(provider, phase, seconds, error=False):
+    """send one timing to every exporter, an exporter failure is logged and
+    never reaches the caller
+    """
+    for exporter in _exporters:
+        try:
+            exporter.record(provider, phase, seconds, error)
+        except Exception:
+            logger.exception('instrumentation exporter %r failed', exporter)
+
+
+def add_exporter(exporter):
+    global _exporters
+
+    with _lock:
+        _exporters = _exporters + (exporter, )
+
+    return exporter
+
+
+def remove_exporter(exporter):
+    global _exporters
+
+    with _lock:
+        _exporters = tuple(e for e in _exporters if e is not exporter)
+
+
+def get_exporters():
+    return _exporters
+
+
+def configure_from_settings():
+    """add the exporters of PAYMENTS_EXTEND_EXPORTERS, (path, options) pairs
+    """
+    for path, options in getattr(settings, 'PAYMENTS_EXTEND_EXPORTERS', ()):
+        add_exporter(import_string(path)(**options))
+
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'errors')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q quantile, None if it's
+        in the +Inf one
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'errors': self.errors,
+            'buckets': list(zip(self.buckets + (float('inf'), ), self.counts)),
+        }
+
+
+class InProcessCollector(object):
+
+    """keep a histogram per (provider, phase) in memory
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider, phase, seconds, error=False):
+        key = (provider, phase)
+
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds, error)
+
+    def get(self, provider, phase):
+        return self._histograms.get((provider, phase), None)
+
+    def snapshot(self):
+        """{(provider, phase): histogram as dict}
+        """
+        with self._lock:
+            return {key: histogram.as_dict()
+                for key, histogram in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+class StatsdExporter(object):
+
+    """send timings as statsd timers, prefix.provider.phase:ms|ms, and
+    failures as counters, prefix.provider.phase.error:1|c
+
+    udp, fire and forget, a lost packet is a lost sample.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='payments_extend'):
+        self.prefix = prefix
+        self._address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line.encode('ascii'), self._address)
+        except OSError:
+            pass
+
+    def record(self, provider, phase, seconds, error=False):
+        name = '{}.{}.{}'.format(self.prefix, provider or 'all', phase)
+        self._send('{}:{:.3f}|ms'.format(name, seconds * 1000))
+
+        if error:
+            self._send('{}.error:1|c'.format(name))
@@ -0,0 +1,34 @@
+"""explicit payment lookups of the checkout and notify views
+
+every view looks a payment up by one column, tradeNo (allpay, alipay) or
+token (paypal, direct_to_pay). Both must be indexed in the payment model,
+unique preferably
+
+    tradeNo = models.CharField(max_length=64, unique=True, ...)
+    token = models.CharField(max_length=36, db_index=True, ...)
+
+the order is always joined, change_status reads it to update the order
+status. lock_payment must be called in transaction.atomic, concurrent
+notifies of the same trade then wait for each other instead of both
+confirming the payment.
+"""
+
+
+def get_payment(queryset, related=('order', ), **lookups):
+    """get a payment with its related rows in one query, None if not found
+    """
+    return queryset.select_related(*related).filter(**lookups).first()
+
+
+def lock_payment(queryset, related=('order', ), **lookups):
+    """get a payment like get_payment and lock its row (and the related
+    ones) until the transaction ends
+    """
+    return queryset.select_for_update().select_related(*related).filter(
+        **lookups).first()
+
+
+def load_payment(queryset, **lookups):
+    """get a payment with its order and the user of the order in one query
+    """
+    return get_payment(queryset, related=('order', 'order__user'), **lookups)
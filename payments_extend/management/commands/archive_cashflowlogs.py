@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...archive import DEFAULT_BATCH_SIZE
+from ...archive import archive_logs_older_than
+
+
+class Command(BaseCommand):
+
+    help = 'move old CashFlowLog rows into gzip json lines files, one per day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+            default=getattr(settings, 'CASHFLOW_LOG_ARCHIVE_AFTER_DAYS', 90),
+            help='archive logs older than this many days')
+        parser.add_argument('--dir', dest='archive_dir', default=None,
+            help='archive directory, default is CASHFLOW_LOG_ARCHIVE_DIR')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help='rows moved and deleted per batch')
+
+    def handle(self, *args, **options):
+        archived = archive_logs_older_than(options['days'],
+            archive_dir=options['archive_dir'],
+            batch_size=options['batch_size'])
+
+        self.stdout.write('archived {} cash flow logs'.format(archived))
@@ -0,0 +1,62 @@
+import csv
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from payments import get_payment_model
+
+from ...reconciliation import STATEMENT_COLUMNS
+from ...reconciliation import build_payment_index
+from ...reconciliation import iter_statement
+from ...reconciliation import open_statement
+from ...reconciliation import reconcile
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+
+    help = 'match a settlement statement of a provider against payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('provider', choices=sorted(STATEMENT_COLUMNS))
+        parser.add_argument('path', help='statement csv file')
+        parser.add_argument('--variant', default=None,
+            help='payment variant, default is the provider name')
+        parser.add_argument('--encoding', default=None)
+        parser.add_argument('--since', type=parse_date, default=None,
+            help='only payments created since this date (YYYY-MM-DD)')
+        parser.add_argument('--until', type=parse_date, default=None,
+            help='only payments created before this date (YYYY-MM-DD)')
+        parser.add_argument('--key-field', default='tradeNo',
+            help='payment field matched with the statement trade number')
+
+    def handle(self, *args, **options):
+        provider = options['provider']
+
+        payments = get_payment_model().objects.filter(
+            variant=options['variant'] or provider)
+        if options['since'] is not None:
+            payments = payments.filter(created__date__gte=options['since'])
+        if options['until'] is not None:
+            payments = payments.filter(created__date__lt=options['until'])
+
+        index = build_payment_index(payments, key_field=options['key_field'])
+
+        writer = csv.writer(self.stdout)
+        writer.writerow(['kind', 'trade_no', 'payment_amount',
+            'statement_amount', 'payment_status', 'statement_status'])
+
+        count = 0
+        try:
+            with open_statement(provider, options['path'],
+                options['encoding']) as f:
+                for mismatch in reconcile(iter_statement(provider, f), index):
+                    writer.writerow(mismatch)
+                    count += 1
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stderr.write('{} mismatches'.format(count))
@@ -0,0 +1,87 @@
+import datetime
+from decimal import Decimal
+from decimal import InvalidOperation
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from payments import get_payment_model
+import requests
+
+from ...concurrency import AdaptiveBackoff
+from ...registry import get_provider
+from ...sweeper import PENDING_STATUSES
+from ...sweeper import sweep
+
+
+PAID_STATUSES = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+
+
+def resolve_alipay_trade(payment, result):
+    """paid trades with the amount of payment are confirmed, closed ones
+    are rejected
+    """
+    trade_status = result.get('trade_status', None)
+
+    if trade_status == 'TRADE_CLOSED':
+        return 'rejected'
+
+    if trade_status not in PAID_STATUSES:
+        return None
+
+    try:
+        amount = Decimal(result.get('total_fee', ''))
+    except InvalidOperation:
+        return None
+
+    if amount != payment.total:
+        return None
+
+    return 'confirmed'
+
+
+class Command(BaseCommand):
+
+    help = 'query alipay about stale pending payments and apply their trade status'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variant', default='alipay')
+        parser.add_argument('--older-than', type=int, default=30,
+            help='only payments created more than these minutes ago')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--max-delay', type=float, default=30,
+            help='longest wait between queries while alipay fails (seconds)')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='only report, leave the payments as they are')
+
+    def handle(self, *args, **options):
+        provider = get_provider(options['variant'])
+        created_before = timezone.now() - datetime.timedelta(
+            minutes=options['older_than'])
+
+        payments = get_payment_model().objects.filter(
+            variant=options['variant'],
+            status__in=PENDING_STATUSES,
+            created__lt=created_before,
+        ).exclude(tradeNo='')
+
+        # only transport errors slow down the sweep, TRADE_NOT_EXIST doesn't
+        backoff = AdaptiveBackoff(max_delay=options['max_delay'],
+            errors=(requests.RequestException, ))
+
+        changed = failed = total = 0
+        for swept in sweep(payments.iterator(), provider.single_trade_query,
+            resolve_alipay_trade, workers=options['workers'],
+            dry_run=options['dry_run'], backoff=backoff):
+
+            total += 1
+            if swept.error is not None:
+                failed += 1
+                self.stderr.write('{}: {}'.format(swept.payment.tradeNo,
+                    swept.error))
+            elif swept.status is not None:
+                changed += 1
+                self.stdout.write('{} {}'.format(swept.payment.tradeNo,
+                    swept.status))
+
+        self.stderr.write('{} payments, {} changed, {} failed'.format(
+            total, changed, failed))
@@ -0,0 +1,69 @@
+import datetime
+from decimal import Decimal
+from decimal import InvalidOperation
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from payments import get_payment_model
+
+from ...registry import get_provider
+from ...sweeper import PENDING_STATUSES
+from ...sweeper import sweep
+
+
+def resolve_allpay_trade(payment, result):
+    """TradeStatus 1 is paid, the amount must be the one of payment
+    """
+    if result.get('TradeStatus', None) != '1':
+        return None
+
+    try:
+        amount = Decimal(result.get('TradeAmt', ''))
+    except InvalidOperation:
+        return None
+
+    if amount != payment.total:
+        return None
+
+    return 'confirmed'
+
+
+class Command(BaseCommand):
+
+    help = 'query allpay about stale pending payments and confirm the paid ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variant', default='allpay')
+        parser.add_argument('--older-than', type=int, default=30,
+            help='only payments created more than these minutes ago')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='only report, leave the payments as they are')
+
+    def handle(self, *args, **options):
+        provider = get_provider(options['variant'])
+        created_before = timezone.now() - datetime.timedelta(
+            minutes=options['older_than'])
+
+        payments = get_payment_model().objects.filter(
+            variant=options['variant'],
+            status__in=PENDING_STATUSES,
+            created__lt=created_before,
+        ).exclude(tradeNo='')
+
+        confirmed = failed = total = 0
+        for swept in sweep(payments.iterator(), provider.query_trade_info,
+            resolve_allpay_trade, workers=options['workers'],
+            dry_run=options['dry_run']):
+
+            total += 1
+            if swept.error is not None:
+                failed += 1
+                self.stderr.write('{}: {}'.format(swept.payment.tradeNo,
+                    swept.error))
+            elif swept.status == 'confirmed':
+                confirmed += 1
+                self.stdout.write('{} confirmed'.format(swept.payment.tradeNo))
+
+        self.stderr.write('{} payments, {} confirmed, {} failed'.format(
+            total, confirmed, failed))
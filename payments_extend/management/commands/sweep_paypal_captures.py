@@ -0,0 +1,103 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from payments import get_payment_model
+import requests
+
+from ...concurrency import AdaptiveBackoff
+from ...paypal.tasks import CHECKOUT_COMPLETED
+from ...paypal.tasks import CHECKOUT_NOT_CAPTURED
+from ...paypal.tasks import PREAUTH
+from ...registry import get_provider
+from ...sweeper import sweep
+
+
+def resolve_paypal_capture(payment, result):
+    """completed checkouts are confirmed, ones paypal never captured go back
+    to input, anything else is left for reconciliation
+    """
+    if not result.is_success:
+        return None
+
+    checkout_status = result.get('CHECKOUTSTATUS', None)
+
+    if checkout_status == CHECKOUT_COMPLETED:
+        return 'confirmed'
+
+    if checkout_status in CHECKOUT_NOT_CAPTURED:
+        return 'input'
+
+    return None
+
+
+def change_paypal_capture(payment, swept):
+    """like capture_payment, a confirmed payment gets the id of the paypal
+    transaction instead of the express checkout token
+    """
+    if swept.status == 'confirmed':
+        payment.transaction_id = swept.result.get(
+            'PAYMENTREQUEST_0_TRANSACTIONID', None) or payment.transaction_id
+
+    payment.change_status(swept.status)
+
+
+class Command(BaseCommand):
+
+    help = 'resolve paypal payments left in preauth by a background capture'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variant', default='paypal')
+        parser.add_argument('--older-than', type=int, default=10,
+            help='only payments in preauth for more than these minutes')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--max-delay', type=float, default=30,
+            help='longest wait between queries while paypal fails (seconds)')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='only report, leave the payments as they are')
+
+    def handle(self, *args, **options):
+        provider = get_provider(options['variant'])
+        modified_before = timezone.now() - datetime.timedelta(
+            minutes=options['older_than'])
+
+        # start_capture keeps the express checkout token in transaction_id,
+        # capture_payment touches modified while it runs
+        payments = get_payment_model().objects.filter(
+            variant=options['variant'],
+            status=PREAUTH,
+            modified__lt=modified_before,
+        ).exclude(transaction_id='')
+
+        def query(token):
+            return provider.get_nvp_response(
+                provider.getExpressCheckoutDetails(TOKEN=token))
+
+        backoff = AdaptiveBackoff(max_delay=options['max_delay'],
+            errors=(requests.RequestException, ))
+
+        changed = failed = left = total = 0
+        for swept in sweep(payments.iterator(), query, resolve_paypal_capture,
+            workers=options['workers'], key_field='transaction_id',
+            dry_run=options['dry_run'], backoff=backoff, statuses=(PREAUTH, ),
+            lookups={'modified__lt': modified_before},
+            change=change_paypal_capture):
+
+            total += 1
+            if swept.error is not None:
+                failed += 1
+                self.stderr.write('{}: {}'.format(swept.payment.pk,
+                    swept.error))
+            elif swept.status is not None:
+                changed += 1
+                self.stdout.write('{} {}'.format(swept.payment.pk,
+                    swept.status))
+            else:
+                left += 1
+                self.stdout.write('{} left in preauth ({})'.format(
+                    swept.payment.pk,
+                    swept.result.get('CHECKOUTSTATUS', None) or
+                    swept.result.get('L_ERRORCODE0', None)))
+
+        self.stderr.write('{} payments, {} changed, {} left, {} failed'.format(
+            total, changed, left, failed))
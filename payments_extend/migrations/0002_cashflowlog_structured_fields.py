@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from decimal import Decimal
+from decimal import InvalidOperation
+
+from django.db import migrations, models, transaction
+import django.utils.timezone
+
+
+# installed as payments_extend or under another name (e.g. cnpayments), the
+# app label is the last part of the package name
+APP_LABEL = __name__.split('.')[-3]
+
+BACKFILL_CHUNK_SIZE = 1000
+
+# frozen copy of models.extract_fields when this migration was written, the
+# backfill must not change with the model module
+TRADE_NO_KEYS = ('MerchantTradeNo', 'out_trade_no', 'PAYMENTREQUEST_0_INVNUM',
+    'INVNUM')
+PAYMENT_TOKEN_KEYS = ('TOKEN', 'token')
+RESULT_CODE_KEYS = ('RtnCode', 'trade_status', 'ACK')
+AMOUNT_KEYS = ('TradeAmt', 'TotalAmount', 'total_fee', 'PAYMENTINFO_0_AMT',
+    'PAYMENTREQUEST_0_AMT', 'AMT')
+
+# CashFlowLog.amount is DecimalField(max_digits=12, decimal_places=2)
+AMOUNT_PLACES = Decimal('0.01')
+AMOUNT_LIMIT = Decimal(10) ** 10
+
+
+def _first_value(data, keys):
+    for key in keys:
+        value = data.get(key, None)
+
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+
+        if value is not None and value != '':
+            return str(value)
+
+    return ''
+
+
+def _parse_amount(value):
+    """value as it fits in the amount column (12 digits, 2 of them
+    decimals), None if it's not a finite amount or doesn't fit
+    """
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        return None
+
+    if not amount.is_finite():
+        return None
+
+    try:
+        amount = amount.quantize(AMOUNT_PLACES)
+    except InvalidOperation:
+        return None
+
+    return amount if abs(amount) < AMOUNT_LIMIT else None
+
+
+def _guess_provider(data):
+    if 'MerchantTradeNo' in data or 'RtnCode' in data:
+        return 'allpay'
+    if 'notify_id' in data or 'out_trade_no' in data:
+        return 'alipay'
+    if 'ACK' in data or 'TOKEN' in data or 'PayerID' in data:
+        return 'paypal'
+    return ''
+
+
+def extract_fields(data):
+    amount = _first_value(data, AMOUNT_KEYS)
+    amount = _parse_amount(amount) if amount else None
+
+    return {
+        'provider': _guess_provider(data),
+        'trade_no': _first_value(data, TRADE_NO_KEYS)[:64],
+        'payment_token': _first_value(data, PAYMENT_TOKEN_KEYS)[:64],
+        'result_code': _first_value(data, RESULT_CODE_KEYS)[:32],
+        'amount': amount,
+    }
+
+
+def backfill_structured_fields(apps, schema_editor):
+    """extract the structured fields of existing logs chunk by chunk
+    """
+    CashFlowLog = apps.get_model(APP_LABEL, 'CashFlowLog')
+    db_alias = schema_editor.connection.alias
+    queryset = CashFlowLog.objects.using(db_alias)
+
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'json_res')[:BACKFILL_CHUNK_SIZE])
+        if not chunk:
+            break
+
+        with transaction.atomic(using=db_alias):
+            for pk, json_res in chunk:
+                try:
+                    data = json.loads(json_res)
+                except ValueError:
+                    continue
+
+                if isinstance(data, dict):
+                    queryset.filter(pk=pk).update(**extract_fields(data))
+
+        last_pk = chunk[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    # every backfill chunk is committed on its own
+    atomic = False
+
+    dependencies = [
+        (APP_LABEL, '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cashflowlog',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='cashflowlog',
+            name='provider',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='cashflowlog',
+            name='trade_no',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='cashflowlog',
+            name='payment_token',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='cashflowlog',
+            name='result_code',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='cashflowlog',
+            name='amount',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='cashflowlog',
+            index=models.Index(fields=['provider', 'created_at'], name='cashflowlog_provider_time'),
+        ),
+        migrations.RunPython(backfill_structured_fields, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,88 @@
+import json
+from decimal import Decimal
+from decimal import InvalidOperation
+
 from django.db import models
 from django.utils import timezone
 
 # Create your models here.
 
+# payload keys of the structured fields of CashFlowLog, first one found wins
+#   allpay  MerchantTradeNo, RtnCode, TradeAmt
+#   alipay  out_trade_no, trade_status, total_fee
+#   paypal  token / NVP response TOKEN, ACK, PAYMENTINFO_0_AMT
+TRADE_NO_KEYS = ('MerchantTradeNo', 'out_trade_no', 'PAYMENTREQUEST_0_INVNUM',
+    'INVNUM')
+PAYMENT_TOKEN_KEYS = ('TOKEN', 'token')
+RESULT_CODE_KEYS = ('RtnCode', 'trade_status', 'ACK')
+AMOUNT_KEYS = ('TradeAmt', 'TotalAmount', 'total_fee', 'PAYMENTINFO_0_AMT',
+    'PAYMENTREQUEST_0_AMT', 'AMT')
+
+# CashFlowLog.amount is DecimalField(max_digits=12, decimal_places=2)
+AMOUNT_PLACES = Decimal('0.01')
+AMOUNT_LIMIT = Decimal(10) ** 10
+
+
+def _first_value(data, keys):
+    for key in keys:
+        value = data.get(key, None)
+
+        # parse_qs gives lists
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+
+        if value is not None and value != '':
+            return str(value)
+
+    return ''
+
+
+def parse_amount(value):
+    """value as it fits in the amount column (12 digits, 2 of them
+    decimals), None if it's not a finite amount or doesn't fit
+    """
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        return None
+
+    if not amount.is_finite():
+        return None
+
+    try:
+        amount = amount.quantize(AMOUNT_PLACES)
+    except InvalidOperation:
+        return None
+
+    return amount if abs(amount) < AMOUNT_LIMIT else None
+
+
+def guess_provider(data):
+    """guess which cash flow merchant sent the payload
+    """
+    if 'MerchantTradeNo' in data or 'RtnCode' in data:
+        return 'allpay'
+    if 'notify_id' in data or 'out_trade_no' in data:
+        return 'alipay'
+    if 'ACK' in data or 'TOKEN' in data or 'PayerID' in data:
+        return 'paypal'
+    return ''
+
+
+def extract_fields(data, provider=''):
+    """extract the structured fields of CashFlowLog from a payload
+    """
+    amount = _first_value(data, AMOUNT_KEYS)
+    amount = parse_amount(amount) if amount else None
+
+    return {
+        'provider': provider or guess_provider(data),
+        'trade_no': _first_value(data, TRADE_NO_KEYS)[:64],
+        'payment_token': _first_value(data, PAYMENT_TOKEN_KEYS)[:64],
+        'result_code': _first_value(data, RESULT_CODE_KEYS)[:32],
+        'amount': amount,
+    }
+
 
 class CashFlowLog(models.Model):
 
@@ -12,9 +92,40 @@ class CashFlowLog(models.Model):
 
     HTTP_USER_AGENT
     REMOTE_ADDR
+
+    json_res keeps the whole payload. provider, trade_no, payment_token,
+    result_code and amount are extracted from it when the log is written,
+    so reconciliation can look logs up by index instead of parsing json_res.
     """
 
     json_res = models.TextField(default='')
     source_device = models.CharField(max_length=255)
     source_ip = models.CharField(max_length=255)
-    created_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    provider = models.CharField(max_length=16, blank=True, default='')
+    trade_no = models.CharField(max_length=64, blank=True, default='',
+        db_index=True)
+    payment_token = models.CharField(max_length=64, blank=True, default='',
+        db_index=True)
+    result_code = models.CharField(max_length=32, blank=True, default='')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, null=True,
+        blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['provider', 'created_at'],
+                name='cashflowlog_provider_time'),
+        ]
+
+    def fill_fields(self, data, provider=''):
+        """set json_res and the structured fields from the payload
+        """
+        # e.g. NVPResponse of paypal is a mapping but not a dict
+        if not isinstance(data, dict):
+            data = dict(data)
+
+        self.json_res = json.dumps(data)
+
+        for name, value in extract_fields(data, provider).items():
+            setattr(self, name, value)
@@ -1,10 +1,12 @@
+import asyncio
 import binascii
 import collections
+import functools
 import json
 import hashlib
 import copy
+from types import MappingProxyType
 from urllib.parse import quote_plus, urlencode
-from urllib.parse import parse_qs
 
 from django.core.exceptions import ImproperlyConfigured
 from django.shortcuts import redirect
@@ -12,12 +14,21 @@ from django.core.urlresolvers import reverse
 from django.utils.translation import pgettext_lazy
 
 from payments import BasicProvider
-import requests
 
+from ..checkout import get_checkout_snapshot
+from ..formcache import payment_form_cache
+from ..instrumentation import HTTP
+from ..instrumentation import timed
+from ..sessions import get_async_session
+from ..sessions import get_session
+from ..sessions import pop_session_options
 from .forms import PayPalForm
+from .nvp import NVPResponse
 
 from .exceptions import MissingParameter
-from .exceptions import ParameterValueError
+
+
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
 
 
 class PayPalExpressCheckoutProvider(BasicProvider):
@@ -31,6 +42,17 @@ class PayPalExpressCheckoutProvider(BasicProvider):
     3. request GetExpressCheckoutDetails with token when we redirect back to our
        site
     4. DoExpressCheckoutPayment
+
+    every step has an async counterpart (aset_express_checkout, aget_details,
+    ado_payment and aprocess_data) running on aiohttp, so an asyncio worker
+    can keep many checkouts in flight.
+
+    nvp calls are form encoded POST bodies, the credentials never go to an
+    url (and so to proxy or access logs).
+
+    the token of a payment is cached for form_cache_ttl seconds (paypal
+    tokens last 3 hours) until the payment is saved, so reloading the
+    checkout page doesn't call SetExpressCheckout again. See formcache.
     """
 
     _action = "https://api-3t.sandbox.paypal.com/nvp"
@@ -38,20 +60,32 @@ class PayPalExpressCheckoutProvider(BasicProvider):
     _cmd_gateway = 'https://www.paypal.com/cgi-bin/webscr'
 
     def __init__(self, user, pwd, signature, version=_version, endpoint=_action,
-        cmd_gateway=_cmd_gateway):
+        cmd_gateway=_cmd_gateway, form_cache_ttl=170 * 60, **kwargs):
         self._user = user
         self._pwd = pwd
         self._signature = signature
         self._version = version
         self._action = endpoint
         self._cmd_gateway = cmd_gateway
+        self._form_cache_ttl = form_cache_ttl
 
-        self._core_params = {
+        # providers are shared by requests, it's read only
+        self._core_params = MappingProxyType({
             "USER": self._user,
             "PWD": self._pwd,
             "SIGNATURE": self._signature,
             "VERSION": self._version,
-        }
+        })
+        # the static part of every nvp body, encoded once
+        self._credential_body = urlencode(self._core_params)
+
+        self._session_options = pop_session_options(kwargs)
+        self._session = get_session('paypal', **self._session_options)
+
+    def get_breaker(self):
+        """the circuit breaker of the gateway, None if it's turned off
+        """
+        return self._session.breaker
 
     def _check_params(self, params, requirements):
         """check params which are needed by paypal express checkout
@@ -68,9 +102,9 @@ class PayPalExpressCheckoutProvider(BasicProvider):
         """
         params_required = ('TOKEN', )
         self._check_params(kwargs, params_required)
-        url = self._build_express_api_url('GetExpressCheckoutDetails', **kwargs)
+        body = self._build_express_api_body('GetExpressCheckoutDetails', **kwargs)
 
-        return url
+        return body
 
     def doExpressCheckoutPayment(self, **kwargs):
         """final step to make a deal
@@ -78,9 +112,9 @@ class PayPalExpressCheckoutProvider(BasicProvider):
         params_required = ('TOKEN', 'PAYERID', 'PAYMENTREQUEST_0_PAYMENTACTION',
             'PAYMENTREQUEST_0_AMT')
         self._check_params(kwargs, params_required)
-        url = self._build_express_api_url('DoExpressCheckoutPayment', **kwargs)
+        body = self._build_express_api_body('DoExpressCheckoutPayment', **kwargs)
 
-        return url
+        return body
 
     def setExpressCheckout(self, **kwargs):
         """express checkout method -- setExpressCheckout
@@ -102,19 +136,18 @@ class PayPalExpressCheckoutProvider(BasicProvider):
 
         # https://developer.paypal.com/docs/classic/api/merchant/SetExpressCheckout_API_Operation_NVP/
         self._check_params(kwargs, params_required)
-        url = self._build_express_api_url('SetExpressCheckout', **kwargs)
-        return url
+        body = self._build_express_api_body('SetExpressCheckout', **kwargs)
+        return body
 
-    def _build_express_api_url(self, method, **kwargs):
-        """generate express checkout api url
+    def _build_express_api_body(self, method, **kwargs):
+        """generate the form encoded body of an express checkout api call
         """
-        _params = self._core_params.copy()
-        _params['METHOD'] = method
+        _params = {'METHOD': method}
         _params.update(kwargs)
 
-        url = '{}?{}'.format(self._action, urlencode(_params))
+        body = '{}&{}'.format(self._credential_body, urlencode(_params))
 
-        return url
+        return body.encode('ascii')
 
     def get_synchro_notify_url(self, request, payment_token):
         """build the aboslute uri for facade url which will be redirect to
@@ -132,12 +165,42 @@ class PayPalExpressCheckoutProvider(BasicProvider):
         url = request.build_absolute_uri(reverse('product_introduction'))
         return url
 
-    def get_nvp_response(self, url):
+    def get_nvp_response(self, body):
         """an util function for getting response of nvp api
+
+        body is what setExpressCheckout, getExpressCheckoutDetails or
+        doExpressCheckoutPayment return, it's posted to the nvp endpoint.
+        return a nvp.NVPResponse, call raise_for_ack to check ACK
+        """
+        with timed('paypal', HTTP):
+            r = self._session.post(self._action, data=body, headers=FORM_HEADERS)
+        return NVPResponse(r.text)
+
+    async def aget_nvp_response(self, body):
+        """async version of get_nvp_response
+        """
+        session = get_async_session('paypal', **self._session_options)
+        with timed('paypal', HTTP):
+            text = await session.post_text(self._action, data=body,
+                headers=FORM_HEADERS)
+        return NVPResponse(text)
+
+    async def aset_express_checkout(self, **kwargs):
+        """call SetExpressCheckout and return the nvp response
         """
-        r = requests.get(url)
-        res = parse_qs(r.text)
-        return res
+        return await self.aget_nvp_response(self.setExpressCheckout(**kwargs))
+
+    async def aget_details(self, **kwargs):
+        """call GetExpressCheckoutDetails and return the nvp response
+        """
+        return await self.aget_nvp_response(
+            self.getExpressCheckoutDetails(**kwargs))
+
+    async def ado_payment(self, **kwargs):
+        """call DoExpressCheckoutPayment and return the nvp response
+        """
+        return await self.aget_nvp_response(
+            self.doExpressCheckoutPayment(**kwargs))
 
     def get_form(self, payment, data=None):
         """call setExpressCheckout api to get token and redirect to
@@ -145,7 +208,7 @@ class PayPalExpressCheckoutProvider(BasicProvider):
         """
         if payment.status == 'waiting':
             payment.change_status('input')
-        else:
+        elif payment.status != 'input':
             return None
 
         form = PayPalForm(data=data, provider=self, payment=payment)
@@ -164,16 +227,58 @@ class PayPalExpressCheckoutProvider(BasicProvider):
         Currently, I think use django url pattern to match a token param..
         """
 
-        items = payment.get_purchased_items()
+        data = payment_form_cache.get(payment)
+        if data is not None:
+            return self.get_form(data=data, payment=payment)
+
+        _params = self._get_set_express_checkout_params(payment, request)
+
+        body = self.setExpressCheckout(**_params)  # first step
+        res = self.get_nvp_response(body)
+        data = self._get_form_data(res)
+
+        form = self.get_form(data=data, payment=payment)
+        # form for redirecting to paypal
+        if form is not None:
+            payment_form_cache.set(payment, data, self._form_cache_ttl)
+
+        return form
+
+    async def aprocess_data(self, payment, request, **kwargs):
+        """async version of process_data
+
+        the database work (purchased items, payment status) is run in the
+        default executor, so only the SetExpressCheckout call is awaited on
+        the loop.
+        """
+        loop = asyncio.get_event_loop()
+
+        data = await loop.run_in_executor(None, payment_form_cache.get, payment)
+        if data is not None:
+            return await loop.run_in_executor(
+                None, functools.partial(self.get_form, data=data, payment=payment))
+
+        _params = await loop.run_in_executor(
+            None, self._get_set_express_checkout_params, payment, request)
 
-        itemName = '#'.join([item.name for item in items])
-        itemCounts = '#'.join([str(item.quantity) for item in items])
-        itemPrice = '#'.join([str(int(item.price)) for item in items])
+        res = await self.aset_express_checkout(**_params)  # first step
+        data = self._get_form_data(res)
 
-        # set params needed by setExpressCheckout api
+        form = await loop.run_in_executor(
+            None, functools.partial(self.get_form, data=data, payment=payment))
+        if form is not None:
+            await loop.run_in_executor(None, payment_form_cache.set, payment,
+                data, self._form_cache_ttl)
+
+        return form
+
+    def _get_set_express_checkout_params(self, payment, request):
+        """collect params needed by setExpressCheckout api from the payment
+        """
+        snapshot = get_checkout_snapshot(payment)
 
         _params = {
-            'PAYMENTREQUEST_0_AMT': int(payment.get_total_price().gross),
+            'PAYMENTREQUEST_0_AMT': snapshot.total,
             'PAYMENTREQUEST_0_PAYMENTACTION': 'Sale',
             'RETURNURL': self.get_synchro_notify_url(request, payment.token),
             'CANCELURL': self.get_cancel_url(request),
@@ -188,15 +293,21 @@ class PayPalExpressCheckoutProvider(BasicProvider):
 
         }
 
-        url = self.setExpressCheckout(**_params)  # first step
-        res = self.get_nvp_response(url)
+        # the Invoice Number of statements, see reconciliation
+        if payment.tradeNo:
+            _params['PAYMENTREQUEST_0_INVNUM'] = payment.tradeNo
+
+        return _params
+
+    def _get_form_data(self, res):
+        """get the token from setExpressCheckout response and build the data
+        of the form for redirecting to paypal
+        """
         # about the response, go to see the doc
         # https://developer.paypal.com/docs/classic/api/merchant/SetExpressCheckout_API_Operation_NVP/
 
-        if res['ACK'][0] == 'Failure':
-            raise ParameterValueError("parameters error")
-        else:
-            token = res['TOKEN'][0]
+        res.raise_for_ack()
+        token = res['TOKEN']
 
         data = {
             'token': token,
@@ -204,7 +315,4 @@ class PayPalExpressCheckoutProvider(BasicProvider):
         }
         # doc https://developer.paypal.com/docs/classic/express-checkout/integration-guide/ECGettingStarted/#id084RM05055Z
 
-        form = self.get_form(data=data, payment=payment)
-        # form for redirecting to paypal
-
-        return form
+        return data
@@ -10,3 +10,22 @@ class MissingParameter(PayPalException):
 
 class ParameterValueError(PayPalException):
     """Raised when parameter value is incorrect"""
+
+
+class NVPResponseError(ParameterValueError):
+    """Raised when the ACK of a nvp response is Failure (or
+    FailureWithWarning), errors are the L_ERRORCODEn... details
+    """
+
+    def __init__(self, ack, errors, correlation_id=None):
+        self.ack = ack
+        self.errors = errors
+        self.correlation_id = correlation_id
+
+        if errors:
+            message = '; '.join('{}: {}'.format(error.code,
+                error.long_message or error.short_message) for error in errors)
+        else:
+            message = 'ACK is {}'.format(ack)
+
+        super().__init__(message)
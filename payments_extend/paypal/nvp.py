@@ -0,0 +1,128 @@
+"""NVP (name-value pair) responses of the paypal classic api
+
+    ACK=Success&TOKEN=EC%2d4P809628KK1823013&L_PAYMENTREQUEST_0_NAME0=Apple&...
+
+NVPResponse keeps the raw values and only unquotes the ones which are
+accessed, a value is a str (not a list like parse_qs gives)
+
+    res = NVPResponse(text)
+    res.raise_for_ack()
+    res['TOKEN']
+    res.line_items()    # [{'NAME': 'Apple', 'QTY': '1', 'AMT': '10.00'}, ...]
+    res.group('PAYMENTINFO')    # [{'TRANSACTIONID': ..., 'AMT': ...}, ...]
+"""
+import collections
+import re
+from collections.abc import Mapping
+from urllib.parse import unquote_plus
+
+from .exceptions import NVPResponseError
+
+
+NVPError = collections.namedtuple('NVPError',
+    ['code', 'short_message', 'long_message', 'severity'])
+
+SUCCESS_ACKS = ('Success', 'SuccessWithWarning')
+
+_LINE_ITEM_KEY = re.compile(r'^L_PAYMENTREQUEST_(\d+)_([A-Z]+?)(\d+)$')
+_ERROR_KEY = re.compile(r'^L_(ERRORCODE|SHORTMESSAGE|LONGMESSAGE|SEVERITYCODE)(\d+)$')
+
+
+def _indexed(groups):
+    return [groups[index] for index in sorted(groups)]
+
+
+class NVPResponse(Mapping):
+
+    """read only mapping of a nvp response text
+    """
+
+    __slots__ = ('_raw', '_decoded')
+
+    def __init__(self, text):
+        self._raw = {}
+        self._decoded = {}
+
+        for pair in text.split('&'):
+            if not pair:
+                continue
+            key, _, value = pair.partition('=')
+            self._raw[unquote_plus(key)] = value
+
+    def __getitem__(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
+            value = self._decoded[key] = unquote_plus(self._raw[key])
+            return value
+
+    def __contains__(self, key):
+        return key in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __repr__(self):
+        return '<NVPResponse ACK={}>'.format(self.ack)
+
+    @property
+    def ack(self):
+        return self.get('ACK', None)
+
+    @property
+    def is_success(self):
+        return self.ack in SUCCESS_ACKS
+
+    @property
+    def errors(self):
+        """the L_ERRORCODEn, L_SHORTMESSAGEn, ... of the response as NVPErrors
+        """
+        groups = collections.defaultdict(dict)
+
+        for key in self._raw:
+            match = _ERROR_KEY.match(key)
+            if match is not None:
+                name, index = match.groups()
+                groups[int(index)][name] = self[key]
+
+        return [NVPError(error.get('ERRORCODE', ''), error.get('SHORTMESSAGE', ''),
+            error.get('LONGMESSAGE', ''), error.get('SEVERITYCODE', ''))
+            for error in _indexed(groups)]
+
+    def raise_for_ack(self):
+        """raise NVPResponseError if ACK isn't Success or SuccessWithWarning
+        """
+        if not self.is_success:
+            raise NVPResponseError(self.ack, self.errors,
+                self.get('CORRELATIONID', None))
+
+    def group(self, prefix):
+        """group PREFIX_n_NAME fields, e.g. PAYMENTREQUEST_0_AMT, into a
+        list of dict by n
+        """
+        pattern = re.compile(r'^{}_(\d+)_(\w+)$'.format(re.escape(prefix)))
+        groups = collections.defaultdict(dict)
+
+        for key in self._raw:
+            match = pattern.match(key)
+            if match is not None:
+                index, name = match.groups()
+                groups[int(index)][name] = self[key]
+
+        return _indexed(groups)
+
+    def line_items(self, request=0):
+        """the L_PAYMENTREQUEST_{request}_NAMEm, ..._QTYm, ..._AMTm fields as
+        a list of dict by m
+        """
+        groups = collections.defaultdict(dict)
+
+        for key in self._raw:
+            match = _LINE_ITEM_KEY.match(key)
+            if match is not None and int(match.group(1)) == request:
+                groups[int(match.group(3))][match.group(2)] = self[key]
+
+        return _indexed(groups)
@@ -0,0 +1,236 @@
+"""capture of express checkout payments out of the return request
+
+the return view used to call GetExpressCheckoutDetails and
+DoExpressCheckoutPayment before redirecting the buyer. With
+PAYPAL_CAPTURE_IN_BACKGROUND = True it calls
+
+    start_capture(payment, token, source_device, source_ip)
+
+which moves the payment to preauth (approved by the buyer, not captured
+yet, as in django-payments) with a single UPDATE and hands capture_payment
+to the task backend (see ..tasks), then redirects at once. The express
+checkout token is kept in transaction_id until the capture is done. The
+order page polls the payment status.
+
+capture_payment ends in confirmed, or back in input if nothing was
+captured (paypal declined, or couldn't be reached before
+DoExpressCheckoutPayment was sent) so the buyer can pay again. Only
+GetExpressCheckoutDetails and calls which surely didn't reach paypal are
+retried, a capture is never sent twice. When DoExpressCheckoutPayment
+fails after it may have been sent, the payment stays in preauth with
+attrs.capture_unknown set. A capture which went through confirms the
+payment even if the sweep moved it back to input meanwhile.
+
+payments left in preauth (unknown captures, lost tasks) are resolved from
+their CHECKOUTSTATUS by
+
+    python manage.py sweep_paypal_captures
+
+which only takes payments not modified for a while. capture_payment
+touches modified under the row lock when it starts and before it sends
+DoExpressCheckoutPayment, so the sweep leaves a running capture alone.
+"""
+import functools
+import logging
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from payments import get_payment_model
+from urllib3.exceptions import NewConnectionError
+
+from ..cashflow import cash_flow_log_buffer
+from ..circuitbreaker import GatewayUnavailable
+from ..concurrency import AdaptiveBackoff
+from ..instrumentation import STATUS_CHANGE
+from ..instrumentation import timed
+from ..lookups import lock_payment
+from ..registry import get_provider
+from ..tasks import enqueue
+
+
+logger = logging.getLogger(__name__)
+
+PREAUTH = 'preauth'
+CAPTURABLE_STATUSES = ('waiting', 'input')
+
+# CHECKOUTSTATUS of GetExpressCheckoutDetails
+CHECKOUT_COMPLETED = 'PaymentActionCompleted'
+CHECKOUT_IN_PROGRESS = 'PaymentActionInProgress'
+CHECKOUT_NOT_CAPTURED = ('PaymentActionNotInitiated', 'PaymentActionFailed')
+
+
+def start_capture(payment, token, source_device='', source_ip=''):
+    """move the payment to preauth and enqueue its capture
+
+    return false if the payment was not waiting for a capture, e.g. the
+    return url is reloaded while the capture runs.
+    """
+    # modified tells the sweep how long the capture has been running
+    updated = type(payment)._default_manager.filter(pk=payment.pk,
+        status__in=CAPTURABLE_STATUSES).update(status=PREAUTH,
+        transaction_id=token, modified=timezone.now())
+
+    if not updated:
+        return False
+
+    payment.status = PREAUTH
+    payment.transaction_id = token
+    # a task worker must not read the payment before the update is committed
+    transaction.on_commit(functools.partial(enqueue,
+        __name__ + '.capture_payment', payment.pk, token, source_device,
+        source_ip))
+
+    return True
+
+
+def not_sent(error):
+    """true if the request of error surely didn't reach paypal
+    """
+    if isinstance(error, (requests.ConnectTimeout, GatewayUnavailable)):
+        return True
+
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and \
+        isinstance(reason, NewConnectionError)
+
+
+def _call(paypal, body, attempts, backoff, retry):
+    for attempt in range(1, attempts + 1):
+        try:
+            return backoff.call(paypal.get_nvp_response, body)
+        except requests.RequestException as e:
+            if attempt == attempts or not retry(e):
+                raise
+            logger.warning('paypal call failed, attempt %s of %s', attempt,
+                attempts, exc_info=True)
+
+
+def _claim(payment_model, payment_pk):
+    """lock the payment and touch its modified if it's in preauth, the sweep
+    then leaves it to the running capture. Return the payment
+    """
+    with transaction.atomic():
+        payment = lock_payment(payment_model.objects, pk=payment_pk)
+
+        if payment is not None and payment.status == PREAUTH:
+            # modified is auto_now
+            payment.save(update_fields=['modified'])
+
+    return payment
+
+
+def _settle(payment_model, payment_pk, status, log=None, transaction_id=None):
+    """change the payment from preauth to status, None keeps it in preauth
+    flagged with capture_unknown. Return the status of the payment
+
+    a captured payment is confirmed from input (or waiting) too, the sweep
+    may have moved it there while the capture ran.
+    """
+    settled_statuses = (PREAUTH, )
+    if status == 'confirmed':
+        settled_statuses += CAPTURABLE_STATUSES
+
+    # the logs must be written before the payment status changes, and
+    # before the payment is locked (flush updates payments)
+    cash_flow_log_buffer.flush()
+
+    with transaction.atomic():
+        payment = lock_payment(payment_model.objects, pk=payment_pk)
+
+        if payment is None or payment.status not in settled_statuses:
+            return payment and payment.status
+
+        if payment.status != PREAUTH:
+            logger.warning('payment %s was captured in %s, confirming it',
+                payment_pk, payment.status)
+
+        if log is not None and log.pk is not None:
+            payment.logs = log.pk
+
+        if status is None:
+            payment.attrs.capture_unknown = True
+            payment.save()
+            return PREAUTH
+
+        if transaction_id:
+            payment.transaction_id = transaction_id
+
+        with timed('paypal', STATUS_CHANGE):
+            payment.change_status(status)
+
+    return status
+
+
+def capture_payment(payment_pk, token, source_device='', source_ip=''):
+    """capture a preauth payment and set its status, return the status
+
+    failed GetExpressCheckoutDetails calls and DoExpressCheckoutPayment
+    calls which didn't reach paypal are tried PAYPAL_CAPTURE_ATTEMPTS times
+    in all.
+    """
+    payment_model = get_payment_model()
+    payment = _claim(payment_model, payment_pk)
+
+    if payment is None or payment.status != PREAUTH:
+        return payment and payment.status
+
+    paypal = get_provider(payment.variant)
+    attempts = getattr(settings, 'PAYPAL_CAPTURE_ATTEMPTS', 3)
+    backoff = AdaptiveBackoff(max_delay=10, errors=(requests.RequestException, ))
+    add_log = functools.partial(cash_flow_log_buffer.add,
+        source_device=source_device, source_ip=source_ip, payment=payment,
+        provider='paypal')
+    # a capture of an earlier try may have gone through
+    unknown = bool(getattr(payment.attrs, 'capture_unknown', False))
+
+    try:
+        res = _call(paypal, paypal.getExpressCheckoutDetails(TOKEN=token),
+            attempts, backoff, retry=lambda e: True)
+    except requests.RequestException:
+        logger.exception('details of payment %s failed', payment_pk)
+        return _settle(payment_model, payment_pk, None if unknown else 'input')
+
+    log = add_log(res)
+
+    if not res.is_success:
+        return _settle(payment_model, payment_pk, None if unknown else 'input',
+            log)
+
+    checkout_status = res.get('CHECKOUTSTATUS', None)
+    if checkout_status == CHECKOUT_COMPLETED:
+        return _settle(payment_model, payment_pk, 'confirmed', log,
+            res.get('PAYMENTREQUEST_0_TRANSACTIONID', None))
+    if checkout_status == CHECKOUT_IN_PROGRESS:
+        return _settle(payment_model, payment_pk, None, log)
+
+    # the details may have taken a while, the sweep may have taken it over
+    claimed = _claim(payment_model, payment_pk)
+    if claimed is None or claimed.status != PREAUTH:
+        return claimed and claimed.status
+
+    body = paypal.doExpressCheckoutPayment(
+        TOKEN=res['TOKEN'],
+        PAYERID=res['PAYERID'],
+        PAYMENTREQUEST_0_PAYMENTACTION='Sale',
+        PAYMENTREQUEST_0_AMT=payment.get_total_price().gross,
+    )
+    try:
+        res = _call(paypal, body, attempts, backoff, retry=not_sent)
+    except requests.RequestException as e:
+        if not_sent(e):
+            logger.exception('capture of payment %s was not sent', payment_pk)
+            return _settle(payment_model, payment_pk, 'input', log)
+
+        logger.exception('capture of payment %s is unknown, it needs '
+            'reconciliation', payment_pk)
+        return _settle(payment_model, payment_pk, None, log)
+
+    log = add_log(res)
+
+    if not res.is_success:
+        return _settle(payment_model, payment_pk, 'input', log)
+
+    return _settle(payment_model, payment_pk, 'confirmed', log,
+        res.get('PAYMENTINFO_0_TRANSACTIONID', None))
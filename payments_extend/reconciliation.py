@@ -0,0 +1,209 @@
+"""match what cash flow merchants settled against our payments
+
+statement files are read row by row with generators, so a million rows
+statement never sits in memory. Payments of the period are put in a dict
+keyed on trade number (the small side of the join), then every statement
+row is looked up in it
+
+    with open_statement('allpay', 'trade.csv') as f:
+        rows = iter_statement('allpay', f)
+        index = build_payment_index(payments)
+        for mismatch in reconcile(rows, index):
+            print(mismatch)
+
+    python manage.py reconcile_statement allpay trade.csv --since 2016-01-01
+
+mismatch kinds are
+ - missing_payment       the statement has a trade we don't have
+ - missing_in_statement  we have a settled (confirmed or refunded) payment
+                         the statement doesn't have, abandoned checkouts
+                         are not reported
+ - amount_differs
+ - status_differs
+
+statuses are normalized to the ones of django-payments (confirmed,
+refunded, rejected, waiting).
+
+paypal statements are matched on their Invoice Number, SetExpressCheckout
+sends tradeNo of the payment as PAYMENTREQUEST_0_INVNUM.
+"""
+import collections
+import csv
+import io
+from decimal import Decimal
+from decimal import InvalidOperation
+
+
+StatementRow = collections.namedtuple('StatementRow',
+    ['provider', 'trade_no', 'amount', 'status'])
+
+PaymentEntry = collections.namedtuple('PaymentEntry',
+    ['pk', 'amount', 'status'])
+
+Mismatch = collections.namedtuple('Mismatch',
+    ['kind', 'trade_no', 'payment_amount', 'statement_amount',
+     'payment_status', 'statement_status'])
+
+MISSING_PAYMENT = 'missing_payment'
+MISSING_IN_STATEMENT = 'missing_in_statement'
+AMOUNT_DIFFERS = 'amount_differs'
+STATUS_DIFFERS = 'status_differs'
+
+# payments the statement must have
+SETTLED_STATUSES = ('confirmed', 'refunded')
+
+# candidate header names of (trade_no, amount, status) columns per provider
+STATEMENT_COLUMNS = {
+    'allpay': {
+        'trade_no': ('MerchantTradeNo', '廠商訂單編號'),
+        'amount': ('TradeAmt', '交易金額'),
+        'status': ('TradeStatus', '交易狀態', '付款狀態'),
+    },
+    'alipay': {
+        'trade_no': ('out_trade_no', '商户订单号'),
+        'amount': ('total_fee', '订单金额（元）', '订单金额(元)'),
+        'status': ('trade_status', '业务类型'),
+    },
+    'paypal': {
+        'trade_no': ('Invoice Number', 'Invoice ID'),
+        'amount': ('Gross', ),
+        'status': ('Status', ),
+    },
+}
+
+STATUS_MAPPING = {
+    'allpay': {
+        '1': 'confirmed', '0': 'waiting',
+        '已付款': 'confirmed', '未付款': 'waiting',
+    },
+    'alipay': {
+        'TRADE_SUCCESS': 'confirmed', 'TRADE_FINISHED': 'confirmed',
+        'WAIT_BUYER_PAY': 'waiting', 'TRADE_CLOSED': 'rejected',
+        '交易': 'confirmed', '退款': 'refunded',
+    },
+    'paypal': {
+        'Completed': 'confirmed', 'Pending': 'waiting',
+        'Refunded': 'refunded', 'Partially Refunded': 'refunded',
+        'Denied': 'rejected', 'Reversed': 'rejected',
+    },
+}
+
+# alipay bills are GBK, the others are exported as utf-8 (with BOM)
+DEFAULT_ENCODINGS = {
+    'allpay': 'utf-8-sig',
+    'alipay': 'gbk',
+    'paypal': 'utf-8-sig',
+}
+
+
+def open_statement(provider, path, encoding=None):
+    """open a statement file as text with the usual encoding of provider
+    """
+    encoding = encoding or DEFAULT_ENCODINGS.get(provider, 'utf-8')
+    return io.open(path, 'r', encoding=encoding, newline='')
+
+
+def parse_amount(value):
+    try:
+        return Decimal(value.replace(',', '').strip()).quantize(Decimal('0.01'))
+    except (InvalidOperation, AttributeError):
+        return None
+
+
+def _find_column(header, candidates):
+    for name in candidates:
+        if name in header:
+            return header.index(name)
+    raise ValueError('none of columns {} is in the statement'.format(
+        ', '.join(candidates)))
+
+
+def iter_statement(provider, lines, columns=None, status_mapping=None):
+    """yield a StatementRow for every trade row of a csv statement
+
+    lines can be a file object or any iterable of lines. Lines starting
+    with # (the alipay bill summary) and blank rows are skipped, the first
+    other row is the header.
+    """
+    columns = columns or STATEMENT_COLUMNS[provider]
+    status_mapping = status_mapping or STATUS_MAPPING.get(provider, {})
+
+    reader = csv.reader(line for line in lines if not line.startswith('#'))
+    trade_no_index = amount_index = status_index = None
+
+    for row in reader:
+        row = [value.strip() for value in row]
+        if not any(row):
+            continue
+
+        if trade_no_index is None:
+            trade_no_index = _find_column(row, columns['trade_no'])
+            amount_index = _find_column(row, columns['amount'])
+            status_index = _find_column(row, columns['status'])
+            continue
+
+        if len(row) <= max(trade_no_index, amount_index, status_index):
+            continue
+
+        trade_no = row[trade_no_index].lstrip('`')  # alipay quotes numbers with `
+        if not trade_no:
+            # e.g. fee and transfer rows of paypal
+            continue
+
+        status = row[status_index]
+        yield StatementRow(
+            provider,
+            trade_no,
+            parse_amount(row[amount_index]),
+            status_mapping.get(status, status),
+        )
+
+
+def build_payment_index(payments, key_field='tradeNo', amount_field='total'):
+    """build the in-memory hash index of payments keyed on trade number
+
+    payments is a queryset, only the needed columns are fetched
+    """
+    index = {}
+    values = payments.values_list('pk', key_field, amount_field, 'status')
+
+    for pk, trade_no, amount, status in values.iterator():
+        if trade_no:
+            index[str(trade_no)] = PaymentEntry(pk, parse_amount(str(amount)),
+                status)
+
+    return index
+
+
+def reconcile(rows, index, settled=SETTLED_STATUSES):
+    """yield a Mismatch for every statement row which doesn't agree with
+    the payment of its trade number, then one for every payment in a
+    settled status the statement doesn't have
+
+    the index holds payments of any status, so a trade settled for an
+    unpaid payment is a status_differs.
+    """
+    unseen = {trade_no for trade_no, entry in index.items()
+        if entry.status in settled}
+
+    for row in rows:
+        entry = index.get(row.trade_no, None)
+
+        if entry is None:
+            yield Mismatch(MISSING_PAYMENT, row.trade_no, None, row.amount,
+                None, row.status)
+            continue
+
+        unseen.discard(row.trade_no)
+
+        if entry.amount != row.amount:
+            yield Mismatch(AMOUNT_DIFFERS, row.trade_no, entry.amount,
+                row.amount, entry.status, row.status)
+        elif entry.status != row.status:
+            yield Mismatch(STATUS_DIFFERS, row.trade_no, entry.amount,
+                row.amount, entry.status, row.status)
+
+    for trade_no in sorted(unseen):
+        entry = index[trade_no]
+        yield Mismatch(MISSING_IN_STATEMENT, trade_no, entry.amount, None,
+            entry.status, None)
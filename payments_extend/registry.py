@@ -0,0 +1,67 @@
+"""process-wide registry of configured providers
+
+provider_factory of django-payments builds a new provider (and re-reads
+settings) on every call. get_provider builds the provider of a variant once
+and shares it, providers keep no per-request state so they are safe to use
+from any thread
+
+    provider = get_provider(payment.variant)
+
+a provider is rebuilt when its PAYMENT_VARIANTS entry changes.
+"""
+import copy
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+
+_providers = {}
+_lock = threading.Lock()
+
+
+def _build_provider(config):
+    handler, options = config
+    provider_class = import_string(handler)
+    # providers pop their own options, keep settings untouched
+    return provider_class(**copy.deepcopy(options))
+
+
+def get_provider(variant):
+    """return the shared provider of a payment variant
+    """
+    variants = getattr(settings, 'PAYMENT_VARIANTS', {})
+    config = variants.get(variant, None)
+
+    if config is None:
+        raise ValueError('Payment variant does not exist: {}'.format(variant))
+
+    entry = _providers.get(variant, None)
+    if entry is not None and entry[0] == config:
+        return entry[1]
+
+    with _lock:
+        entry = _providers.get(variant, None)
+        if entry is not None and entry[0] == config:
+            return entry[1]
+
+        provider = _build_provider(config)
+        _providers[variant] = (copy.deepcopy(config), provider)
+
+    return provider
+
+
+def clear_providers():
+    """drop all built providers, they will be built again when needed
+    """
+    with _lock:
+        _providers.clear()
+
+
+def _on_setting_changed(setting, **kwargs):
+    if setting == 'PAYMENT_VARIANTS':
+        clear_providers()
+
+
+setting_changed.connect(_on_setting_changed)
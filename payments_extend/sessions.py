@@ -0,0 +1,296 @@
+"""pooled, keep-alive http sessions for talking to cash flow merchants
+
+Every provider asks for its session with get_session(name, ...). Sessions
+are built once per (name, options) and shared by the whole process, so the
+TCP+TLS handshake is paid only once per pooled connection instead of once
+per gateway call.
+
+options can be given in PAYMENT_VARIANTS along with the provider settings
+
+    PAYMENT_VARIANTS = {
+        'paypal': ('payments_extend.paypal.PayPalExpressCheckoutProvider', {
+            'user': '...',
+            'pwd': '...',
+            'signature': '...',
+            'pool_size': 20,
+            'timeout': (3.05, 10),
+            'max_retries': 2,
+            'backoff_factor': 0.5,
+            'breaker_failure_rate': 0.5,
+        }),
+    }
+
+every session is guarded by the circuit breaker of its provider, see
+circuitbreaker for the breaker_* options. A breaker can be turned off with
+'circuit_breaker': False.
+
+the async provider API uses get_async_session which gives the aiohttp
+counterpart with the same options. aiohttp is an optional dependency
+
+    pip install django-payments-extend[async]
+"""
+import asyncio
+import threading
+import time
+import weakref
+from http.cookiejar import DefaultCookiePolicy
+
+from django.core.exceptions import ImproperlyConfigured
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from .circuitbreaker import BREAKER_OPTIONS
+from .circuitbreaker import get_breaker
+from .circuitbreaker import pop_breaker_options
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (3.05, 30)  # (connect, read) in seconds
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_BACKOFF_FACTOR = 0.3
+
+SESSION_OPTIONS = ('pool_size', 'timeout', 'max_retries', 'backoff_factor',
+    'circuit_breaker') + tuple(BREAKER_OPTIONS)
+
+_sessions = {}
+_async_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class GatewaySession(object):
+
+    """a thin wrapper of requests.Session with a connection pool, default
+    timeout and retry policy.
+
+    retry with backoff is applied on connection errors for every method, but
+    read errors and 5xx responses are only retried for idempotent methods
+    (urllib3 rule), so we never send a capture twice.
+
+    cookies are never kept. Gateways don't need them and this makes the
+    session safe to share across worker threads.
+
+    with a breaker, requests fail fast with GatewayUnavailable while it's
+    open, and errors, 5xx answers and slow calls are recorded to it.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+        max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+        breaker=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.breaker = breaker
+
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size,
+            pool_maxsize=pool_size, max_retries=retry)
+
+        self._session = requests.Session()
+        self._session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """send a request through the pool with the default timeout
+        """
+        kwargs.setdefault('timeout', self.timeout)
+
+        if self.breaker is None:
+            return self._session.request(method, url, **kwargs)
+
+        self.breaker.before()
+        started_at = time.monotonic()
+        ok = None
+        try:
+            response = self._session.request(method, url, **kwargs)
+            ok = response.status_code < 500
+            return response
+        except requests.RequestException:
+            ok = False
+            raise
+        finally:
+            # any other error is not the gateway's, the call is given back
+            if ok is None:
+                self.breaker.cancel()
+            else:
+                self.breaker.record(ok, time.monotonic() - started_at)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self._session.close()
+
+
+class AsyncGatewaySession(object):
+
+    """aiohttp counterpart of GatewaySession
+
+    an aiohttp ClientSession is bound to the event loop which creates it, so
+    one client (and its connection pool) is kept per running loop.
+
+    retry with backoff is applied when the connection can't be established.
+    Other connection errors are only retried for GET, the same rule as the
+    sync session. The breaker is used like the sync session does.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+        max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+        breaker=None):
+        if aiohttp is None:
+            raise ImproperlyConfigured('aiohttp is required for the async api')
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.breaker = breaker
+
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            self._client_timeout = aiohttp.ClientTimeout(
+                sock_connect=connect, sock_read=read)
+        else:
+            self._client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _get_client(self):
+        loop = asyncio.get_event_loop()
+        client = self._clients.get(loop)
+
+        if client is None or client.closed:
+            client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self._client_timeout,
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+            self._clients[loop] = client
+
+        return client
+
+    async def request_text(self, method, url, **kwargs):
+        """send a request through the pool and return the response body
+        """
+        if self.breaker is None:
+            status, text = await self._request(method, url, **kwargs)
+            return text
+
+        self.breaker.before()
+        started_at = time.monotonic()
+        ok = None
+        try:
+            status, text = await self._request(method, url, **kwargs)
+            ok = status < 500
+            return text
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+            raise
+        finally:
+            # e.g. CancelledError when the client went away
+            if ok is None:
+                self.breaker.cancel()
+            else:
+                self.breaker.record(ok, time.monotonic() - started_at)
+
+    async def _request(self, method, url, **kwargs):
+        client = self._get_client()
+        retryable = aiohttp.ClientConnectionError if method == 'GET' \
+            else aiohttp.ClientConnectorError
+
+        attempt = 0
+        while True:
+            try:
+                async with client.request(method, url, **kwargs) as response:
+                    return response.status, await response.text()
+            except retryable:
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+
+    async def get_text(self, url, **kwargs):
+        return await self.request_text('GET', url, **kwargs)
+
+    async def post_text(self, url, **kwargs):
+        return await self.request_text('POST', url, **kwargs)
+
+    async def close(self):
+        """close the client of the running loop
+        """
+        client = self._clients.pop(asyncio.get_event_loop(), None)
+        if client is not None:
+            await client.close()
+
+
+def _get_or_create(registry, session_class, name, options):
+    if isinstance(options.get('timeout'), list):
+        options['timeout'] = tuple(options['timeout'])
+
+    key = (name, tuple(sorted(options.items())))
+    session = registry.get(key)
+
+    if session is None:
+        with _sessions_lock:
+            session = registry.get(key)
+            if session is None:
+                options = dict(options)
+                breaker_options = pop_breaker_options(options)
+                if options.pop('circuit_breaker', True):
+                    options['breaker'] = get_breaker(name, **breaker_options)
+
+                session = session_class(**options)
+                registry[key] = session
+
+    return session
+
+
+def pop_session_options(kwargs):
+    """take the session options out of provider kwargs
+
+    BasicProvider only accepts a capture keyword argument, so providers
+    should pop these before calling super().__init__
+    """
+    return {key: kwargs.pop(key) for key in SESSION_OPTIONS if key in kwargs}
+
+
+def get_session(name, **options):
+    """return the shared session of the provider named name
+
+    a new session is built only the first time a (name, options) pair is
+    seen. It's thread-safe.
+    """
+    return _get_or_create(_sessions, GatewaySession, name, options)
+
+
+def get_async_session(name, **options):
+    """return the shared async session of the provider named name
+    """
+    return _get_or_create(_async_sessions, AsyncGatewaySession, name, options)
+
+
+def close_sessions():
+    """close all pooled connections, mainly for tests and worker shutdown
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,487 @@
+"""local stub of the allpay, alipay and paypal gateways for load testing
+
+it speaks just enough of every gateway for the whole checkout flow
+
+    allpay  POST /Cashier/AioCheckOut, POST /Cashier/QueryTradeInfo
+    alipay  GET /gateway.do (create_direct_pay_by_user, notify_verify,
+            single_trade_query)
+    paypal  POST /nvp (SetExpressCheckout, GetExpressCheckoutDetails,
+            DoExpressCheckoutPayment)
+
+requests are checked like the real gateways do (CheckMacValue, md5 sign,
+credentials; alipay is md5 only). A paid trade is notified back to its
+ReturnURL / notify_url with a signed callback, paypal returns go to
+RETURNURL like the browser of the buyer would. Point the providers to it
+
+    'allpay': ('payments_extend.allpay.AllPayProvider', {
+        ..., 'endpoint': 'http://127.0.0.1:8765/Cashier/AioCheckOut',
+        'query_endpoint': 'http://127.0.0.1:8765/Cashier/QueryTradeInfo'}),
+    'alipay': (..., {..., 'endpoint': 'http://127.0.0.1:8765/gateway.do'}),
+    'paypal': (..., {..., 'endpoint': 'http://127.0.0.1:8765/nvp',
+        'cmd_gateway': 'http://127.0.0.1:8765/webscr'}),
+
+and run it, the merchants are the test ones of benchmarks unless given in a
+json config file
+
+    python -m payments_extend.stubgateway --port 8765 --latency 0.05:0.2 \\
+        --error-rate 0.01
+
+latency (a fixed or min:max range of seconds) and error injection (503
+answers, dropped callbacks) apply to every request. GET /_stats gives the
+counters and callback latencies, for throughput measurement. It needs
+aiohttp (the async extra).
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import random
+import time
+import uuid
+from urllib.parse import urlencode
+from xml.sax.saxutils import escape
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:  # pragma: no cover
+    aiohttp = web = None
+
+
+DEFAULT_ALLPAY = {
+    'MerchantID': '2000132',
+    'HashKey': '5294y06JbISpM5x9',
+    'HashIV': 'v77hoKGq4kWxNNIS',
+}
+
+DEFAULT_ALIPAY = {
+    'partner': '2088101122136241',
+    'secret_key': '0123456789abcdef0123456789abcdef',
+}
+
+DEFAULT_PAYPAL = {
+    'user': 'user',
+    'pwd': 'pwd',
+    'signature': 'signature',
+}
+
+Trade = collections.namedtuple('Trade',
+    ['provider', 'trade_no', 'gateway_trade_no', 'amount', 'params',
+     'created_at'])
+
+
+def _now():
+    return datetime.datetime.now()
+
+
+def parse_latency(value):
+    """'0.05' or '0.05:0.2' -> (min, max) seconds
+    """
+    low, _, high = value.partition(':')
+    return float(low), float(high or low)
+
+
+class StubGateway(object):
+
+    """the state and handlers of the stub, trades are kept in memory
+    """
+
+    def __init__(self, allpay=None, alipay=None, paypal=None, latency=(0, 0),
+        error_rate=0.0, drop_callback_rate=0.0, callback_delay=0.0,
+        send_callbacks=True, seed=None):
+        from .alipay.signer import MD5Signer
+        from .allpay.signer import CheckMacValueSigner
+
+        self.allpay = dict(DEFAULT_ALLPAY, **(allpay or {}))
+        self.alipay = dict(DEFAULT_ALIPAY, **(alipay or {}))
+        self.paypal = dict(DEFAULT_PAYPAL, **(paypal or {}))
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_callback_rate = drop_callback_rate
+        self.callback_delay = callback_delay
+        self.send_callbacks = send_callbacks
+
+        self._allpay_signer = CheckMacValueSigner(self.allpay['HashKey'],
+            self.allpay['HashIV'])
+        self._alipay_signer = MD5Signer(self.alipay['secret_key'])
+
+        self._random = random.Random(seed)
+        self._trades = {}
+        self._notify_ids = set()
+        self._paypal_tokens = {}
+        self._client = None
+        self._callbacks = set()
+
+        self.stats = collections.Counter()
+        self.callback_latencies = []
+
+    # plumbing
+
+    def make_app(self):
+        @web.middleware
+        async def inject(request, handler):
+            return await self._inject(request, handler)
+
+        app = web.Application(middlewares=[inject])
+        app.router.add_post('/Cashier/AioCheckOut', self.allpay_checkout)
+        app.router.add_post('/Cashier/QueryTradeInfo', self.allpay_query)
+        app.router.add_get('/gateway.do', self.alipay_gateway)
+        app.router.add_post('/nvp', self.paypal_nvp)
+        app.router.add_route('*', '/webscr', self.paypal_webscr)
+        app.router.add_get('/_stats', self.get_stats)
+        app.on_cleanup.append(self._close)
+        return app
+
+    async def _inject(self, request, handler):
+        """latency and 503 errors of every request but /_stats
+        """
+        if request.path == '/_stats':
+            return await handler(request)
+
+        self.stats['requests'] += 1
+
+        low, high = self.latency
+        if high:
+            await asyncio.sleep(self._random.uniform(low, high))
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats['injected_errors'] += 1
+            return web.Response(status=503, text='stub gateway error')
+
+        return await handler(request)
+
+    async def _close(self, app):
+        for task in list(self._callbacks):
+            task.cancel()
+        if self._client is not None:
+            await self._client.close()
+
+    def _schedule_callback(self, method, url, data):
+        if not self.send_callbacks or not url:
+            return
+
+        if self.drop_callback_rate and \
+            self._random.random() < self.drop_callback_rate:
+            self.stats['dropped_callbacks'] += 1
+            return
+
+        task = asyncio.ensure_future(self._callback(method, url, data))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    async def _callback(self, method, url, data):
+        if self.callback_delay:
+            await asyncio.sleep(self.callback_delay)
+
+        if self._client is None:
+            self._client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100),
+                cookie_jar=aiohttp.DummyCookieJar())
+
+        started_at = time.perf_counter()
+        try:
+            if method == 'GET':
+                response = await self._client.get(url, params=data,
+                    allow_redirects=False)
+            else:
+                response = await self._client.post(url, data=data,
+                    allow_redirects=False)
+            async with response:
+                await response.read()
+                self.stats['callbacks_{}'.format(response.status)] += 1
+        except aiohttp.ClientError:
+            self.stats['callback_errors'] += 1
+            return
+
+        self.callback_latencies.append(time.perf_counter() - started_at)
+
+    def _add_trade(self, provider, trade_no, amount, params):
+        trade = Trade(provider, trade_no, uuid.uuid4().hex[:20], amount,
+            params, _now())
+        self._trades[(provider, trade_no)] = trade
+        self.stats['{}_trades'.format(provider)] += 1
+        return trade
+
+    async def get_stats(self, request):
+        latencies = sorted(self.callback_latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+        return web.json_response({
+            'counters': dict(self.stats),
+            'trades': len(self._trades),
+            'callback_latency': {
+                'count': len(latencies),
+                'p50': percentile(0.5),
+                'p90': percentile(0.9),
+                'p99': percentile(0.99),
+            },
+        })
+
+    # allpay
+
+    async def allpay_checkout(self, request):
+        params = dict(await request.post())
+
+        if params.get('MerchantID') != self.allpay['MerchantID'] or \
+            not self._allpay_signer.verify(params):
+            self.stats['allpay_bad_requests'] += 1
+            return web.Response(status=400, text='CheckMacValue Error')
+
+        trade = self._add_trade('allpay', params['MerchantTradeNo'],
+            params.get('TotalAmount', '0'), params)
+
+        notify = {
+            'MerchantID': self.allpay['MerchantID'],
+            'MerchantTradeNo': trade.trade_no,
+            'RtnCode': '1',
+            'RtnMsg': 'Succeeded',
+            'TradeNo': trade.gateway_trade_no,
+            'TradeAmt': trade.amount,
+            'PaymentDate': trade.created_at.strftime('%Y/%m/%d %H:%M:%S'),
+            'PaymentType': '{}_stub'.format(params.get('ChoosePayment', 'ALL')),
+            'PaymentTypeChargeFee': '0',
+            'TradeDate': params.get('MerchantTradeDate', ''),
+            'SimulatePaid': '1',
+        }
+        notify['CheckMacValue'] = self._allpay_signer.sign(notify)
+        self._schedule_callback('POST', params.get('ReturnURL'), notify)
+
+        return web.Response(text='paid {}'.format(trade.trade_no))
+
+    async def allpay_query(self, request):
+        params = dict(await request.post())
+
+        if not self._allpay_signer.verify(params):
+            return web.Response(status=400, text='CheckMacValue Error')
+
+        trade = self._trades.get(('allpay', params.get('MerchantTradeNo')), None)
+
+        result = {
+            'MerchantID': self.allpay['MerchantID'],
+            'MerchantTradeNo': params.get('MerchantTradeNo', ''),
+            'TradeNo': trade.gateway_trade_no if trade else '',
+            'TradeAmt': trade.amount if trade else '0',
+            'PaymentDate': trade.created_at.strftime('%Y/%m/%d %H:%M:%S')
+                if trade else '',
+            'PaymentType': 'Credit_CreditCard',
+            'HandlingCharge': '0',
+            'PaymentTypeChargeFee': '0',
+            'TradeDate': trade.params.get('MerchantTradeDate', '') if trade else '',
+            'TradeStatus': '1' if trade else '0',
+            'ItemName': trade.params.get('ItemName', '') if trade else '',
+        }
+        result['CheckMacValue'] = self._allpay_signer.sign(result)
+
+        return web.Response(text=urlencode(result))
+
+    # alipay
+
+    def _alipay_sign(self, params):
+        return dict(params, sign_type='MD5', sign=self._alipay_signer.sign(params))
+
+    async def alipay_gateway(self, request):
+        params = dict(request.query)
+        service = params.get('service', '')
+
+        if service == 'notify_verify':
+            valid = params.get('notify_id') in self._notify_ids
+            return web.Response(text='true' if valid else 'false')
+
+        sign = params.get('sign', None)
+        if params.get('partner') != self.alipay['partner'] or \
+            not self._alipay_signer.verify(params, sign):
+            self.stats['alipay_bad_requests'] += 1
+            return self._alipay_xml('F', error='ILLEGAL_SIGN')
+
+        if service == 'create_direct_pay_by_user':
+            return self._alipay_pay(params)
+        if service == 'single_trade_query':
+            return self._alipay_query(params)
+
+        return self._alipay_xml('F', error='ILLEGAL_SERVICE')
+
+    def _alipay_pay(self, params):
+        trade = self._add_trade('alipay', params['out_trade_no'],
+            params.get('total_fee', '0'), params)
+
+        notify_id = uuid.uuid4().hex
+        self._notify_ids.add(notify_id)
+
+        notify = self._alipay_sign({
+            'notify_time': _now().strftime('%Y-%m-%d %H:%M:%S'),
+            'notify_type': 'trade_status_sync',
+            'notify_id': notify_id,
+            'out_trade_no': trade.trade_no,
+            'subject': params.get('subject', ''),
+            'payment_type': params.get('payment_type', '1'),
+            'trade_no': trade.gateway_trade_no,
+            'trade_status': 'TRADE_SUCCESS',
+            'seller_id': params.get('seller_id', self.alipay['partner']),
+            'buyer_email': 'buyer@example.com',
+            'total_fee': trade.amount,
+            'gmt_create': trade.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'gmt_payment': trade.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        })
+        self._schedule_callback('POST', params.get('notify_url'), notify)
+
+        return web.Response(text='paid {}'.format(trade.trade_no))
+
+    def _alipay_query(self, params):
+        trade = self._trades.get(('alipay', params.get('out_trade_no')), None)
+        if trade is None:
+            return self._alipay_xml('F', error='TRADE_NOT_EXIST')
+
+        fields = self._alipay_sign({
+            'out_trade_no': trade.trade_no,
+            'trade_no': trade.gateway_trade_no,
+            'trade_status': 'TRADE_SUCCESS',
+            'total_fee': trade.amount,
+            'subject': trade.params.get('subject', ''),
+            'gmt_create': trade.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        })
+        sign, sign_type = fields.pop('sign'), fields.pop('sign_type')
+
+        return self._alipay_xml('T', fields=fields, sign=sign,
+            sign_type=sign_type)
+
+    def _alipay_xml(self, is_success, error=None, fields=None, sign=None,
+        sign_type=None):
+        parts = ['<?xml version="1.0" encoding="utf-8"?><alipay>',
+            '<is_success>{}</is_success>'.format(is_success)]
+
+        if error is not None:
+            parts.append('<error>{}</error>'.format(escape(error)))
+
+        if fields is not None:
+            parts.append('<response><trade>')
+            parts.extend('<{0}>{1}</{0}>'.format(key, escape(str(value)))
+                for key, value in sorted(fields.items()))
+            parts.append('</trade></response>')
+            parts.append('<sign>{}</sign><sign_type>{}</sign_type>'.format(
+                sign, sign_type))
+
+        parts.append('</alipay>')
+        return web.Response(text=''.join(parts), content_type='text/xml')
+
+    # paypal
+
+    def _nvp(self, **fields):
+        fields.setdefault('ACK', 'Success')
+        fields.setdefault('VERSION', '124')
+        fields['CORRELATIONID'] = uuid.uuid4().hex[:13]
+        fields['TIMESTAMP'] = datetime.datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%SZ')
+        return web.Response(text=urlencode(fields))
+
+    def _nvp_failure(self, code, message):
+        return self._nvp(ACK='Failure', L_ERRORCODE0=code,
+            L_SHORTMESSAGE0=message, L_LONGMESSAGE0=message,
+            L_SEVERITYCODE0='Error')
+
+    async def paypal_nvp(self, request):
+        params = dict(await request.post())
+
+        if (params.get('USER'), params.get('PWD'), params.get('SIGNATURE')) != \
+            (self.paypal['user'], self.paypal['pwd'], self.paypal['signature']):
+            self.stats['paypal_bad_requests'] += 1
+            return self._nvp_failure('10002', 'Security header is not valid')
+
+        method = params.get('METHOD', '')
+
+        if method == 'SetExpressCheckout':
+            token = 'EC-{}'.format(uuid.uuid4().hex[:17].upper())
+            self._paypal_tokens[token] = params
+            self.stats['paypal_tokens'] += 1
+            return self._nvp(TOKEN=token)
+
+        checkout = self._paypal_tokens.get(params.get('TOKEN'), None)
+        if checkout is None:
+            return self._nvp_failure('10410', 'Invalid token')
+
+        if method == 'GetExpressCheckoutDetails':
+            return self._nvp(TOKEN=params['TOKEN'], PAYERID='STUBPAYER',
+                CHECKOUTSTATUS='PaymentActionNotInitiated',
+                PAYMENTREQUEST_0_AMT=checkout.get('PAYMENTREQUEST_0_AMT', '0'))
+
+        if method == 'DoExpressCheckoutPayment':
+            trade = self._add_trade('paypal', params['TOKEN'],
+                params.get('PAYMENTREQUEST_0_AMT', '0'), params)
+            return self._nvp(TOKEN=params['TOKEN'],
+                PAYMENTINFO_0_TRANSACTIONID=trade.gateway_trade_no,
+                PAYMENTINFO_0_AMT=trade.amount,
+                PAYMENTINFO_0_PAYMENTSTATUS='Completed',
+                PAYMENTINFO_0_ACK='Success')
+
+        return self._nvp_failure('81002', 'Unspecified Method')
+
+    async def paypal_webscr(self, request):
+        """the paypal login page, the buyer approves at once and is sent
+        back to RETURNURL
+        """
+        data = dict(request.query)
+        data.update(await request.post())
+
+        token = data.get('token', '')
+        checkout = self._paypal_tokens.get(token, None)
+        if checkout is None:
+            return web.Response(status=400, text='Invalid token')
+
+        self._schedule_callback('GET', checkout.get('RETURNURL'),
+            {'token': token, 'PayerID': 'STUBPAYER'})
+
+        return web.Response(text='approved {}'.format(token))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m payments_extend.stubgateway')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--config', default=None,
+        help='json file with allpay, alipay and paypal merchant settings')
+    parser.add_argument('--latency', type=parse_latency, default=(0, 0),
+        help='seconds added to every answer, fixed or min:max')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='ratio of requests answered with 503')
+    parser.add_argument('--drop-callback-rate', type=float, default=0.0,
+        help='ratio of notifies never sent')
+    parser.add_argument('--callback-delay', type=float, default=0.0)
+    parser.add_argument('--no-callbacks', action='store_true', default=False)
+    parser.add_argument('--seed', type=int, default=None)
+    options = parser.parse_args(argv)
+
+    if web is None:
+        parser.error('aiohttp is required, pip install django-payments-extend[async]')
+
+    from django.conf import settings
+    if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        settings.configure()
+
+    merchants = {}
+    if options.config:
+        with open(options.config) as f:
+            merchants = json.load(f)
+
+    gateway = StubGateway(
+        allpay=merchants.get('allpay'),
+        alipay=merchants.get('alipay'),
+        paypal=merchants.get('paypal'),
+        latency=options.latency,
+        error_rate=options.error_rate,
+        drop_callback_rate=options.drop_callback_rate,
+        callback_delay=options.callback_delay,
+        send_callbacks=not options.no_callbacks,
+        seed=options.seed,
+    )
+
+    web.run_app(gateway.make_app(), host=options.host, port=options.port)
+
+
+if __name__ == '__main__':
+    main()
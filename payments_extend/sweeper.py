@@ -0,0 +1,89 @@
+"""sweep pending payments by querying their trades from the providers
+
+notifies get lost (merchant down, network, ...), the sweeper asks the
+provider about every pending payment and applies what it says
+
+    for swept in sweep(payments, provider.query_trade_info, resolve):
+        print(swept)
+
+queries run concurrently in worker threads, the status changes (and so
+all the ORM work) happen in the calling thread, each in its own
+transaction so a notify never waits for more than one payment. Every
+payment is read again and locked before its status changes, a payment a
+notify changed meanwhile is left as it is. Pass a
+concurrency.AdaptiveBackoff to slow the queries down while the gateway
+fails.
+"""
+import collections
+
+from django.db import transaction
+
+from .concurrency import map_concurrently
+from .instrumentation import STATUS_CHANGE
+from .instrumentation import timed
+from .lookups import lock_payment
+
+
+PENDING_STATUSES = ('waiting', 'input')
+
+Swept = collections.namedtuple('Swept', ['payment', 'result', 'status', 'error'])
+
+
+def _change_status(payment, swept):
+    payment.change_status(swept.status)
+
+
+def _apply(swept, statuses, lookups, change):
+    try:
+        with transaction.atomic():
+            payment = lock_payment(type(swept.payment)._default_manager,
+                pk=swept.payment.pk, **lookups)
+
+            if payment is None or payment.status not in statuses:
+                # e.g. confirmed by a notify since the sweep read it
+                return swept._replace(status=None)
+
+            with timed(payment.variant, STATUS_CHANGE):
+                change(payment, swept)
+    except Exception as e:
+        return swept._replace(error=e)
+
+    return swept._replace(payment=payment)
+
+
+def sweep(payments, query, resolve, workers=4, key_field='tradeNo',
+    dry_run=False, backoff=None, statuses=PENDING_STATUSES, lookups=None,
+    change=_change_status):
+    """query the trade of every payment and change its status
+
+    query is called with the trade number (key_field of payment) in a
+    worker thread. resolve(payment, result) returns the new status of
+    payment or None to leave it as is. yield a Swept per payment, a payment
+    whose status changes is yielded once it's committed, with status None
+    if it was no longer in statuses (or no longer matches lookups), or with
+    the error of the change (the change is rolled back, the sweep goes on).
+
+    change(payment, swept) changes the locked payment, its default calls
+    payment.change_status(swept.status).
+    """
+    def query_payment(payment):
+        trade_no = getattr(payment, key_field)
+        if backoff is None:
+            return query(trade_no)
+        return backoff.call(query, trade_no)
+
+    for outcome in map_concurrently(query_payment, payments, workers=workers):
+        payment = outcome.item
+
+        if outcome.error is not None:
+            yield Swept(payment, None, None, outcome.error)
+            continue
+
+        status = resolve(payment, outcome.result)
+        swept = Swept(payment, outcome.result, status, None)
+
+        if status is None or status == payment.status or dry_run:
+            yield swept
+            continue
+
+        yield _apply(swept, statuses, lookups or {}, change)
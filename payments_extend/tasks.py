@@ -0,0 +1,86 @@
+"""run work (e.g. paypal capture) out of the request
+
+    enqueue('payments_extend.paypal.tasks.capture_payment', payment.pk,
+        token)
+
+tasks are referred by dotted path and take simple arguments, so a task
+queue backend only has to send them over. The backend is set with
+
+    PAYMENTS_EXTEND_TASK_BACKEND = (
+        'payments_extend.tasks.ThreadPoolBackend', {'max_workers': 4})
+
+ThreadPoolBackend (default) runs tasks in a thread pool of the process,
+ImmediateBackend runs them at once in the caller, for tests and local
+runs. Another backend only needs an enqueue(path, *args, **kwargs) method.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+# installed as payments_extend or under another name (e.g. cnpayments)
+DEFAULT_TASK_BACKEND = (__name__ + '.ThreadPoolBackend', {})
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def run_task(path, *args, **kwargs):
+    """import and call the task, the database connection of the thread is
+    closed afterwards if it's too old or broken
+    """
+    try:
+        return import_string(path)(*args, **kwargs)
+    except Exception:
+        logger.exception('task %s failed', path)
+        raise
+    finally:
+        close_old_connections()
+
+
+class ImmediateBackend(object):
+
+    def enqueue(self, path, *args, **kwargs):
+        return run_task(path, *args, **kwargs)
+
+
+class ThreadPoolBackend(object):
+
+    """tasks are lost if the process exits before they run, a sweep must
+    pick up what they left (e.g. sweep_paypal_captures)
+    """
+
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix='payments-extend-task')
+
+    def enqueue(self, path, *args, **kwargs):
+        return self._executor.submit(run_task, path, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def get_task_backend():
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path, options = getattr(settings, 'PAYMENTS_EXTEND_TASK_BACKEND',
+                    DEFAULT_TASK_BACKEND)
+                _backend = import_string(path)(**options)
+
+    return _backend
+
+
+def enqueue(path, *args, **kwargs):
+    """hand the task path(*args, **kwargs) to the task backend
+    """
+    return get_task_backend().enqueue(path, *args, **kwargs)
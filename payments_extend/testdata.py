@@ -0,0 +1,59 @@
+"""data of the allpay test merchant shared by the tests and the benchmarks
+"""
+
+
+# allpay test merchant, see AllPayProvider docstring
+ALLPAY_TEST_MERCHANT = {
+    'MerchantID': '2000132',
+    'HashKey': '5294y06JbISpM5x9',
+    'HashIV': 'v77hoKGq4kWxNNIS',
+}
+
+# golden vectors, CheckMacValue produced by md5 of
+# AllPayProvider._encode_param with the test merchant
+CHECK_MAC_VALUE_VECTORS = [
+    ({
+        'MerchantID': '2000132',
+        'PaymentType': 'aio',
+        'ReturnURL': 'http://example.com/allpay_asynchro_notify',
+        'OrderResultURL': 'http://example.com/allpay_synchro_notify',
+        'MerchantTradeNo': 'T20160101000001',
+        'MerchantTradeDate': '2016/01/01 12:00:00',
+        'TotalAmount': 100,
+        'TradeDesc': 'lbstek',
+        'ItemName': 'Apple',
+        'ChoosePayment': 'ALL',
+    }, '1650CA81C717EBDA3DD1977CBD115487'),
+    ({
+        'MerchantID': '2000132',
+        'PaymentType': 'aio',
+        'ReturnURL': 'http://example.com/notify?a=1&b=2',
+        'OrderResultURL': '',
+        'MerchantTradeNo': 'T20160101000002',
+        'MerchantTradeDate': '2016/01/01 12:00:00',
+        'TotalAmount': 1050,
+        'TradeDesc': 'lbstek',
+        'ItemName': '商品A#商品B (限量)!*',
+        'AlipayItemName': '商品A#商品B (限量)!*',
+        'AlipayItemCounts': '1#3',
+        'AlipayItemPrice': '50#1000',
+        'Email': 'buyer+1@example.com',
+        'PhoneNo': '0912345678',
+        'UserName': '王 小明',
+        'ChoosePayment': 'Alipay',
+    }, '9DCE0C1D4C8414210D4C33E4440A5F33'),
+    ({
+        'MerchantID': '2000132',
+        'MerchantTradeNo': 'T20160101000002',
+        'RtnCode': '1',
+        'RtnMsg': 'Succeeded',
+        'TradeNo': '1601011200000001',
+        'TradeAmt': '1050',
+        'PaymentDate': '2016/01/01 12:05:00',
+        'PaymentType': 'Alipay_Alipay',
+        'PaymentTypeChargeFee': '0',
+        'TradeDate': '2016/01/01 12:00:00',
+        'SimulatePaid': '0',
+        'CheckMacValue': 'IGNORED',
+    }, 'E0BC3D135CF76291CC08913997C3DB58'),
+]
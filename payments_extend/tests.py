@@ -1,3 +1,644 @@
+import datetime
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+from unittest import mock
+
+import requests
+from django.core.management import call_command
+from django.db import connection
+from django.db import transaction
+from django.http import HttpResponse
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from saleor.order.models import Order
+from saleor.order.models import Payment
+from saleor.userprofile.models import Address
+
+from . import archive
+from . import circuitbreaker
+from . import tasks
+from . import views
+from .alipay import AliPayProvider
+from .allpay import AllPayProvider
+from .checkout import get_checkout_snapshot
+from .circuitbreaker import CircuitBreaker
+from .circuitbreaker import GatewayUnavailable
+from .lookups import get_payment
+from .lookups import load_payment
+from .lookups import lock_payment
+from .management.commands import sweep_paypal_captures
+from .models import CashFlowLog
+from .models import extract_fields
+from .paypal import tasks as paypal_tasks
+from .paypal.nvp import NVPResponse
+from .sweeper import sweep
+from .testdata import ALLPAY_TEST_MERCHANT
+from .testdata import CHECK_MAC_VALUE_VECTORS
+
+
+def make_payment(variant='allpay', status='waiting', **kwargs):
+    """a payment of a new order billed to Wang Xiaoming
+    """
+    address = Address.objects.create(first_name='Xiaoming', last_name='Wang',
+        street_address_1='No. 1, Section 1', city='Taipei', postal_code='100',
+        country='TW')
+    order = Order.objects.create(billing_address=address,
+        user_email='buyer@example.com')
+    return Payment.objects.create(order=order, variant=variant, status=status,
+        total=100, currency='TWD', billing_first_name='Xiaoming',
+        billing_last_name='Wang', billing_email='buyer@example.com', **kwargs)
+
+
+class PaymentLookupQueriesTest(TestCase):
+
+    """every lookup is one query, the related rows come with the payment
+    """
+
+    def setUp(self):
+        self.payment = make_payment(tradeNo='T20160101000001')
+
+    def test_get_payment(self):
+        with self.assertNumQueries(1):
+            payment = get_payment(Payment.objects, tradeNo='T20160101000001')
+            payment.order.status
+
+        self.assertEqual(payment.pk, self.payment.pk)
+
+    def test_get_payment_not_found(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_payment(Payment.objects, tradeNo='missing'))
+
+    def test_lock_payment(self):
+        with transaction.atomic():
+            with self.assertNumQueries(1):
+                payment = lock_payment(Payment.objects, pk=self.payment.pk)
+                payment.order.status
+
+    def test_load_payment(self):
+        with self.assertNumQueries(1):
+            payment = load_payment(Payment.objects, token=self.payment.token)
+            payment.order.user
+
+
+class DirectToPayQueriesTest(TestCase):
+
+    """direct_to_pay reads the payment once, the provider gets it with its
+    order and buyer
+    """
+
+    def setUp(self):
+        self.payment = make_payment()
+        self.request = RequestFactory().get('/')
+
+    @mock.patch.object(views, 'render', return_value=HttpResponse())
+    @mock.patch.object(views, 'get_provider')
+    def test_one_query(self, get_provider, render):
+        provider = get_provider.return_value
+
+        def process_data(payment, request):
+            payment.order.user
+
+        provider.process_data.side_effect = process_data
+
+        with self.assertNumQueries(1):
+            views.direct_to_pay(self.request, self.payment.token)
+
+        get_provider.assert_called_once_with('allpay')
+
+
+class SweepTest(TestCase):
+
+    """every status change is committed on its own, a failing one doesn't
+    stop the sweep
+    """
+
+    def setUp(self):
+        self.payments = [make_payment(tradeNo='T20160101000001'),
+            make_payment(tradeNo='T20160101000002')]
+
+    def sweep(self):
+        swept = sweep(self.payments, lambda trade_no: trade_no,
+            lambda payment, result: 'confirmed', workers=1)
+        return {swept.payment.tradeNo: swept for swept in swept}
+
+    def test_failed_change(self):
+        change_status = Payment.change_status
+
+        def fail_first(payment, status):
+            if payment.tradeNo == 'T20160101000001':
+                raise ValueError('change failed')
+            change_status(payment, status)
+
+        with mock.patch.object(Payment, 'change_status', autospec=True,
+            side_effect=fail_first):
+            swept = self.sweep()
+
+        self.assertIsInstance(swept['T20160101000001'].error, ValueError)
+        self.assertIsNone(swept['T20160101000002'].error)
+        self.assertEqual(Payment.objects.get(
+            tradeNo='T20160101000001').status, 'waiting')
+        self.assertEqual(Payment.objects.get(
+            tradeNo='T20160101000002').status, 'confirmed')
+
+    def test_changed_meanwhile(self):
+        Payment.objects.filter(tradeNo='T20160101000001').update(
+            status='rejected')
+
+        swept = self.sweep()
+
+        self.assertIsNone(swept['T20160101000001'].status)
+        self.assertEqual(Payment.objects.get(
+            tradeNo='T20160101000001').status, 'rejected')
+        self.assertEqual(swept['T20160101000002'].status, 'confirmed')
+
+
+DETAILS = ('ACK=Success&TOKEN=EC-1&PAYERID=PAYER1'
+    '&CHECKOUTSTATUS=PaymentActionNotInitiated')
+CAPTURED = 'ACK=Success&PAYMENTINFO_0_TRANSACTIONID=TX1'
+
+
+def mock_paypal(*answers):
+    """a paypal provider answering GetExpressCheckoutDetails with DETAILS
+    and the DoExpressCheckoutPayment calls with answers in turn, an answer
+    is a nvp text, an exception to raise or a callable returning either
+    """
+    paypal = mock.Mock()
+    paypal.getExpressCheckoutDetails.return_value = 'details'
+    paypal.doExpressCheckoutPayment.return_value = 'capture'
+    answers = list(answers)
+
+    def get_nvp_response(body):
+        answer = DETAILS if body == 'details' else answers.pop(0)
+        if callable(answer):
+            answer = answer()
+        if isinstance(answer, Exception):
+            raise answer
+        return NVPResponse(answer)
+
+    paypal.get_nvp_response.side_effect = get_nvp_response
+    return paypal
+
+
+def capture_calls(paypal):
+    return [call for call in paypal.get_nvp_response.call_args_list
+        if call[0][0] == 'capture']
+
+
+@mock.patch.object(tasks, '_backend', tasks.ImmediateBackend())
+@mock.patch.object(paypal_tasks.AdaptiveBackoff, 'wait')
+class PayPalCaptureTest(TransactionTestCase):
+
+    """a capture is sent once unless it surely didn't reach paypal, a
+    captured payment is always confirmed
+    """
+
+    def setUp(self):
+        self.payment = make_payment(variant='paypal')
+
+    def capture(self, paypal):
+        with mock.patch.object(paypal_tasks, 'get_provider',
+            return_value=paypal):
+            self.assertTrue(paypal_tasks.start_capture(self.payment, 'EC-1'))
+
+        return Payment.objects.get(pk=self.payment.pk)
+
+    def test_captured(self, wait):
+        paypal = mock_paypal(CAPTURED)
+        payment = self.capture(paypal)
+
+        self.assertEqual(payment.status, 'confirmed')
+        self.assertEqual(payment.transaction_id, 'TX1')
+        self.assertEqual(len(capture_calls(paypal)), 1)
+
+    def test_reload_doesnt_capture_again(self, wait):
+        self.capture(mock_paypal(CAPTURED))
+
+        self.assertFalse(paypal_tasks.start_capture(self.payment, 'EC-1'))
+
+    def test_not_sent_is_retried(self, wait):
+        paypal = mock_paypal(requests.ConnectTimeout(), CAPTURED)
+        payment = self.capture(paypal)
+
+        self.assertEqual(payment.status, 'confirmed')
+        self.assertEqual(len(capture_calls(paypal)), 2)
+
+    def test_never_sent(self, wait):
+        paypal = mock_paypal(*[requests.ConnectTimeout()] * 3)
+        payment = self.capture(paypal)
+
+        self.assertEqual(payment.status, 'input')
+
+    def test_unknown_capture_is_not_sent_again(self, wait):
+        paypal = mock_paypal(requests.ReadTimeout())
+        payment = self.capture(paypal)
+
+        self.assertEqual(payment.status, 'preauth')
+        self.assertTrue(payment.attrs.capture_unknown)
+        self.assertEqual(len(capture_calls(paypal)), 1)
+
+    def test_declined(self, wait):
+        payment = self.capture(mock_paypal('ACK=Failure&L_ERRORCODE0=10486'))
+
+        self.assertEqual(payment.status, 'input')
+
+    def test_captured_after_sweep(self, wait):
+        def sweep_meanwhile():
+            Payment.objects.filter(pk=self.payment.pk).update(status='input')
+            return CAPTURED
+
+        payment = self.capture(mock_paypal(sweep_meanwhile))
+
+        self.assertEqual(payment.status, 'confirmed')
+        self.assertEqual(payment.transaction_id, 'TX1')
+
+    def test_late_capture_is_touched(self, wait):
+        # enqueued long ago (a backlog of tasks), the sweep must see it run
+        Payment.objects.filter(pk=self.payment.pk).update(status='preauth',
+            transaction_id='EC-1',
+            modified=timezone.now() - datetime.timedelta(hours=1))
+        modified = []
+
+        def capture():
+            modified.append(Payment.objects.get(pk=self.payment.pk).modified)
+            return CAPTURED
+
+        with mock.patch.object(paypal_tasks, 'get_provider',
+            return_value=mock_paypal(capture)):
+            paypal_tasks.capture_payment(self.payment.pk, 'EC-1')
+
+        self.assertGreater(modified[0],
+            timezone.now() - datetime.timedelta(minutes=1))
+
+
+@mock.patch.object(paypal_tasks.AdaptiveBackoff, 'wait')
+class SweepPayPalCapturesTest(TransactionTestCase):
+
+    """the sweep resolves payments left in preauth, not running captures
+    """
+
+    def setUp(self):
+        self.payment = make_payment(variant='paypal', status='preauth',
+            transaction_id='EC-1')
+        Payment.objects.filter(pk=self.payment.pk).update(
+            modified=timezone.now() - datetime.timedelta(hours=1))
+
+    def sweep(self, answer):
+        paypal = mock.Mock()
+        paypal.get_nvp_response.side_effect = lambda body: NVPResponse(
+            answer() if callable(answer) else answer)
+
+        with mock.patch.object(sweep_paypal_captures, 'get_provider',
+            return_value=paypal):
+            call_command('sweep_paypal_captures', workers=1,
+                stdout=io.StringIO(), stderr=io.StringIO())
+
+        return Payment.objects.get(pk=self.payment.pk)
+
+    def test_completed(self, wait):
+        payment = self.sweep('ACK=Success&CHECKOUTSTATUS=PaymentActionCompleted'
+            '&PAYMENTREQUEST_0_TRANSACTIONID=TX1')
+
+        self.assertEqual(payment.status, 'confirmed')
+        self.assertEqual(payment.transaction_id, 'TX1')
+
+    def test_not_captured(self, wait):
+        payment = self.sweep(DETAILS)
+
+        self.assertEqual(payment.status, 'input')
+
+    def test_capture_started_meanwhile(self, wait):
+        def start_capture():
+            paypal_tasks._claim(Payment, self.payment.pk)
+            return DETAILS
+
+        payment = self.sweep(start_capture)
+
+        self.assertEqual(payment.status, 'preauth')
+
+
+class ExtractFieldsTest(SimpleTestCase):
+
+    """only amounts which fit the amount column are kept
+    """
+
+    def amount(self, value):
+        return extract_fields({'TradeAmt': value})['amount']
+
+    def test_amount(self):
+        self.assertEqual(self.amount('1050'), Decimal('1050.00'))
+        self.assertEqual(self.amount('10.505'), Decimal('10.50'))
+        self.assertEqual(self.amount('9999999999.99'),
+            Decimal('9999999999.99'))
+
+    def test_not_an_amount(self):
+        for value in ('', 'abc', 'NaN', 'sNaN', 'Infinity', '-Infinity',
+            '10000000000', '9999999999.999', '1e30'):
+            with self.subTest(value):
+                self.assertIsNone(self.amount(value))
+
+
+class ArchiveTest(TestCase):
+
+    """a batch is a complete part file or none, a damaged file doesn't
+    hide the others
+    """
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+        created_at = timezone.now() - datetime.timedelta(days=100)
+        for trade_no in ('T1', 'T2', 'T3'):
+            CashFlowLog.objects.create(created_at=created_at,
+                trade_no=trade_no, json_res='{}')
+
+    def archive(self):
+        return archive.archive_logs(timezone.now(),
+            archive_dir=self.archive_dir, batch_size=2)
+
+    def archived_trade_nos(self):
+        return sorted(row['trade_no'] for row in
+            archive.iter_archived_logs(archive_dir=self.archive_dir))
+
+    def test_archive(self):
+        self.assertEqual(self.archive(), 3)
+
+        self.assertEqual(len(list(archive.iter_archive_days(
+            self.archive_dir))), 2)
+        self.assertEqual(self.archived_trade_nos(), ['T1', 'T2', 'T3'])
+        self.assertFalse(CashFlowLog.objects.exists())
+
+    def test_damaged_part(self):
+        self.archive()
+        (_day, path), _ = archive.iter_archive_days(self.archive_dir)
+
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+
+        self.assertEqual(self.archived_trade_nos(), ['T3'])
+
+    def test_failed_write(self):
+        with mock.patch.object(archive.gzip.GzipFile, 'write',
+            side_effect=OSError('no space left on device')):
+            with self.assertRaises(OSError):
+                self.archive()
+
+        self.assertEqual(os.listdir(self.archive_dir), [])
+        self.assertEqual(CashFlowLog.objects.count(), 3)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    """open on failures and slow calls, probe when open_for is over
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(circuitbreaker.time, 'monotonic',
+            lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.breaker = CircuitBreaker('test', failure_rate=0.5, min_calls=4,
+            window=30, slow_call=5, open_for=30)
+
+    def calls(self, *outcomes):
+        for ok, duration in outcomes:
+            self.breaker.before()
+            self.breaker.record(ok, duration)
+
+    def open(self):
+        self.calls(*[(False, 0.1)] * 4)
+        self.assertEqual(self.breaker.state, circuitbreaker.OPEN)
+
+    def test_failure_rate(self):
+        self.calls((True, 0.1), (False, 0.1), (True, 0.1))
+        self.assertEqual(self.breaker.state, circuitbreaker.CLOSED)
+
+        self.calls((False, 0.1))
+        self.assertEqual(self.breaker.state, circuitbreaker.OPEN)
+        self.assertFalse(self.breaker.allows_calls())
+        with self.assertRaises(GatewayUnavailable):
+            self.breaker.before()
+
+    def test_old_failures_are_forgotten(self):
+        self.calls((False, 0.1), (False, 0.1))
+        self.now += 31
+
+        self.calls((True, 0.1), (True, 0.1), (False, 0.1), (True, 0.1))
+        self.assertEqual(self.breaker.state, circuitbreaker.CLOSED)
+
+    def test_slow_calls(self):
+        self.calls(*[(True, 6)] * 4)
+        self.assertEqual(self.breaker.state, circuitbreaker.OPEN)
+
+    def test_probe(self):
+        self.open()
+        self.now += 30
+        self.assertTrue(self.breaker.allows_calls())
+
+        self.breaker.before()
+        self.assertEqual(self.breaker.state, circuitbreaker.HALF_OPEN)
+        # one probe at a time
+        with self.assertRaises(GatewayUnavailable):
+            self.breaker.before()
+
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, circuitbreaker.CLOSED)
+
+    def test_failed_probe(self):
+        self.open()
+        self.now += 30
+
+        self.calls((False, 0.1))
+        self.assertEqual(self.breaker.state, circuitbreaker.OPEN)
+        with self.assertRaises(GatewayUnavailable):
+            self.breaker.before()
+
+    def test_cancel(self):
+        self.open()
+        self.now += 30
+        self.breaker.before()
+
+        self.breaker.cancel()
+        self.assertTrue(self.breaker.allows_calls())
+        self.breaker.before()
+
+    def test_lost_probe(self):
+        self.open()
+        self.now += 30
+        self.breaker.before()
+
+        self.now += 29
+        with self.assertRaises(GatewayUnavailable):
+            self.breaker.before()
+
+        self.now += 1
+        self.breaker.before()
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, circuitbreaker.CLOSED)
+
+
+class IsAvailableTest(SimpleTestCase):
+
+    """a variant is offered unless the breaker of its provider is open
+    """
+
+    @mock.patch.object(views, 'get_provider')
+    def test_open_breaker(self, get_provider):
+        breaker = CircuitBreaker('test', min_calls=1)
+        get_provider.return_value.get_breaker.return_value = breaker
+        self.assertTrue(views._is_available('paypal'))
+
+        breaker.before()
+        breaker.record(False, 0.1)
+        self.assertFalse(views._is_available('paypal'))
+
+    @mock.patch.object(views, 'get_provider')
+    def test_no_breaker(self, get_provider):
+        get_provider.return_value.get_breaker.return_value = None
+        self.assertTrue(views._is_available('paypal'))
+
+
+def count_checkout_queries(token):
+    """queries run to start a checkout of the payment of token, and to
+    start it again (another provider or a retry)
+    """
+    counts = []
+    for _ in range(2):
+        with CaptureQueriesContext(connection) as queries:
+            payment = load_payment(Payment.objects, token=token)
+            get_checkout_snapshot(payment)
+        counts.append(len(queries))
+
+    return tuple(counts)
+
+
+class CheckoutSnapshotTest(TestCase):
+
+    """a checkout reads the items once, starting it again is the payment
+    query only
+    """
+
+    def setUp(self):
+        self.payment = make_payment(variant='paypal')
+
+    def test_queries(self):
+        first, second = count_checkout_queries(self.payment.token)
+
+        # the payment, then the lines of its order
+        self.assertLessEqual(first, 3)
+        self.assertEqual(second, 1)
+
+    def test_saved_payment_is_read_again(self):
+        count_checkout_queries(self.payment.token)
+
+        self.payment.billing_first_name = 'Daming'
+        self.payment.save()
+
+        first, second = count_checkout_queries(self.payment.token)
+        self.assertGreater(first, 1)
+        self.assertEqual(second, 1)
+
+    def test_buyer_is_not_cached(self):
+        payment = load_payment(Payment.objects, token=self.payment.token)
+        get_checkout_snapshot(payment)
+
+        payment.order.user_email = 'another@example.com'
+        self.assertEqual(get_checkout_snapshot(payment).email,
+            'another@example.com')
+
+
+class CheckMacValueVectorsTest(SimpleTestCase):
+
+    """the signer must give what md5 of _encode_param gives, the vectors
+    are in testdata (non-ascii item names, the reserved ()!* characters,
+    a notify with its CheckMacValue)
+    """
+
+    def setUp(self):
+        self.provider = AllPayProvider(**ALLPAY_TEST_MERCHANT)
+
+    def test_encode_param(self):
+        for params, expected in CHECK_MAC_VALUE_VECTORS:
+            with self.subTest(params['MerchantTradeNo']):
+                hash_code = self.provider._encode_param(params)
+                self.assertEqual(
+                    hashlib.md5(hash_code.encode('utf-8')).hexdigest().upper(),
+                    expected)
+
+    def test_signer(self):
+        for params, expected in CHECK_MAC_VALUE_VECTORS:
+            with self.subTest(params['MerchantTradeNo']):
+                self.assertEqual(self.provider._signer.sign(params), expected)
+                self.assertTrue(self.provider._signer.verify(
+                    dict(params, CheckMacValue=expected)))
+
+    def test_verify_mac_value(self):
+        params, expected = CHECK_MAC_VALUE_VECTORS[2]
+        self.assertTrue(self.provider.verify_macValue(
+            **dict(params, CheckMacValue=expected)))
+        self.assertFalse(self.provider.verify_macValue(
+            **dict(params, CheckMacValue=expected, TradeAmt='1051')))
+
+    def test_reserved_characters(self):
+        # ()!* are not escaped, everything else is lowered after quote_plus
+        params = {'ItemName': '(A)!*B #商品'}
+        self.assertEqual(self.provider._encode_param(params),
+            'hashkey%3d5294y06jbispm5x9%26itemname%3d(a)!*b+%23%e5%95%86%e5'
+            '%93%81%26hashiv%3dv77hokgq4kwxnnis')
+        self.assertEqual(self.provider._signer.sign(params),
+            hashlib.md5(self.provider._encode_param(params).encode(
+                'utf-8')).hexdigest().upper())
+
+
+class AliPayRSAKeysTest(SimpleTestCase):
+
+    """a provider which couldn't verify its RSA notifies isn't created
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        cls.private_key = key.private_bytes(serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        cls.public_key = key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    def provider(self, **kwargs):
+        return AliPayProvider(vendor='2088101122136241',
+            app_id='2088101122136241', **kwargs)
+
+    def test_private_key_only(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.provider(private_key=self.private_key, sign_type='RSA')
+
+    def test_public_key_only(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.provider(alipay_public_key=self.public_key, sign_type='RSA2')
+
+    def test_key_pair(self):
+        provider = self.provider(private_key=self.private_key,
+            alipay_public_key=self.public_key, sign_type='RSA2')
 
-# Create your tests here.
+        notify = {'out_trade_no': 'T20160101000001', 'sign_type': 'RSA2'}
+        notify['sign'] = provider._generate_sign('RSA2', notify)
+        self.assertTrue(provider._get_signer('RSA2').verify(notify,
+            notify['sign']))
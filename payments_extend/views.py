@@ -1,10 +1,53 @@
+from django.conf import settings
 from django.shortcuts import render
-from payments import provider_factory
+from django.core.urlresolvers import NoReverseMatch
+from django.core.urlresolvers import reverse
 
 from saleor.order.models import Payment
 
+from .circuitbreaker import GatewayUnavailable
+from .lookups import load_payment
+from .registry import get_provider
+
 # Create your views here.
 
+def _is_available(variant):
+    """false if the gateway of variant is failing fast now
+    """
+    try:
+        provider = get_provider(variant)
+    except ValueError:
+        return False
+
+    # providers of django-payments have no breaker
+    get_breaker = getattr(provider, 'get_breaker', None)
+    breaker = get_breaker() if get_breaker is not None else None
+    return breaker is None or breaker.allows_calls()
+
+
+def gateway_unavailable(request, payment, retry_url=None):
+    """let the buyer choose another payment method at once, or try again at
+    retry_url (e.g. the paypal return url, the buyer's approval is kept)
+    """
+    try:
+        payment_process_url = reverse('web_api:cnpayments:payment_process')
+    except NoReverseMatch:
+        payment_process_url = None
+
+    context = {
+        'page': 'gateway_unavailable',
+        'payment': payment,
+        'payment_process_url': payment_process_url,
+        'retry_url': retry_url,
+        'alternatives': [(variant, name) for variant, name in
+            getattr(settings, 'CHECKOUT_PAYMENT_CHOICES', ())
+            if variant != payment.variant and _is_available(variant)],
+    }
+
+    return render(request, 'payments_extend/gateway_unavailable.html', context,
+        status=503)
+
+
 def direct_to_pay(request, token):
     """post to cash flow merchantdise with params needed
 
@@ -13,17 +56,22 @@ def direct_to_pay(request, token):
      - call process_data (a unify facade for transfering payment data to
        cash flow merchandise)
 
+    when the gateway is down (its circuit breaker is open) the other
+    payment methods are offered instead of waiting for it.
     """
     context = {
         'page': 'direct_to_pay'
     }
 
     if token is not None:
-        payment = Payment.objects.filter(token=token).first()
+        payment = load_payment(Payment.objects, token=token)
 
 
-    provider = provider_factory(payment.variant)
-    form = provider.process_data(payment, request)
+    provider = get_provider(payment.variant)
+    try:
+        form = provider.process_data(payment, request)
+    except GatewayUnavailable:
+        return gateway_unavailable(request, payment)
 
     context['form'] = form
 
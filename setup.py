@@ -11,6 +11,9 @@ PACKAGES = [
     'payments_extend',
     'payments_extend.alipay',
     'payments_extend.allpay',
+    'payments_extend.management',
+    'payments_extend.management.commands',
+    'payments_extend.migrations',
     'payments_extend.paypal',
 ]
 
@@ -18,6 +21,11 @@ REQUIREMENTS = [
     'django-payments',
 ]
 
+EXTRAS_REQUIREMENTS = {
+    'async': ['aiohttp'],
+    'rsa': ['cryptography'],
+}
+
 
 setup(
     name='django-payments-extend',
@@ -28,5 +36,6 @@ setup(
     url='https://github.com/sillygod/payments',
     packages=PACKAGES,
     install_requires=REQUIREMENTS,
+    extras_require=EXTRAS_REQUIREMENTS,
     include_package_data=True,
 )